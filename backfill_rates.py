@@ -0,0 +1,32 @@
+import argparse
+import asyncio
+import sys
+from datetime import date
+
+from clients.exchange_rates.base import BaseExchangeRateClient
+from clients.exchange_rates.nbp_client import NBPExchangeRateClient
+
+
+# Loads NBP table C rates for a range of dates into the local rate store, for example:
+#   python backfill_rates.py --start 2024-01-01 --end 2024-12-31
+# Days that are already stored are skipped, so the command can be rerun to extend a range.
+
+async def backfill(start: date, end: date) -> int:
+    try:
+        return await NBPExchangeRateClient.backfill(start, end)
+    finally:
+        await BaseExchangeRateClient.close_http_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the local exchange rate store from the NBP API")
+    parser.add_argument("--start", type=date.fromisoformat, required=True, help="first date, YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today(), help="last date, defaults to today")
+    args = parser.parse_args()
+
+    stored = asyncio.run(backfill(args.start, args.end))
+    print(f"Stored {stored} rates", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Tail latency of wallet reads when the API is offered more load than
+DynamoDB can serve, with admission control off and on.
+
+DynamoDB is made a bottleneck by letting only `--backend-capacity` calls
+run at once, each taking at least `--service-time` seconds, which with the
+defaults serves about 40 requests per second. Many users send a mix of
+GET /wallet/original and GET /wallet requests at 1.5 times that rate.
+Without admission control every request waits in a queue that keeps
+growing, with it the excess is shed with fast 503s and the admitted requests
+keep a bounded latency, cheap wallet reads ahead of conversions. The tail
+of the admitted requests comes from the first seconds, while the limit
+comes down from its initial value.
+
+The client runs in the same process as the API, keep the rate low enough
+for both to fit on the machine's CPUs, or the client's own delays end up in
+the latencies.
+
+    python -m benchmarks.bench_admission_control --rate 60 --duration 10
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+
+from settings import api_settings
+
+from benchmarks.common import local_environment, serve, summarise
+
+PATHS = ("/wallet/original", "/wallet")
+
+
+def limit_backend(capacity: int, service_time: float):
+    """
+    Lets only `capacity` DynamoDB calls run at once, each taking at least `service_time`
+    """
+    from clients.aws.dynamo import AsyncTable
+
+    call = AsyncTable._call
+    slots = {}
+
+    async def limited_call(self, operation, method, **kwargs):
+        loop = asyncio.get_running_loop()
+        semaphore = slots.setdefault(loop, asyncio.Semaphore(capacity))
+        async with semaphore:
+            await asyncio.sleep(service_time)
+            return await call(self, operation, method, **kwargs)
+
+    AsyncTable._call = limited_call
+
+
+async def overload(base_url: str, users: list, args) -> dict:
+    """
+    Sends requests at a fixed rate regardless of how fast they are answered,
+    like clients do, so requests the API can't keep up with pile up
+    """
+    from services.auth_service import AuthService
+
+    headers = [
+        {"Authorization": f"Bearer {AuthService.create_access_token(data={'sub': user_id}).access_token}"}
+        for user_id in users
+    ]
+    latencies = {}
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=args.rate)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        async def send(path):
+            started = time.perf_counter()
+            response = await client.get(path, headers=random.choice(headers))
+            latencies.setdefault((path, response.status_code), []).append(time.perf_counter() - started)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        requests = []
+        for index in range(int(args.rate * args.duration)):
+            await asyncio.sleep(max(0.0, started + index / args.rate - loop.time()))
+            path = PATHS[0] if random.random() < args.read_share else PATHS[1]
+            requests.append(asyncio.create_task(send(path)))
+        await asyncio.gather(*requests)
+        elapsed = loop.time() - started
+
+    return {key: summarise(values, elapsed) for key, values in sorted(latencies.items())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=int, default=60, help="requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--read-share", type=float, default=0.7)
+    parser.add_argument("--backend-capacity", type=int, default=2)
+    parser.add_argument("--service-time", type=float, default=0.05)
+    parser.add_argument("--target-latency", type=float, default=0.25)
+    args = parser.parse_args()
+
+    random.seed(0)
+    # Conversions have to read the wallet, otherwise they never reach the backend
+    api_settings.converted_wallet_cache_enabled = False
+    api_settings.admission_target_latency = args.target_latency
+
+    results = {}
+    with local_environment():
+        from main import app
+        from services import admission_control
+        from test.fixtures.create_database_resources import create_extra_wallets
+
+        users = create_extra_wallets(args.users)
+        limit_backend(args.backend_capacity, args.service_time)
+
+        with serve(app) as base_url:
+            for enabled in (False, True):
+                api_settings.admission_control_enabled = enabled
+                admission_control.admission_controller = admission_control.AdmissionController()
+                results[enabled] = asyncio.run(overload(base_url, users, args))
+                final_limit = admission_control.admission_controller.limit.limit
+
+    print(
+        f"{args.rate} requests per second for {args.duration:.0f} s, DynamoDB capacity "
+        f"{args.backend_capacity} calls at {args.service_time * 1000:.0f} ms each"
+    )
+    for enabled, result in results.items():
+        for (path, status_code), summary in result.items():
+            label = f"admission {'on' if enabled else 'off'}: {path} {status_code}"
+            print(
+                f"  {label:<40} {summary['requests']:>6} requests"
+                f"  p50 {summary['p50_ms']:>8} ms  p99 {summary['p99_ms']:>8} ms"
+            )
+    print(f"Adaptive concurrency limit at the end: {final_limit:.1f}")
+
+
+if __name__ == "__main__":
+    main()
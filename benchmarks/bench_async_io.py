@@ -0,0 +1,76 @@
+"""
+Concurrent-request throughput of the wallet endpoints when the
+DynamoDB round trip is slow.
+
+The "blocking" app reproduces the previous handlers, which called boto3
+directly inside `async def` routes; the "async" app is the real API.
+A fixed delay is added in front of every DynamoDB call to stand in for
+network latency, since moto answers instantly.
+
+    python -m benchmarks.bench_async_io --ddb-latency-ms 20 --concurrency 32
+"""
+import argparse
+import time
+
+from fastapi import Depends, FastAPI
+
+from benchmarks.common import auth_headers, local_environment, print_results, run_load, serve
+
+
+def build_blocking_app():
+    from clients.aws import wallets_table
+    from models.wallet import CommonWalletData
+    from services.auth_service import AuthService
+
+    blocking_app = FastAPI()
+
+    @blocking_app.get("/wallet/original")
+    async def get_original_wallet(user_id: str = Depends(AuthService.get_user_id)) -> CommonWalletData:
+        data = wallets_table.get_item(
+            Key={"user_id": user_id},
+            ProjectionExpression="balances, local_currency, user_id"
+        )
+        return CommonWalletData(**data["Item"])
+
+    return blocking_app
+
+
+def add_latency(table, latency: float):
+    get_item = table.get_item
+
+    def slow_get_item(**kwargs):
+        time.sleep(latency)
+        return get_item(**kwargs)
+
+    table.get_item = slow_get_item
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--ddb-latency-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    with local_environment():
+        from clients.aws import wallets_table
+        from main import app
+
+        add_latency(wallets_table, args.ddb_latency_ms / 1000)
+        headers = auth_headers()
+        results = {}
+
+        for name, target_app in (("blocking (before)", build_blocking_app()), ("async (after)", app)):
+            with serve(target_app) as base_url:
+                results[name] = run_load(
+                    base_url, "GET", "/wallet/original", args.requests, args.concurrency, headers=headers
+                )
+
+    print_results(
+        f"GET /wallet/original, {args.concurrency} concurrent, {args.ddb_latency_ms}ms DynamoDB latency",
+        results,
+    )
+
+
+if __name__ == "__main__":
+    main()
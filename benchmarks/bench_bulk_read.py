@@ -0,0 +1,47 @@
+"""
+Reading many wallets one by one (a get_item per user, like calling
+GET /wallet/original per user) against WalletService.get_wallets,
+which uses BatchGetItem in chunks of 100 keys.
+
+    python -m benchmarks.bench_bulk_read --wallets 10000
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.common import local_environment
+from test.fixtures.create_database_resources import create_extra_wallets
+
+
+async def read_one_by_one(user_ids) -> int:
+    from services.wallet_service import WalletService
+
+    for user_id in user_ids:
+        await WalletService.get_original_wallet(user_id)
+    return len(user_ids)
+
+
+async def read_in_bulk(user_ids) -> int:
+    from services.wallet_service import WalletService
+
+    return len([result async for result in WalletService.get_wallets(user_ids)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wallets", type=int, default=10000)
+    args = parser.parse_args()
+
+    with local_environment():
+        user_ids = create_extra_wallets(args.wallets)
+
+        print(f"Reading {args.wallets} wallets")
+        for name, read in (("one by one", read_one_by_one), ("bulk", read_in_bulk)):
+            started = time.perf_counter()
+            count = asyncio.run(read(user_ids))
+            elapsed = time.perf_counter() - started
+            print(f"  {name:<12} {elapsed:8.2f} s  {count / elapsed:10,.0f} wallets/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Cost of converting a wallet to local currency per request, with and
+without memoized conversion results. The wallet cache is switched on and
+rates are warm, so the numbers are dominated by conversion and validation.
+
+    python -m benchmarks.bench_conversion --iterations 20000
+"""
+import argparse
+import asyncio
+import time
+
+from settings import api_settings
+
+from benchmarks.common import local_environment
+from test.data.wallets import DEFAULT_WALLET_DATA
+
+
+async def measure(iterations: int) -> float:
+    from services.wallet_service import WalletService
+
+    # Warm the wallet cache, the rate cache and (if enabled) the memoized result
+    await WalletService.get_local_currency_wallet(DEFAULT_WALLET_DATA["user_id"])
+    await WalletService.get_local_currency_wallet(DEFAULT_WALLET_DATA["user_id"])
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await WalletService.get_local_currency_wallet(DEFAULT_WALLET_DATA["user_id"])
+    return (time.perf_counter() - started) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    api_settings.wallet_cache_enabled = True
+    results = {}
+
+    with local_environment():
+        for name, memoized in (("without memoization", False), ("with memoization", True)):
+            api_settings.converted_wallet_cache_enabled = memoized
+            results[name] = asyncio.run(measure(args.iterations))
+
+    print("WalletService.get_local_currency_wallet")
+    for name, seconds in results.items():
+        print(f"  {name:<20} {seconds * 1e6:8.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
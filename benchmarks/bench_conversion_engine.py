@@ -0,0 +1,83 @@
+"""
+Cost of the conversion arithmetic alone, for many wallets. Compares the
+former per-currency float loop, the exact engine one wallet at a time and
+the engine converting the whole batch in one call.
+
+    python -m benchmarks.bench_conversion_engine --wallets 100000
+"""
+import argparse
+import random
+import time
+from decimal import Decimal
+from typing import Callable, Dict, List
+
+from services.currency_conversion import ConversionEngine
+from test.data.exchange_rates import DEFAULT_EXCHANGE_RATES
+
+
+def build_wallets(count: int) -> List[Dict[str, Decimal]]:
+    rng = random.Random(0)
+    return [
+        {
+            currency: Decimal(rng.randint(0, 10_000_000)).scaleb(-rng.randint(0, 4))
+            for currency in rng.sample(["EUR", "USD", "JPY"], rng.randint(1, 3))
+        }
+        for _ in range(count)
+    ]
+
+
+def float_loop(wallets: List[Dict[str, Decimal]], exchange_rates: Dict[str, float]):
+    for balances in wallets:
+        total = 0
+        for currency, balance in balances.items():
+            total += round(float(balance) * exchange_rates[currency], 2)
+        round(total, 2)
+
+
+def engine_per_wallet(wallets: List[Dict[str, Decimal]], exchange_rates: Dict[str, float]):
+    engine = ConversionEngine(exchange_rates)
+    for balances in wallets:
+        engine.convert(balances)
+
+
+def engine_batch(wallets: List[Dict[str, Decimal]], exchange_rates: Dict[str, float]):
+    ConversionEngine(exchange_rates).convert_many(wallets)
+
+
+def measure(
+        convert: Callable,
+        wallets: List[Dict[str, Decimal]],
+        exchange_rates: Dict[str, float],
+        repeats: int,
+) -> float:
+    """
+    Best time per wallet out of several runs
+    """
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        convert(wallets, exchange_rates)
+        timings.append((time.perf_counter() - started) / len(wallets))
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wallets", type=int, default=100000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    wallets = build_wallets(args.wallets)
+    exchange_rates = {currency: rate["bid"] for currency, rate in DEFAULT_EXCHANGE_RATES.items()}
+
+    print(f"Converting {args.wallets} wallets")
+    for name, convert in (
+            ("float loop", float_loop),
+            ("engine per wallet", engine_per_wallet),
+            ("engine batch", engine_batch),
+    ):
+        print(f"  {name:<20} {measure(convert, wallets, exchange_rates, args.repeats) * 1e6:8.2f} us/wallet")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Cost of GET /wallet/history queries as a function of history length,
+replaying the whole ledger against reading the closest snapshot plus
+the entries after it. Ledger entries and the snapshots a periodic
+compaction job would have written are loaded directly into the table.
+
+    python -m benchmarks.bench_ledger_history --lengths 100 1000 10000 --interval 100
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from settings import api_settings
+
+from benchmarks.common import local_environment
+from test.fixtures.create_database_resources import create_extra_wallets
+
+# Ledger entries are one second apart, starting here
+HISTORY_START = 1_700_000_000
+
+
+def load_history(user_id: str, length: int, snapshot_interval: int):
+    """
+    Writes `length` entries adding 1 JPY each, and a snapshot every `snapshot_interval` entries
+    """
+    from clients.aws import ledger_table, wallets_table
+    from services.ledger_service import ENTRY_PREFIX, SNAPSHOT_PREFIX
+
+    position = None
+    with ledger_table.batch_writer() as batch:
+        for index in range(1, length + 1):
+            position = f"{(HISTORY_START + index) * 1_000_000:016d}#{index:032x}"
+            batch.put_item(Item={"user_id": user_id, "entry_key": ENTRY_PREFIX + position, "changes": {"JPY": 1}})
+            if snapshot_interval and index % snapshot_interval == 0:
+                batch.put_item(Item={
+                    "user_id": user_id,
+                    "entry_key": SNAPSHOT_PREFIX + position,
+                    "balances": {"JPY": index},
+                    "entry_count": index,
+                })
+
+    wallets_table.put_item(Item={
+        "user_id": user_id,
+        "balances": {"JPY": length},
+        "local_currency": "PLN",
+        "ledger_entry": position,
+        "ledger_entry_count": length,
+    })
+
+
+async def query_history(user_id: str, length: int, queries: int) -> tuple:
+    """
+    Queries random points in the history, returns the mean latency and items read per query
+    """
+    from clients.aws import async_ledger_table
+    from services.ledger_service import LedgerService
+
+    items_read = 0
+    query = async_ledger_table.query
+
+    async def counting_query(**kwargs):
+        nonlocal items_read
+        response = await query(**kwargs)
+        items_read += len(response["Items"])
+        return response
+
+    async_ledger_table.query = counting_query
+    try:
+        started = time.perf_counter()
+        for _ in range(queries):
+            index = random.randint(1, length)
+            at = datetime.fromtimestamp(HISTORY_START + index, timezone.utc)
+            balances = await LedgerService.get_balances_at(user_id, at)
+            assert balances["JPY"] == Decimal(index)
+        elapsed = time.perf_counter() - started
+    finally:
+        async_ledger_table.query = query
+
+    return elapsed / queries, items_read / queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--interval", type=int, default=api_settings.ledger_snapshot_interval)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    with local_environment():
+        print(f"{args.queries} history queries at random times, snapshots every {args.interval} entries")
+        for length in args.lengths:
+            for name, interval in (("full replay", 0), ("snapshots", args.interval)):
+                user_id = create_extra_wallets(1)[0]
+                load_history(user_id, length, interval)
+                latency, items_read = asyncio.run(query_history(user_id, length, args.queries))
+                print(f"  {length:>7} entries  {name:<12} {latency * 1000:9.2f} ms/query  {items_read:9.1f} items read/query")
+
+
+if __name__ == "__main__":
+    main()
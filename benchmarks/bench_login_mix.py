@@ -0,0 +1,70 @@
+"""
+Wallet read latency while the API is hit by a burst of logins.
+
+Compares verifying bcrypt hashes directly on the event loop ("inline",
+the previous behaviour) with the bounded password hashing pool. Logins
+rejected by a saturated pool show up as 503s in the status counts.
+
+    python -m benchmarks.bench_login_mix --logins 64 --wallet-requests 400
+"""
+import argparse
+import asyncio
+from contextlib import contextmanager
+
+from benchmarks.common import auth_headers, local_environment, print_results, run_load_async, serve
+
+LOGIN_FORM = {"username": "pjauvin", "password": "supermariobros", "grant_type": "password"}
+
+
+@contextmanager
+def inline_password_hashing():
+    from services.auth_service import password_hashing_pool
+
+    async def run_inline(func, *args):
+        return func(*args)
+
+    original_run = password_hashing_pool.run
+    password_hashing_pool.run = run_inline
+    try:
+        yield
+    finally:
+        password_hashing_pool.run = original_run
+
+
+async def mixed_load(base_url, args, headers):
+    login_result, wallet_result = await asyncio.gather(
+        run_load_async(base_url, "POST", "/token", args.logins, args.login_concurrency, data=LOGIN_FORM),
+        run_load_async(base_url, "GET", "/wallet/original", args.wallet_requests, args.wallet_concurrency, headers=headers),
+    )
+    return login_result, wallet_result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--login-concurrency", type=int, default=16)
+    parser.add_argument("--wallet-requests", type=int, default=400)
+    parser.add_argument("--wallet-concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    results = {}
+    with local_environment():
+        from main import app
+
+        headers = auth_headers()
+
+        with serve(app) as base_url:
+            with inline_password_hashing():
+                login_result, wallet_result = asyncio.run(mixed_load(base_url, args, headers))
+            results["inline: POST /token"] = login_result
+            results["inline: GET /wallet/original"] = wallet_result
+
+            login_result, wallet_result = asyncio.run(mixed_load(base_url, args, headers))
+            results["pool: POST /token"] = login_result
+            results["pool: GET /wallet/original"] = wallet_result
+
+    print_results("Wallet reads during a login burst", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+CPU time per GET /wallet request with metrics switched off and on, and
+the time it takes to render /metrics once the series exist.
+
+End to end differences are within the noise of a shared machine, so the
+metrics a /wallet request records (the middleware around a trivial ASGI app
+and every stage timer) are also timed on their own.
+
+Requests are sent one at a time in process. With the wallet and conversion
+caches on there is little other work per request, which makes this the
+worst case for the relative overhead. Runs alternate between off and on
+and the best round of each is kept, to keep machine noise out of the difference.
+
+    python -m benchmarks.bench_metrics_overhead --requests 3000 --rounds 5
+"""
+import argparse
+import asyncio
+import time
+
+from settings import api_settings
+
+from benchmarks.common import auth_headers, local_environment, measure_cpu_per_request
+
+
+def measure_instrumentation(iterations: int) -> float:
+    """
+    CPU time of the metrics recorded for one GET /wallet request
+    """
+    import metrics
+
+    async def empty_app(scope, receive, send):
+        scope["route"] = None
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def noop(message):
+        pass
+
+    async def run(app):
+        scope = {"type": "http", "method": "GET"}
+        started = time.process_time()
+        for _ in range(iterations):
+            await app(scope, None, noop)
+            for stage in ("jwt_decode", "wallet_read", "exchange_rates", "conversion", "serialization"):
+                with metrics.stage_duration.time(stage):
+                    pass
+            metrics.dynamodb_request_duration.observe(0.001, "user_wallets", "GetItem")
+            metrics.record_consumed_capacity("GetItem", {"TableName": "user_wallets", "CapacityUnits": 0.5})
+        return (time.process_time() - started) / iterations
+
+    api_settings.metrics_enabled = False
+    baseline = asyncio.run(run(empty_app))
+    api_settings.metrics_enabled = True
+    instrumented = asyncio.run(run(metrics.MetricsMiddleware(empty_app)))
+    return instrumented - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+
+    with local_environment():
+        import metrics
+        from main import app
+
+        headers = auth_headers()
+        # The first round of a process runs noticeably slower, it is left out
+        asyncio.run(measure_cpu_per_request(app, "/wallet", args.requests, headers))
+
+        for cached in (True, False):
+            api_settings.wallet_cache_enabled = cached
+            api_settings.converted_wallet_cache_enabled = cached
+            for _ in range(args.rounds):
+                for enabled in (False, True):
+                    api_settings.metrics_enabled = enabled
+                    seconds = asyncio.run(measure_cpu_per_request(app, "/wallet", args.requests, headers))
+                    key = (cached, enabled)
+                    results[key] = min(results.get(key, seconds), seconds)
+
+        started = time.perf_counter()
+        metrics.registry.render()
+        render_seconds = time.perf_counter() - started
+        instrumentation_seconds = measure_instrumentation(args.requests * 10)
+
+    print(f"GET /wallet CPU time per request, best of {args.rounds} rounds of {args.requests}")
+    for cached in (True, False):
+        off, on = results[(cached, False)], results[(cached, True)]
+        label = "caches on" if cached else "caches off"
+        print(
+            f"  {label:<12} metrics off {off * 1e6:8.1f} us   metrics on {on * 1e6:8.1f} us"
+            f"   overhead {(on - off) * 1e6:6.1f} us ({(on - off) / off:+.1%})"
+        )
+    print(f"Metrics recorded per request: {instrumentation_seconds * 1e6:.1f} us")
+    print(f"Rendering /metrics: {render_seconds * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
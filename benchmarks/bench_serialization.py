@@ -0,0 +1,66 @@
+"""
+CPU time per request of GET /wallet and GET /wallet/original, with the
+response model validated and encoded by FastAPI against the real API,
+which writes the already validated model straight to JSON.
+
+The "validated" app reproduces the previous handlers, which returned the
+model for FastAPI to validate against the return annotation again. Requests
+are sent one at a time in process, with the wallet and conversion caches
+on, so the numbers are dominated by the request path rather than moto.
+
+    python -m benchmarks.bench_serialization --requests 5000
+"""
+import argparse
+import asyncio
+
+from fastapi import Depends, FastAPI
+
+from settings import api_settings
+
+from benchmarks.common import auth_headers, local_environment, measure_cpu_per_request
+
+
+def build_validated_app():
+    from models.wallet import ClientWallet, CommonWalletData
+    from services.auth_service import AuthService
+    from services.wallet_service import WalletService
+
+    validated_app = FastAPI()
+
+    @validated_app.get("/wallet/original")
+    async def get_original_wallet(user_id: str = Depends(AuthService.get_user_id)) -> CommonWalletData:
+        return await WalletService.get_original_wallet(user_id)
+
+    @validated_app.get("/wallet")
+    async def get_wallet(user_id: str = Depends(AuthService.get_user_id)) -> ClientWallet:
+        return await WalletService.get_local_currency_wallet(user_id)
+
+    return validated_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    api_settings.wallet_cache_enabled = True
+    api_settings.converted_wallet_cache_enabled = True
+
+    with local_environment():
+        from main import app
+
+        headers = auth_headers()
+        results = {}
+        for name, target_app in (("validated (before)", build_validated_app()), ("pre-serialized (after)", app)):
+            for path in ("/wallet/original", "/wallet"):
+                results[(path, name)] = asyncio.run(
+                    measure_cpu_per_request(target_app, path, args.requests, headers)
+                )
+
+    print(f"CPU time per request, {args.requests} sequential requests")
+    for (path, name), seconds in results.items():
+        print(f"  {path:<18} {name:<24} {seconds * 1e6:8.1f} us")
+
+
+if __name__ == "__main__":
+    main()
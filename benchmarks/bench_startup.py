@@ -0,0 +1,92 @@
+"""
+Startup time of the API: how long `import main` takes in a fresh interpreter
+and how long the first GET /wallet takes after it, which is where the AWS
+clients are now set up.
+
+Every run is a new process without any AWS configuration in its environment,
+so importing also checks that nothing talks to AWS at import time. The median
+of the runs is compared against the limits and the script exits with status 1
+when one is exceeded, so it can guard against startup regressions in CI.
+
+    python -m benchmarks.bench_startup --runs 5 --max-import-ms 3000 --max-first-request-ms 1500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def measure_child():
+    """
+    Runs in the child process, prints the timings as JSON
+    """
+    started = time.perf_counter()
+    import main
+    import_seconds = time.perf_counter() - started
+
+    # Only imported now, so the test fixtures and moto aren't part of the import time
+    import asyncio
+
+    import httpx
+
+    from benchmarks.common import auth_headers, local_environment
+
+    async def first_request():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            started = time.perf_counter()
+            response = await client.get("/wallet", headers=headers)
+            assert response.status_code == 200, response.text
+            return time.perf_counter() - started
+
+    with local_environment():
+        headers = auth_headers()
+        first_request_seconds = asyncio.run(first_request())
+
+    print(json.dumps({"import": import_seconds, "first_request": first_request_seconds}))
+
+
+def measure(runs: int) -> dict:
+    env = {key: value for key, value in os.environ.items() if not key.startswith("AWS_")}
+    timings = {"import": [], "first_request": []}
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_startup", "--child"],
+            env=env, capture_output=True, text=True, check=True
+        )
+        for name, seconds in json.loads(result.stdout.splitlines()[-1]).items():
+            timings[name].append(seconds)
+    return {name: statistics.median(values) for name, values in timings.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=3000)
+    parser.add_argument("--max-first-request-ms", type=float, default=1500)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure_child()
+        return
+
+    results = measure(args.runs)
+    limits = {"import": args.max_import_ms, "first_request": args.max_first_request_ms}
+
+    print(f"Startup, median of {args.runs} fresh processes")
+    exceeded = False
+    for name, seconds in results.items():
+        within = seconds * 1000 <= limits[name]
+        exceeded = exceeded or not within
+        print(f"  {name:<14} {seconds * 1000:8.1f} ms   limit {limits[name]:8.1f} ms   {'ok' if within else 'EXCEEDED'}")
+
+    if exceeded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Throughput of AuthService.get_user_id with the verified-token cache
+hit and missed. A miss decodes and validates the JWT like every
+request used to.
+
+    python -m benchmarks.bench_token_cache --iterations 100000
+"""
+import argparse
+import asyncio
+import time
+
+from test.data.users import DEFAULT_USER_RECORD
+from test.fixtures.util import set_fake_aws_credentials
+
+
+async def measure(get_user_id, token: str, iterations: int, before_call=None) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        if before_call is not None:
+            before_call()
+        await get_user_id(token)
+    return iterations / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    set_fake_aws_credentials()
+    from services.auth_service import AuthService, verified_token_cache
+
+    token = AuthService.create_access_token(data={"sub": DEFAULT_USER_RECORD["user_id"]}).access_token
+
+    missed = asyncio.run(measure(AuthService.get_user_id, token, args.iterations, verified_token_cache.clear))
+    hit = asyncio.run(measure(AuthService.get_user_id, token, args.iterations))
+
+    print("AuthService.get_user_id")
+    print(f"  cache missed {missed:>12,.0f} calls/s  {1e6 / missed:8.2f} us/call")
+    print(f"  cache hit    {hit:>12,.0f} calls/s  {1e6 / hit:8.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
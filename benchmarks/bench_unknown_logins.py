@@ -0,0 +1,83 @@
+"""
+Login latency and DynamoDB reads of the users table during a credential
+stuffing burst, with the user record cache off and on.
+
+Most logins in the burst use one of a small set of unknown usernames and
+the rest log in the default user. Unknown usernames are checked against a
+dummy bcrypt hash, so with or without the cache their latency should be
+close to that of real users, while the cache saves most of the reads.
+
+    python -m benchmarks.bench_unknown_logins --logins 200 --usernames 20
+"""
+import argparse
+import asyncio
+import random
+
+import httpx
+
+from settings import api_settings
+
+from benchmarks.common import local_environment, serve, summarise
+
+
+async def login_burst(base_url: str, args) -> dict:
+    unknown_usernames = [f"unknown-{index}" for index in range(args.usernames)]
+    forms = [
+        {"username": "pjauvin", "password": "supermariobros", "grant_type": "password"}
+        if random.random() < args.known_share else
+        {"username": random.choice(unknown_usernames), "password": "password", "grant_type": "password"}
+        for _ in range(args.logins)
+    ]
+    latencies = {"known": [], "unknown": []}
+    remaining = iter(forms)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        async def worker():
+            loop = asyncio.get_running_loop()
+            for form in remaining:
+                started = loop.time()
+                response = await client.post("/token", data=form)
+                latencies["known" if response.status_code == 200 else "unknown"].append(loop.time() - started)
+
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = asyncio.get_running_loop().time() - started
+
+    return {name: summarise(values, elapsed) for name, values in latencies.items() if values}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--usernames", type=int, default=20)
+    parser.add_argument("--known-share", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    random.seed(0)
+    reads = {}
+    results = {}
+    with local_environment():
+        import metrics
+        from main import app
+        from services import auth_service
+
+        with serve(app) as base_url:
+            for enabled in (False, True):
+                api_settings.user_cache_enabled = enabled
+                auth_service.user_cache.clear()
+                reads_before = metrics.dynamodb_request_duration.count(api_settings.users_table_name, "GetItem")
+                for name, result in asyncio.run(login_burst(base_url, args)).items():
+                    results[(enabled, name)] = result
+                reads[enabled] = metrics.dynamodb_request_duration.count(api_settings.users_table_name, "GetItem") - reads_before
+
+    print(f"POST /token, {args.logins} logins, {args.usernames} unknown usernames")
+    for (enabled, name), result in results.items():
+        label = f"cache {'on' if enabled else 'off'}: {name}"
+        print(f"  {label:<22} {result['requests']:>5} logins  p50 {result['p50_ms']:>8} ms  p99 {result['p99_ms']:>8} ms")
+    for enabled, count in reads.items():
+        print(f"  users table reads with the cache {'on' if enabled else 'off'}: {count}")
+
+
+if __name__ == "__main__":
+    main()
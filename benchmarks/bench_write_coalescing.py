@@ -0,0 +1,74 @@
+"""
+Add/subtract throughput on a single hot wallet with and without write
+coalescing. DynamoDB limits writes per partition, which moto doesn't do,
+so every write to the wallet item holds a per-item lock for
+1 / --item-writes-per-second seconds to simulate that limit.
+
+    python -m benchmarks.bench_write_coalescing --operations 2000 --concurrency 200
+"""
+import argparse
+import asyncio
+import threading
+import time
+from decimal import Decimal
+
+from settings import api_settings
+
+from benchmarks.common import local_environment
+from test.data.wallets import DEFAULT_WALLET_DATA
+
+
+def throttle_item_writes(table, writes_per_second: float):
+    update_item = table.update_item
+    item_lock = threading.Lock()
+
+    def throttled_update_item(**kwargs):
+        with item_lock:
+            time.sleep(1 / writes_per_second)
+            return update_item(**kwargs)
+
+    table.update_item = throttled_update_item
+
+
+async def hammer_wallet(operations: int, concurrency: int) -> float:
+    from services.wallet_service import WalletService
+
+    remaining = iter(range(operations))
+
+    async def worker():
+        for index in remaining:
+            # One subtraction for every two additions, so batches rarely cancel out
+            if index % 3 == 2:
+                await WalletService.subtract_from_wallet(DEFAULT_WALLET_DATA["user_id"], "JPY", Decimal(1))
+            else:
+                await WalletService.add_to_wallet(DEFAULT_WALLET_DATA["user_id"], "JPY", Decimal(1))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return operations / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--operations", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--item-writes-per-second", type=float, default=200)
+    args = parser.parse_args()
+
+    with local_environment():
+        from clients.aws import wallets_table
+        from services.wallet_service import WalletService
+
+        throttle_item_writes(wallets_table, args.item_writes_per_second)
+
+        print(f"{args.operations} add/subtract calls on one wallet, {args.item_writes_per_second:.0f} item writes/s")
+        for name, enabled in (("without coalescing", False), ("with coalescing", True)):
+            api_settings.write_coalescing_enabled = enabled
+            writes_before = WalletService.write_coalescer.writes
+            throughput = asyncio.run(hammer_wallet(args.operations, args.concurrency))
+            writes = WalletService.write_coalescer.writes - writes_before if enabled else args.operations
+            print(f"  {name:<20} {throughput:10,.0f} calls/s  {writes:6} DynamoDB writes")
+
+
+if __name__ == "__main__":
+    main()
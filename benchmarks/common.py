@@ -0,0 +1,175 @@
+import asyncio
+import itertools
+import os
+import statistics
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List, Optional, Union
+
+import httpx
+import uvicorn
+from moto import mock_aws
+
+from settings import api_settings
+
+from test.data.users import DEFAULT_USER_RECORD
+from test.fixtures.create_database_resources import (
+    create_idempotency_table, create_ledger_table, create_users_table, create_wallets_table
+)
+from test.fixtures.nbp_stub import NBPStubServer
+from test.fixtures.util import set_fake_aws_credentials
+
+
+# Shared helpers for the benchmark scripts. Like run_local.py, these reuse the
+# test fixtures so that DynamoDB (moto) and the NBP API (stub server) are local stand-ins.
+
+@contextmanager
+def local_environment(nbp_delay: float = 0.0, dynamodb_endpoint: Optional[str] = None):
+    """
+    Sets up mocked AWS resources, a stubbed NBP API and an empty
+    rate store, yields the stub server so request counts can be inspected
+
+    With `dynamodb_endpoint`, e.g. the DynamoDB Local container from
+    docker-compose.yml on http://localhost:8000, the tables are created
+    there (if missing) instead of in moto.
+    """
+    set_fake_aws_credentials()
+    nbp_stub = NBPStubServer(delay=nbp_delay).start()
+    original_nbp_url = api_settings.nbp_api_url
+    api_settings.nbp_api_url = nbp_stub.api_url
+    # Stub rates must never end up in the store that real runs read history from
+    rate_store_dir = tempfile.TemporaryDirectory()
+    original_rate_store_path = api_settings.rate_store_path
+    api_settings.rate_store_path = f"{rate_store_dir.name}/exchange_rates.sqlite3"
+    if dynamodb_endpoint:
+        # Read by boto3 when the clients are first built
+        os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = dynamodb_endpoint
+        aws = nullcontext()
+    else:
+        aws = mock_aws()
+    try:
+        with aws:
+            create_users_table()
+            create_wallets_table()
+            create_idempotency_table()
+            create_ledger_table()
+            yield nbp_stub
+    finally:
+        api_settings.nbp_api_url = original_nbp_url
+        api_settings.rate_store_path = original_rate_store_path
+        rate_store_dir.cleanup()
+        nbp_stub.stop()
+
+
+@contextmanager
+def serve(app, port: int = 0):
+    """
+    Runs the given ASGI app with uvicorn in a background thread
+    and yields its base url
+    """
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    bound_port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{bound_port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def auth_headers() -> dict:
+    """
+    Builds a bearer token for the default user without going through bcrypt
+    """
+    from services.auth_service import AuthService
+
+    token = AuthService.create_access_token(data={"sub": DEFAULT_USER_RECORD["user_id"]})
+    return {"Authorization": f"Bearer {token.access_token}"}
+
+
+def run_load(
+        base_url: str,
+        method: str,
+        path: Union[str, List[str]],
+        total: int,
+        concurrency: int,
+        before_request: Optional[Callable[[], None]] = None,
+        **request_kwargs,
+) -> dict:
+    """
+    Fires `total` requests at the given path with `concurrency` requests in flight
+    and returns throughput and latency percentiles. A list of paths is cycled
+    through, one path per request, and `before_request` is called before each.
+    """
+    return asyncio.run(run_load_async(base_url, method, path, total, concurrency, before_request, **request_kwargs))
+
+
+async def run_load_async(base_url, method, path, total, concurrency, before_request=None, **request_kwargs):
+    latencies = []
+    statuses = {}
+    paths = itertools.cycle([path] if isinstance(path, str) else path)
+    remaining = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker():
+            for _ in remaining:
+                if before_request is not None:
+                    before_request()
+                started = time.perf_counter()
+                response = await client.request(method, next(paths), **request_kwargs)
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return summarise(latencies, elapsed, statuses)
+
+
+async def measure_cpu_per_request(app, path: str, requests: int, headers: dict) -> float:
+    """
+    Sends `requests` GET requests one at a time to an ASGI app in process
+    and returns the CPU time spent per request, client side included
+    """
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        # Warm the caches along the request path
+        for _ in range(10):
+            response = await client.get(path, headers=headers)
+            assert response.status_code == 200
+
+        started = time.process_time()
+        for _ in range(requests):
+            await client.get(path, headers=headers)
+        return (time.process_time() - started) / requests
+
+
+def summarise(latencies: list, elapsed: float, statuses: dict = None) -> dict:
+    latencies = sorted(latencies)
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(quantiles[49] * 1000, 2),
+        "p95_ms": round(quantiles[94] * 1000, 2),
+        "p99_ms": round(quantiles[98] * 1000, 2),
+        "statuses": statuses or {},
+    }
+
+
+def print_results(title: str, results: dict):
+    print(title)
+    for name, result in results.items():
+        print(
+            f"  {name:<28} {result['throughput']:>9} req/s"
+            f"  p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms  p99 {result['p99_ms']:>8} ms"
+            f"  {result['statuses']}"
+        )
@@ -0,0 +1,170 @@
+"""
+Benchmark suite of the main request paths, for catching performance regressions
+before they reach production.
+
+Each scenario is sent over HTTP to the API served by uvicorn, against moto
+or DynamoDB Local and the stub NBP server, with `--concurrency` requests in
+flight. Throughput and p50/p95/p99 latencies are the median of `--rounds`
+rounds. Results can be written to a JSON baseline, and a later run can be
+compared against it, exiting with status 1 if any number is worse than the
+baseline by more than `--threshold`.
+
+    python -m benchmarks.suite --output baseline.json
+    python -m benchmarks.suite --compare baseline.json --threshold 0.2
+
+Baselines are only comparable between runs on the same machine, backend and
+options. To run against DynamoDB Local, start it with `docker compose up
+dynamodb-local` and pass `--dynamodb-endpoint http://localhost:8000`.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+from datetime import datetime, timezone
+from typing import Callable, List, NamedTuple, Optional
+
+from benchmarks.common import auth_headers, local_environment, print_results, run_load, serve
+
+LOGIN_FORM = {"username": "pjauvin", "password": "supermariobros", "grant_type": "password"}
+
+# Compared against the baseline, and whether a higher value is better
+COMPARED_METRICS = {"throughput": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+
+class Scenario(NamedTuple):
+    name: str
+    method: str
+    # Cycled through, one path per request
+    paths: List[str]
+    authenticated: bool = True
+    form: Optional[dict] = None
+    # Share of --requests sent in this scenario, logins are slow by design
+    request_share: float = 1.0
+    # Called before every request
+    before_request: Optional[Callable[[], None]] = None
+
+
+def clear_rate_caches():
+    from clients.exchange_rates.nbp_client import NBPExchangeRateClient, NBPTableExchangeRateClient
+    from services.wallet_service import WalletService
+
+    NBPExchangeRateClient._rate_cache.clear()
+    NBPTableExchangeRateClient._rate_cache.clear()
+    WalletService.converted_wallet_cache.clear()
+
+
+SCENARIOS = {
+    scenario.name: scenario for scenario in (
+        Scenario("wallet_cold_rates", "GET", ["/wallet"], before_request=clear_rate_caches),
+        Scenario("wallet_warm_rates", "GET", ["/wallet"]),
+        Scenario("wallet_original", "GET", ["/wallet/original"]),
+        Scenario("token", "POST", ["/token"], authenticated=False, form=LOGIN_FORM, request_share=0.05),
+        # Every request updates the same wallet item
+        Scenario("wallet_contention", "POST", ["/wallet/add/JPY/1", "/wallet/subtract/JPY/1"]),
+    )
+}
+
+
+def run_scenario(base_url: str, scenario: Scenario, total: int, concurrency: int, headers: dict) -> dict:
+    request_kwargs = {"data": scenario.form} if scenario.form else {}
+    if scenario.authenticated:
+        request_kwargs["headers"] = headers
+    return run_load(
+        base_url, scenario.method, scenario.paths, total, concurrency, scenario.before_request, **request_kwargs
+    )
+
+
+def run_suite(args) -> dict:
+    results = {}
+    with local_environment(dynamodb_endpoint=args.dynamodb_endpoint):
+        from main import app
+
+        headers = auth_headers()
+        with serve(app) as base_url:
+            for name in args.scenarios:
+                scenario = SCENARIOS[name]
+                total = max(args.concurrency, int(args.requests * scenario.request_share))
+                # Warms the connections and whatever the scenario doesn't clear itself
+                run_scenario(base_url, scenario, args.concurrency, args.concurrency, headers)
+                rounds = [run_scenario(base_url, scenario, total, args.concurrency, headers) for _ in range(args.rounds)]
+                results[name] = {
+                    **{metric: round(statistics.median(result[metric] for result in rounds), 2)
+                       for metric in COMPARED_METRICS},
+                    "requests": total,
+                    "statuses": {
+                        str(status_code): sum(result["statuses"].get(status_code, 0) for result in rounds)
+                        for status_code in sorted({code for result in rounds for code in result["statuses"]})
+                    },
+                }
+    return results
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> List[str]:
+    """
+    Prints each result next to the baseline and returns the regressions
+    """
+    regressions = []
+    for name, result in results.items():
+        baseline_result = baseline["scenarios"].get(name)
+        if baseline_result is None:
+            print(f"  {name:<20} not in the baseline")
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before, after = baseline_result[metric], result[metric]
+            change = (after - before) / before if before else 0.0
+            regressed = (-change if higher_is_better else change) > threshold
+            if regressed:
+                regressions.append(f"{name} {metric}")
+            print(
+                f"  {name:<20} {metric:<11} {before:>10} -> {after:>10} {change:>+8.1%}"
+                f"{'  REGRESSION' if regressed else ''}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=1000, help="requests per round of a scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--dynamodb-endpoint", help="e.g. http://localhost:8000 for DynamoDB Local, moto if unset")
+    parser.add_argument("--output", help="writes the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change reported as a regression")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = run_suite(args)
+
+    print_results(f"{args.rounds} rounds of up to {args.requests} requests, {args.concurrency} in flight", results)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "backend": args.dynamodb_endpoint or "moto",
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "rounds": args.rounds,
+                "scenarios": results,
+            }, output_file, indent=2)
+            output_file.write("\n")
+
+    if baseline is not None:
+        print(f"Compared with {args.compare} ({baseline['created_at']}), threshold {args.threshold:.0%}")
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,5 @@
-from clients.aws.dynamo import dynamo_client, dynamo_resource, wallets_table, users_table
-from clients.aws.secrets_manager import secrets_client
\ No newline at end of file
+from clients.aws.dynamo import (
+    dynamo_client, dynamo_resource, wallets_table, users_table, idempotency_table, ledger_table,
+    async_wallets_table, async_users_table, async_idempotency_table, async_ledger_table, transact_write_items
+)
+from clients.aws.secrets_manager import SecretProvider, secrets_client
@@ -1,8 +1,105 @@
+import asyncio
+import time
+
 import boto3
+from botocore.exceptions import ClientError
 
+import metrics
 from settings import api_settings
 
-dynamo_client = boto3.client("dynamodb")
-dynamo_resource = boto3.resource("dynamodb")
-wallets_table = dynamo_resource.Table(api_settings.wallets_table_name)
-users_table = dynamo_resource.Table(api_settings.users_table_name)
\ No newline at end of file
+from clients.aws.lazy import LazyClient
+
+
+class AsyncTable:
+    """
+    Thin awaitable facade over a boto3 DynamoDB table.
+
+    boto3 calls are blocking, so each one is handed to a worker thread
+    instead of running on the event loop. The handlers can then await
+    DynamoDB without stalling every other in-flight request. With metrics
+    enabled, each call's latency, errors and consumed capacity are recorded.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    @property
+    def name(self) -> str:
+        return self.table.name
+
+    async def get_item(self, **kwargs):
+        return await self._call("GetItem", self.table.get_item, **kwargs)
+
+    async def update_item(self, **kwargs):
+        return await self._call("UpdateItem", self.table.update_item, **kwargs)
+
+    async def put_item(self, **kwargs):
+        return await self._call("PutItem", self.table.put_item, **kwargs)
+
+    async def query(self, **kwargs):
+        return await self._call("Query", self.table.query, **kwargs)
+
+    async def scan(self, **kwargs):
+        return await self._call("Scan", self.table.scan, **kwargs)
+
+    async def batch_get_item(self, request: dict):
+        """
+        Runs BatchGetItem against this table only,
+        `request` holds the Keys and other per-table options
+        """
+        return await self._call(
+            "BatchGetItem", self.table.meta.client.batch_get_item, RequestItems={self.table.name: request}
+        )
+
+    async def _call(self, operation: str, method, **kwargs):
+        return await _instrumented_call(self.table.name, operation, method, **kwargs)
+
+
+async def _instrumented_call(table_name: str, operation: str, method, **kwargs):
+    """
+    Runs a boto3 call on a worker thread, recording its metrics on the event loop
+    """
+    if not api_settings.metrics_enabled:
+        return await asyncio.to_thread(method, **kwargs)
+
+    kwargs.setdefault("ReturnConsumedCapacity", "TOTAL")
+    started = time.perf_counter()
+    try:
+        response = await asyncio.to_thread(method, **kwargs)
+    except ClientError as error:
+        metrics.dynamodb_errors.inc(table_name, operation, error.response["Error"]["Code"])
+        raise
+    finally:
+        metrics.dynamodb_request_duration.observe(time.perf_counter() - started, table_name, operation)
+
+    metrics.record_consumed_capacity(operation, response.get("ConsumedCapacity"))
+    return response
+
+
+# Built on first use, see LazyClient
+dynamo_client = LazyClient(lambda: boto3.client("dynamodb"))
+dynamo_resource = LazyClient(lambda: boto3.resource("dynamodb"))
+wallets_table = LazyClient(lambda: dynamo_resource.Table(api_settings.wallets_table_name))
+users_table = LazyClient(lambda: dynamo_resource.Table(api_settings.users_table_name))
+idempotency_table = LazyClient(lambda: dynamo_resource.Table(api_settings.idempotency_table_name))
+ledger_table = LazyClient(lambda: dynamo_resource.Table(api_settings.ledger_table_name))
+
+async_wallets_table = AsyncTable(wallets_table)
+async_users_table = AsyncTable(users_table)
+async_idempotency_table = AsyncTable(idempotency_table)
+async_ledger_table = AsyncTable(ledger_table)
+
+
+async def transact_write_items(transact_items: list):
+    """
+    Runs TransactWriteItems, items are given as Python values
+    like with the table resources rather than as typed attributes
+    """
+    # Recorded under the joined names of the tables the transaction writes to
+    table_names = sorted({action["TableName"] for item in transact_items for action in item.values()})
+    return await _instrumented_call(
+        ",".join(table_names),
+        "TransactWriteItems",
+        dynamo_resource.meta.client.transact_write_items,
+        TransactItems=transact_items,
+    )
@@ -0,0 +1,37 @@
+import threading
+from typing import Any, Callable
+
+# Shared by every lazy client, building a boto3 client also sets up the default
+# session, which isn't thread-safe. Reentrant since a table is built from the resource.
+_build_lock = threading.RLock()
+
+
+class LazyClient:
+    """
+    Stands in for a boto3 client, resource or table that is only built on
+    first use and then kept for the life of the process.
+
+    Attribute access is forwarded to the built object, so importing a module
+    that defines clients doesn't need AWS credentials, a region or a network.
+    The first use may happen on a worker thread, so building is locked.
+    """
+
+    def __init__(self, build: Callable[[], Any]):
+        self._build = build
+        self._instance = None
+
+    @property
+    def is_built(self) -> bool:
+        return self._instance is not None
+
+    def get(self) -> Any:
+        instance = self._instance
+        if instance is None:
+            with _build_lock:
+                if self._instance is None:
+                    self._instance = self._build()
+                instance = self._instance
+        return instance
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
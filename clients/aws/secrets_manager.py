@@ -1,7 +1,16 @@
+import asyncio
+import logging
+import threading
+from typing import Optional
+
 import boto3
 
 from settings import api_settings
 
+from clients.aws.lazy import LazyClient
+
+logger = logging.getLogger(__name__)
+
 
 # Since there isn't a very good way of running
 # a standalone AWS secrets manager locally I've written a mock
@@ -20,14 +29,83 @@ class MockedSecretsManager:
         }
 
 
-if api_settings.environment == "LOCAL":
-    secrets_client = MockedSecretsManager()
-else:
-    secrets_client = boto3.client("secretsmanager")
+class SecretProvider:
+    """
+    Value of a secret, fetched from the secrets client on first use.
+
+    The client is blocking, so code running on the event loop should
+    `load` the secret once before relying on `get`, as the API does on
+    startup. With the refresher running, the secret is fetched again every
+    `refresh_interval` seconds on a worker thread, so a rotated secret is
+    picked up without a restart. If a refresh fails the current value is kept.
+    """
 
+    def __init__(self, client, secret_id: str, refresh_interval: float):
+        self.client = client
+        self.secret_id = secret_id
+        self.refresh_interval = refresh_interval
+        self._value: Optional[str] = None
+        self._lock = threading.Lock()
+        self._refresher: Optional[asyncio.Task] = None
 
+    def get(self) -> str:
+        """
+        Returns the current value, fetching it if it wasn't fetched yet
+        """
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._fetch()
+                value = self._value
+        return value
 
+    async def load(self) -> str:
+        """
+        Same as get, but a secret that wasn't fetched yet is fetched on a worker thread
+        """
+        value = self._value
+        if value is None:
+            value = await asyncio.to_thread(self.get)
+        return value
 
+    def refresh(self) -> str:
+        value = self._fetch()
+        with self._lock:
+            self._value = value
+        return value
 
+    def start_refresher(self):
+        """
+        Starts fetching the secret again every `refresh_interval` seconds,
+        must be called from a running event loop
+        """
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.get_running_loop().create_task(self._refresh_loop())
 
+    async def stop_refresher(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
 
+    def _fetch(self) -> str:
+        return self.client.get_secret_value(SecretId=self.secret_id)["SecretString"]
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as error:
+                logger.warning("Refreshing secret %s failed: %r", self.secret_id, error)
+
+
+if api_settings.environment == "LOCAL":
+    secrets_client = MockedSecretsManager()
+else:
+    # Built on first use, see LazyClient
+    secrets_client = LazyClient(lambda: boto3.client("secretsmanager"))
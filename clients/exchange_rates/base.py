@@ -1,5 +1,188 @@
+import asyncio
+import random
+from datetime import date
+from typing import Dict, Iterable, Optional
+
+import httpx
+from fastapi import HTTPException, status
+
+import metrics
+from settings import api_settings
+
+from clients.exchange_rates.http import CircuitBreaker, HTTPClientMetrics
+
+
 class BaseExchangeRateClient:
 
+    # A single keep-alive connection pool is shared by every exchange rate client
+    _http_client: Optional[httpx.AsyncClient] = None
+    _http_client_loop: Optional[asyncio.AbstractEventLoop] = None
+    _circuit_breaker = CircuitBreaker(
+        failure_threshold=api_settings.exchange_rate_circuit_failure_threshold,
+        reset_timeout=api_settings.exchange_rate_circuit_reset_timeout,
+    )
+    http_metrics = HTTPClientMetrics()
+
     @classmethod
-    def get_rate(cls, currency_code: str) -> float:
+    async def get_rate(cls, currency_code: str, as_of: Optional[date] = None) -> float:
+        """
+        Returns the current rate, or the rate in effect on
+        the `as_of` date for clients that keep rate history
+        """
         raise NotImplementedError
+
+    @classmethod
+    async def get_rates(cls, currency_codes: Iterable[str], as_of: Optional[date] = None) -> Dict[str, float]:
+        """
+        Returns the rates for several currencies at once.
+        Lookups run concurrently, clients that can fetch
+        many rates in one call should override this.
+        """
+        currency_codes = list(currency_codes)
+        rates = await asyncio.gather(*(cls.get_rate(currency_code, as_of) for currency_code in currency_codes))
+        return dict(zip(currency_codes, rates))
+
+    @classmethod
+    def rate_epoch(cls) -> Optional[int]:
+        """
+        Returns a number that changes whenever the client's cached rates change,
+        or None when rates aren't cached and results can't be reused.
+        It should be read before the rates that a result is computed from.
+        """
+        return None
+
+    @classmethod
+    def rate_epoch_scope(cls) -> Optional[str]:
+        """
+        Returns the name of the counter that rate_epoch comes from, the same
+        epoch in another scope may have been reached with different rates
+        """
+        return None
+
+    @classmethod
+    def start_refresher(cls):
+        """
+        Starts refreshing cached rates in the background,
+        clients without a cache have nothing to do
+        """
+
+    @classmethod
+    async def stop_refresher(cls):
+        pass
+
+    @classmethod
+    def get_http_client(cls) -> httpx.AsyncClient:
+        """
+        Returns the shared HTTP client, creating it on first use
+        """
+        client = BaseExchangeRateClient._http_client
+        loop = asyncio.get_running_loop()
+        # A pool belongs to the event loop it was created on,
+        # so a new loop (e.g. in tests) gets its own client
+        if client is None or client.is_closed or BaseExchangeRateClient._http_client_loop is not loop:
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    api_settings.exchange_rate_read_timeout,
+                    connect=api_settings.exchange_rate_connect_timeout,
+                ),
+                limits=httpx.Limits(
+                    max_connections=api_settings.exchange_rate_max_connections,
+                    max_keepalive_connections=api_settings.exchange_rate_max_connections,
+                ),
+            )
+            BaseExchangeRateClient._http_client = client
+            BaseExchangeRateClient._http_client_loop = loop
+        return client
+
+    @classmethod
+    async def close_http_client(cls):
+        client = BaseExchangeRateClient._http_client
+        BaseExchangeRateClient._http_client = None
+        if client is not None:
+            await client.aclose()
+
+    @classmethod
+    async def _fetch(cls, url: str, missing_ok: bool = False):
+        """
+        GETs a JSON document from an exchange rate API.
+
+        Transport errors and 5xx responses are retried with jittered backoff,
+        and once the API keeps failing the circuit breaker rejects calls
+        straight away. Any failure is reported as a 503, except a 404
+        which returns None if `missing_ok` is set.
+        """
+        if not cls._circuit_breaker.allow_request():
+            cls.http_metrics.circuit_rejections += 1
+            raise cls._unavailable()
+
+        response = None
+        with metrics.exchange_rate_request_duration.time():
+            for attempt in range(api_settings.exchange_rate_max_retries + 1):
+                if attempt:
+                    cls.http_metrics.retries += 1
+                    # Full jitter keeps workers from retrying in lockstep
+                    await asyncio.sleep(random.uniform(0, api_settings.exchange_rate_retry_backoff * 2 ** attempt))
+
+                cls.http_metrics.requests += 1
+                try:
+                    response = await cls.get_http_client().get(
+                        url, extensions={"trace": cls.http_metrics.trace}
+                    )
+                except httpx.TransportError:
+                    response = None
+                    continue
+
+                if response.status_code < 500:
+                    break
+
+        if response is None or response.status_code >= 500:
+            cls.http_metrics.failures += 1
+            cls._circuit_breaker.record_failure()
+            raise cls._unavailable()
+
+        # The API answered, even if it has no data for us
+        cls._circuit_breaker.record_success()
+
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code == 404 and missing_ok:
+            return None
+
+        raise cls._unavailable()
+
+    @staticmethod
+    def _unavailable() -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Could not retrieve exchange rate information",
+        )
+
+
+def _register_http_metrics():
+    """
+    Exposes the request, connection and error counts of the shared HTTP client
+    """
+    for counter, documentation in (
+            ("requests", "Requests sent to the exchange rate API, retries included"),
+            ("connections_opened", "TCP connections opened to the exchange rate API"),
+            ("retries", "Exchange rate API requests that were retries"),
+            ("failures", "Exchange rate lookups that failed after every retry"),
+            ("circuit_rejections", "Exchange rate lookups rejected by the open circuit breaker"),
+    ):
+        name = f"exchange_rate_upstream_{counter}_total"
+        metrics.registry.add_collector(
+            name,
+            "counter",
+            documentation,
+            # The client's counters are looked up at render time, tests swap them out
+            lambda name=name, counter=counter: [(name, {}, getattr(BaseExchangeRateClient.http_metrics, counter))],
+        )
+    metrics.registry.add_collector(
+        "exchange_rate_upstream_pool_hit_ratio",
+        "gauge",
+        "Share of exchange rate API requests sent over a pooled connection",
+        lambda: [("exchange_rate_upstream_pool_hit_ratio", {}, BaseExchangeRateClient.http_metrics.pool_hit_rate)],
+    )
+
+
+_register_http_metrics()
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import secrets
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _CacheEntry:
+
+    __slots__ = ("value", "fetched_at", "loader")
+
+    def __init__(self, value: Any, fetched_at: float, loader: Callable[[], Awaitable[Any]]):
+        self.value = value
+        self.fetched_at = fetched_at
+        self.loader = loader
+
+
+class BaseRateCache:
+    """
+    Async cache for exchange rate lookups, subclasses decide where the
+    entries are kept.
+
+    - Concurrent misses for the same key share a single upstream fetch.
+    - Once an entry is older than `ttl` it is still served for `stale_grace`
+      seconds while a background task refreshes it.
+    - The optional refresher task reloads entries `refresh_ahead` seconds
+      before they expire, so readers rarely see a miss at all.
+
+    `epoch` goes up whenever a cached value changes or is dropped, so anything
+    computed from cached rates can be tagged with the epoch it was computed at.
+    Reloading a value that hasn't changed keeps the epoch, so results computed
+    from it stay valid across refreshes. `scope` names the counter the epoch
+    comes from, equal epochs only mean equal rates within the same scope.
+    """
+
+    def __init__(
+            self,
+            ttl: float,
+            stale_grace: float = 0,
+            refresh_ahead: float = 0,
+            refresh_interval: float = 1,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.stale_grace = stale_grace
+        self.refresh_ahead = refresh_ahead
+        self.refresh_interval = refresh_interval
+        self._clock = clock
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._refresher: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        cached = self._cached(self._cache_key(key))
+        return cached is not None and self._clock() - cached[1] < self.ttl
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns the cached value for the key, calling the loader
+        only when no usable value is cached
+        """
+        key = self._cache_key(key)
+        cached = self._cached(key)
+
+        if cached is not None:
+            value, fetched_at = cached
+            age = self._clock() - fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return value
+            if age < self.ttl + self.stale_grace:
+                # Serve the stale value and let a single background task revalidate it
+                self.hits += 1
+                self._load_in_background(key, loader)
+                return value
+
+        self.misses += 1
+        # asyncio.shield keeps the shared fetch alive if one of its waiters is cancelled
+        return await asyncio.shield(self._load_in_background(key, loader))
+
+    def start_refresher(self):
+        """
+        Starts the task that reloads entries before they expire,
+        must be called from a running event loop
+        """
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.get_running_loop().create_task(self._refresh_loop())
+
+    async def stop_refresher(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+
+    @staticmethod
+    def _cache_key(key: Hashable) -> Hashable:
+        return key
+
+    def _cached(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        """
+        Returns the cached value of the key and the time it was fetched at
+        """
+        raise NotImplementedError
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], refresh: bool = False) -> Any:
+        """
+        Loads and caches the value of the key, `refresh` is set
+        when reloading a value that hasn't expired yet
+        """
+        raise NotImplementedError
+
+    def _due_for_refresh(self) -> List[Tuple[Hashable, Callable[[], Awaitable[Any]]]]:
+        """
+        Returns the keys, with their loaders, that the refresher should reload
+        """
+        raise NotImplementedError
+
+    def _load_in_background(
+            self,
+            key: Hashable,
+            loader: Callable[[], Awaitable[Any]],
+            refresh: bool = False,
+    ) -> asyncio.Task:
+        loop = asyncio.get_running_loop()
+        task = self._in_flight.get(key)
+
+        # A task started on another event loop can't be awaited from this one
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = loop.create_task(self._load_and_forget(key, loader, refresh))
+            task.add_done_callback(self._log_background_failure)
+            self._in_flight[key] = task
+
+        return task
+
+    async def _load_and_forget(self, key: Hashable, loader: Callable[[], Awaitable[Any]], refresh: bool) -> Any:
+        try:
+            return await self._load(key, loader, refresh)
+        finally:
+            if self._in_flight.get(key) is asyncio.current_task():
+                del self._in_flight[key]
+
+    @staticmethod
+    def _log_background_failure(task: asyncio.Task):
+        # Foreground callers get the exception themselves, logging it here
+        # keeps failed background refreshes from going unnoticed
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Exchange rate refresh failed: %r", task.exception())
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            for key, loader in self._due_for_refresh():
+                self._load_in_background(key, loader, refresh=True)
+
+
+class RateCache(BaseRateCache):
+    """
+    Rate cache of a single process, see BaseRateCache
+    """
+
+    def __init__(
+            self,
+            ttl: float,
+            stale_grace: float = 0,
+            refresh_ahead: float = 0,
+            refresh_interval: float = 1,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(ttl, stale_grace, refresh_ahead, refresh_interval, clock)
+        self._entries: Dict[Hashable, _CacheEntry] = {}
+        self.epoch = 0
+        # Epochs start over in every process
+        self.scope = secrets.token_hex(4)
+
+    def clear(self):
+        self._entries.clear()
+        self._in_flight.clear()
+        self.epoch += 1
+
+    def _cached(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry.value, entry.fetched_at
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], refresh: bool = False) -> Any:
+        value = await loader()
+        previous_entry = self._entries.get(key)
+        self._entries[key] = _CacheEntry(value, self._clock(), loader)
+        # A value cached for the first time can't have been used by an earlier result
+        if previous_entry is not None and previous_entry.value != value:
+            self.epoch += 1
+        return value
+
+    def _due_for_refresh(self) -> List[Tuple[Hashable, Callable[[], Awaitable[Any]]]]:
+        now = self._clock()
+        return [
+            (key, entry.loader)
+            for key, entry in list(self._entries.items())
+            if now - entry.fetched_at >= self.ttl - self.refresh_ahead
+        ]
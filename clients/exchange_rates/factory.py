@@ -1,7 +1,9 @@
 from typing import Type
 
+from settings import api_settings
+
 from clients.exchange_rates.base import BaseExchangeRateClient
-from clients.exchange_rates.nbp_client import NBPExchangeRateClient
+from clients.exchange_rates.nbp_client import NBPExchangeRateClient, NBPTableExchangeRateClient
 
 from models.wallet import LocalCurrency
 
@@ -15,6 +17,10 @@ class ExchangeRateClientFactory:
     @staticmethod
     def get_client(currency: LocalCurrency) -> Type[BaseExchangeRateClient]:
         if currency == LocalCurrency.PLN:
+            # Table mode loads every rate in one request,
+            # rates mode requests each currency separately
+            if api_settings.nbp_api_mode == "table":
+                return NBPTableExchangeRateClient
             return NBPExchangeRateClient
 
         raise ValueError(f"Currency {str(currency)} doesn't have an exchange rate client")
@@ -0,0 +1,69 @@
+import time
+from typing import Callable
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls are rejected. Every `reset_timeout` seconds a single trial call
+    is let through, a success closes the circuit again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow_request(self) -> bool:
+        if self._opened_at is None:
+            return True
+        if self._clock() - self._opened_at < self.reset_timeout:
+            return False
+        # Let this call through as a trial and keep rejecting the others
+        self._opened_at = self._clock()
+        return True
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self._failures >= self.failure_threshold:
+            self._opened_at = self._clock()
+
+
+class HTTPClientMetrics:
+    """
+    Counters for the shared HTTP client. Connection reuse is
+    measured from httpcore trace events, every request that
+    didn't open a TCP connection was served from the pool.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.connections_opened = 0
+        self.retries = 0
+        self.failures = 0
+        self.circuit_rejections = 0
+
+    @property
+    def pool_hit_rate(self) -> float:
+        if not self.requests:
+            return 0.0
+        return max(self.requests - self.connections_opened, 0) / self.requests
+
+    def reset(self):
+        self.__init__()
+
+    async def trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
@@ -1,39 +1,282 @@
-import requests
-from cachetools import cached, TTLCache
-from fastapi import HTTPException, status
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Union
 
+import metrics
 from settings import api_settings
 
 from clients.exchange_rates.base import BaseExchangeRateClient
+from clients.exchange_rates.cache import RateCache
+from clients.exchange_rates.rate_store import RateStore, StoredRate
+from clients.exchange_rates.shared_cache import SharedRateCache
 
 from models.wallet import Currency
 
+logger = logging.getLogger(__name__)
 
-CONVERSION_URL = f"{api_settings.nbp_api_url}/{api_settings.nbp_api_conversion_endpoint}"
+
+def get_conversion_url(currency_code: str) -> str:
+    return f"{api_settings.nbp_api_url}/{api_settings.nbp_api_conversion_endpoint}" % currency_code.lower()
+
+
+def get_table_url() -> str:
+    return f"{api_settings.nbp_api_url}/{api_settings.nbp_api_table_endpoint}"
+
+
+def get_table_range_url(start: date, end: date) -> str:
+    return f"{api_settings.nbp_api_url}/{api_settings.nbp_api_table_range_endpoint}" % (
+        start.isoformat(), end.isoformat()
+    )
+
+
+def today() -> date:
+    # A new table C is published on Warsaw mornings, by then the UTC date has changed too
+    return datetime.now(timezone.utc).date()
+
+
+def build_rate_cache(name: str) -> Union[RateCache, SharedRateCache]:
+    """
+    Builds a client's rate cache, shared by the worker processes on
+    the host if a shared cache directory is configured
+    """
+    if api_settings.shared_rate_cache_dir:
+        return SharedRateCache(
+            path=os.path.join(api_settings.shared_rate_cache_dir, f"{name}.cache"),
+            ttl=api_settings.cache_ttl,
+            stale_grace=api_settings.cache_stale_grace,
+            refresh_ahead=api_settings.cache_refresh_ahead,
+        )
+    return RateCache(
+        ttl=api_settings.cache_ttl,
+        stale_grace=api_settings.cache_stale_grace,
+        refresh_ahead=api_settings.cache_refresh_ahead,
+    )
 
 
 class NBPExchangeRateClient(BaseExchangeRateClient):
 
-    # The function has a cache mechanism to prevent spamming the NBP API, the result
-    # will be cached for as long as defined by the cache ttl value.
-    # By default, we set this setting to 5 minutes.
+    # Rates are cached to prevent spamming the NBP API, a result
+    # will be kept for as long as defined by the cache ttl value.
+    # Concurrent misses share one request and expired rates are
+    # revalidated in the background, see RateCache.
+    _rate_cache = build_rate_cache("nbp_rates")
+    # Tables fetched from NBP are kept in a local store shared by both NBP clients.
+    # The store only saves NBP requests, current rates are still fetched if it fails.
+    _rate_store: Optional[RateStore] = None
+    _rate_store_lock = threading.Lock()
+
     @classmethod
-    @cached(cache=TTLCache(maxsize=10, ttl=api_settings.cache_ttl))
-    def get_rate(cls, currency_code: str) -> float:
+    async def get_rate(cls, currency_code: str, as_of: Optional[date] = None) -> float:
         """
-        Returns the rate of PLN to given currency.
+        Returns the rate of PLN to given currency,
+        as it was on the `as_of` date if one is given.
         """
         # Check that we're passing in a valid currency
-        Currency(currency_code)
+        currency = Currency(currency_code)
+        if as_of is not None and as_of < today():
+            rates = await cls._get_historical_rates([currency], as_of)
+            return rates[currency]
+        return await cls._rate_cache.get(currency, lambda: cls._load_rate(currency))
 
-        formatted_conversion_url = CONVERSION_URL % currency_code.lower()
-        nbp_api_response = requests.get(formatted_conversion_url)
+    @classmethod
+    async def get_rates(cls, currency_codes: Iterable[str], as_of: Optional[date] = None) -> Dict[str, float]:
+        if as_of is not None and as_of < today():
+            return await cls._get_historical_rates([Currency(currency_code) for currency_code in currency_codes], as_of)
+        return await super().get_rates(currency_codes)
 
-        if nbp_api_response.status_code == 200:
-            return nbp_api_response.json()["rates"][0]["ask"]
+    @classmethod
+    def get_rate_store(cls) -> RateStore:
+        """
+        Returns the local rate store, opening it on first use. Opening
+        the file blocks, so it is called on a worker thread.
+        """
+        with NBPExchangeRateClient._rate_store_lock:
+            store = NBPExchangeRateClient._rate_store
+            if store is None or store.path != api_settings.rate_store_path:
+                if store is not None:
+                    store.close()
+                    NBPExchangeRateClient._rate_store = None
+                store = NBPExchangeRateClient._rate_store = RateStore(api_settings.rate_store_path)
+            return store
 
-        # TODO: maybe this should go to the parent class ?
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Could not retrieve exchange rate information",
-        )
+    @classmethod
+    async def backfill(cls, start: date, end: date) -> int:
+        """
+        Fetches the tables published between the two dates (inclusive) that
+        aren't stored yet, using NBP's date range endpoint, and returns the
+        number of rates stored. Days before today are then marked as covered,
+        today's table may not have been published yet.
+        """
+        store = await asyncio.to_thread(cls.get_rate_store)
+        missing_days = await asyncio.to_thread(store.missing_days, start, min(end, today()))
+        if not missing_days:
+            return 0
+
+        stored = 0
+        chunk_start = missing_days[0]
+        while chunk_start <= missing_days[-1]:
+            chunk_end = min(chunk_start + timedelta(days=api_settings.nbp_api_max_range_days - 1), missing_days[-1])
+            # NBP answers with a 404 when no table was published in the range
+            tables = await cls._fetch(get_table_range_url(chunk_start, chunk_end), missing_ok=True) or []
+            rates = [rate for table in tables for rate in cls._parse_table(table)]
+
+            await asyncio.to_thread(store.add_rates, rates)
+            covered_end = min(chunk_end, today() - timedelta(days=1))
+            if covered_end >= chunk_start:
+                await asyncio.to_thread(store.mark_covered, chunk_start, covered_end)
+
+            stored += len(rates)
+            chunk_start = chunk_end + timedelta(days=1)
+
+        return stored
+
+    @classmethod
+    def rate_epoch(cls) -> int:
+        return cls._rate_cache.epoch
+
+    @classmethod
+    def rate_epoch_scope(cls) -> str:
+        return cls._rate_cache.scope
+
+    @classmethod
+    def start_refresher(cls):
+        cls._rate_cache.start_refresher()
+
+    @classmethod
+    async def stop_refresher(cls):
+        await cls._rate_cache.stop_refresher()
+
+    @classmethod
+    async def _get_historical_rates(cls, currencies: List[Currency], as_of: date) -> Dict[Currency, float]:
+        """
+        Returns the rates from the latest table published on or before
+        the date, backfilling the days leading up to it if needed
+        """
+        earliest = as_of - timedelta(days=api_settings.rate_store_lookback_days)
+        try:
+            await cls.backfill(earliest, as_of)
+            store = await asyncio.to_thread(cls.get_rate_store)
+            stored_rates = await asyncio.to_thread(store.get_rates, [currency.value for currency in currencies], as_of)
+        except (OSError, sqlite3.Error) as error:
+            # Historical rates are only answered from the store
+            logger.warning("Reading historical rates from the rate store failed: %r", error)
+            raise cls._unavailable()
+
+        rates = {}
+        for currency in currencies:
+            stored_rate = stored_rates.get(currency.value)
+            if stored_rate is None or stored_rate.effective_date < earliest:
+                # No table lists the currency in the days before the date
+                raise cls._unavailable()
+            rates[currency] = stored_rate.ask
+        return rates
+
+    @classmethod
+    async def _get_stored_current_rates(cls, currencies: List[Currency]) -> Optional[Dict[Currency, float]]:
+        """
+        Returns the rates from today's table if it was already stored,
+        tables don't change once published so they can be reused after a restart.
+        Returns None if they aren't stored or the store can't be read.
+        """
+        current_date = today()
+        try:
+            store = await asyncio.to_thread(cls.get_rate_store)
+            stored_rates = await asyncio.to_thread(
+                store.get_rates, [currency.value for currency in currencies], current_date
+            )
+        except (OSError, sqlite3.Error) as error:
+            logger.warning("Reading the rate store failed, fetching rates from NBP: %r", error)
+            return None
+
+        if any(currency.value not in stored_rates or stored_rates[currency.value].effective_date != current_date
+               for currency in currencies):
+            return None
+        return {currency: stored_rates[currency.value].ask for currency in currencies}
+
+    @classmethod
+    async def _store_rates(cls, rates: List[StoredRate]):
+        try:
+            store = await asyncio.to_thread(cls.get_rate_store)
+            await asyncio.to_thread(store.add_rates, rates)
+        except (OSError, sqlite3.Error) as error:
+            # The fetched rates are still served, only a restart will fetch them again
+            logger.warning("Storing rates failed: %r", error)
+
+    @staticmethod
+    def _parse_table(table: dict) -> List[StoredRate]:
+        effective_date = date.fromisoformat(table["effectiveDate"])
+        return [StoredRate(effective_date, rate["code"], rate["bid"], rate["ask"]) for rate in table["rates"]]
+
+    @classmethod
+    async def _load_rate(cls, currency: Currency) -> float:
+        stored_rates = await cls._get_stored_current_rates([currency])
+        if stored_rates is not None:
+            return stored_rates[currency]
+
+        nbp_api_response = await cls._fetch(get_conversion_url(currency.value))
+        rate = nbp_api_response["rates"][0]
+        await cls._store_rates([
+            StoredRate(date.fromisoformat(rate["effectiveDate"]), currency.value, rate["bid"], rate["ask"])
+        ])
+        return rate["ask"]
+
+
+class NBPTableExchangeRateClient(NBPExchangeRateClient):
+    """
+    Reads the whole NBP table C in a single request
+    and caches the rate of every supported currency from it.
+    """
+
+    # The whole table is cached as a single entry
+    TABLE_KEY = "C"
+    _rate_cache = build_rate_cache("nbp_table_c")
+
+    @classmethod
+    async def get_rate(cls, currency_code: str, as_of: Optional[date] = None) -> float:
+        """
+        Returns the rate of PLN to given currency,
+        as it was on the `as_of` date if one is given.
+        """
+        rates = await cls.get_rates([currency_code], as_of)
+        return rates[currency_code]
+
+    @classmethod
+    async def get_rates(cls, currency_codes: Iterable[str], as_of: Optional[date] = None) -> Dict[str, float]:
+        currencies = [Currency(currency_code) for currency_code in currency_codes]
+        if as_of is not None and as_of < today():
+            return await cls._get_historical_rates(currencies, as_of)
+
+        table = await cls._rate_cache.get(cls.TABLE_KEY, cls._load_table)
+
+        try:
+            return {currency: table[currency] for currency in currencies}
+        except KeyError:
+            # The table was fetched but doesn't list one of our currencies
+            raise cls._unavailable()
+
+    @classmethod
+    async def _load_table(cls) -> Dict[Currency, float]:
+        """
+        Fetches table C and returns the rate of every supported currency
+        """
+        stored_rates = await cls._get_stored_current_rates(list(Currency))
+        if stored_rates is not None:
+            return stored_rates
+
+        nbp_api_response = await cls._fetch(get_table_url())
+        await cls._store_rates(cls._parse_table(nbp_api_response[0]))
+        supported_codes = {currency.value for currency in Currency}
+
+        return {
+            Currency(rate["code"]): rate["ask"]
+            for rate in nbp_api_response[0]["rates"]
+            if rate["code"] in supported_codes
+        }
+
+
+metrics.registry.add_cache("nbp_rates", lambda: NBPExchangeRateClient._rate_cache)
+metrics.registry.add_cache("nbp_table_c", lambda: NBPTableExchangeRateClient._rate_cache)
@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import threading
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+
+class StoredRate(NamedTuple):
+    effective_date: date
+    currency: str
+    bid: float
+    ask: float
+
+
+class RateStore:
+    """
+    Local SQLite store of exchange rate tables, one (date, currency, bid, ask)
+    row per currency and publication day.
+
+    NBP doesn't publish tables on weekends and holidays, so the rate as of a
+    date is the one from the latest table published on or before it. Days
+    that were backfilled are recorded as covered, which tells a day without
+    a table apart from a day that was never fetched.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Used from worker threads, writes are serialised by the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS rates (
+                    effective_date TEXT NOT NULL,
+                    currency TEXT NOT NULL,
+                    bid REAL NOT NULL,
+                    ask REAL NOT NULL,
+                    PRIMARY KEY (effective_date, currency)
+                );
+                -- Serves "latest rate on or before a date" lookups for one currency
+                CREATE INDEX IF NOT EXISTS rates_by_currency ON rates (currency, effective_date);
+                CREATE TABLE IF NOT EXISTS covered_days (
+                    day TEXT PRIMARY KEY
+                );
+            """)
+
+    def add_rates(self, rates: Iterable[StoredRate]):
+        rows = [(rate.effective_date.isoformat(), rate.currency, rate.bid, rate.ask) for rate in rates]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO rates VALUES (?, ?, ?, ?)", rows)
+
+    def mark_covered(self, start: date, end: date):
+        """
+        Records that every table published between the two dates (inclusive) is stored
+        """
+        days = [(day.isoformat(),) for day in _days_between(start, end)]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR IGNORE INTO covered_days VALUES (?)", days)
+
+    def missing_days(self, start: date, end: date) -> List[date]:
+        with self._lock:
+            covered = {
+                row[0] for row in self._connection.execute(
+                    "SELECT day FROM covered_days WHERE day BETWEEN ? AND ?", (start.isoformat(), end.isoformat())
+                )
+            }
+        return [day for day in _days_between(start, end) if day.isoformat() not in covered]
+
+    def get_rate(self, currency: str, as_of: date) -> Optional[StoredRate]:
+        """
+        Returns the latest rate of the currency published on or before the date
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT effective_date, currency, bid, ask FROM rates"
+                " WHERE currency = ? AND effective_date <= ? ORDER BY effective_date DESC LIMIT 1",
+                (currency, as_of.isoformat()),
+            ).fetchone()
+        return _to_stored_rate(row) if row else None
+
+    def get_rates(self, currencies: Iterable[str], as_of: date) -> Dict[str, StoredRate]:
+        """
+        Returns the rates found for the given currencies, currencies without a rate are left out
+        """
+        rates = {}
+        for currency in currencies:
+            rate = self.get_rate(currency, as_of)
+            if rate is not None:
+                rates[currency] = rate
+        return rates
+
+    def close(self):
+        self._connection.close()
+
+
+def _days_between(start: date, end: date) -> List[date]:
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+def _to_stored_rate(row: tuple) -> StoredRate:
+    return StoredRate(date.fromisoformat(row[0]), row[1], row[2], row[3])
@@ -0,0 +1,338 @@
+import asyncio
+import fcntl
+import json
+import mmap
+import os
+import secrets
+import struct
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from clients.exchange_rates.cache import BaseRateCache
+
+# Sequence number and length of the encoded entries, followed by the entries themselves
+_HEADER = struct.Struct("<QI")
+# Reads that keep overlapping with writes give up after this many attempts
+_READ_ATTEMPTS = 1000
+# Seconds between checks of an entry whose load was claimed by another worker
+_CLAIM_POLL_INTERVAL = 0.01
+
+
+class _Document(NamedTuple):
+    entries: Dict[str, dict]
+    epoch: int
+    # Names the counter of the epoch, None before the first write
+    scope: Optional[str]
+
+
+class SharedRateCache(BaseRateCache):
+    """
+    Exchange rate cache shared by every worker process on a host.
+
+    Entries live in a memory-mapped file, so a lookup is a read from shared
+    memory rather than a call to another process. Writes are guarded by a
+    seqlock: the sequence number is odd while a write is in progress, and a
+    reader retries until it reads the same even number before and after
+    copying the entries. Writers take an exclusive lock on a lock file first.
+
+    One worker is elected refresher by holding a second lock and reloads
+    entries `refresh_ahead` seconds before they expire. If it exits the
+    lock is released and another worker takes over. A worker that finds an
+    entry missing or past its stale grace claims its load under the write
+    lock, unless another worker loaded or claimed it in the meantime, and
+    publishes the value once loaded. The lock isn't held while loading, a
+    worker that finds the load claimed waits for the value to be published,
+    or for the claim to expire after `load_timeout` seconds if the loading
+    worker died. The upstream API sees one request per host for each expiry.
+
+    Values must be JSON serializable. The interface matches RateCache, the
+    `epoch` and its `scope` are kept in the shared file so that all workers
+    agree on them. The scope is picked by the first write to the file, and
+    picked again if a writer died and left the file unreadable.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            ttl: float,
+            stale_grace: float = 0,
+            refresh_ahead: float = 0,
+            refresh_interval: float = 1,
+            load_timeout: float = 30,
+            size: int = 64 * 1024,
+            clock: Callable[[], float] = time.time,
+    ):
+        # Wall clock time, the entries are read by several processes
+        super().__init__(ttl, stale_grace, refresh_ahead, refresh_interval, clock)
+        self.path = path
+        self.load_timeout = load_timeout
+        self.size = size
+        self._loaders: Dict[str, Callable[[], Awaitable[Any]]] = {}
+        self._election_file = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._file = None
+        # Sequence number and document of the last decoded write, the document is only
+        # decoded again once the sequence number changes. Kept in one tuple as the
+        # write lock is taken on worker threads, which decode the document too.
+        self._decoded: Tuple[Optional[int], _Document] = (None, _Document({}, 0, None))
+
+    @property
+    def epoch(self) -> int:
+        return self._read_document().epoch
+
+    @property
+    def scope(self) -> Optional[str]:
+        # None until the first write
+        return self._read_document().scope
+
+    @property
+    def is_refresher(self) -> bool:
+        return self._election_file is not None
+
+    def clear(self):
+        """
+        Removes every entry, for all processes sharing the cache
+        """
+        self._open()
+        with self._write_lock():
+            document = self._locked_document()
+            self._write({}, document.epoch + 1, document.scope)
+        self._in_flight.clear()
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns the shared value for the key, calling the loader only
+        when no worker on the host has a usable value cached
+        """
+        # Kept for the refresher, this worker may be elected after the value was loaded
+        self._loaders[self._cache_key(key)] = loader
+        return await super().get(key, loader)
+
+    async def stop_refresher(self):
+        await super().stop_refresher()
+
+        if self._election_file is not None:
+            # Closing the file releases the lock, letting another worker take over
+            self._election_file.close()
+            self._election_file = None
+
+    @staticmethod
+    def _cache_key(key: Hashable) -> str:
+        # Enum keys are stored by value so that every process reads the same key
+        return str(getattr(key, "value", key))
+
+    def _cached(self, shared_key: str) -> Optional[Tuple[Any, float]]:
+        entry = self._read().get(shared_key)
+        # An entry without a value has only been claimed by a loading worker
+        if entry is None or "value" not in entry:
+            return None
+        return entry["value"], entry["fetched_at"]
+
+    def _open(self):
+        if self._mmap is not None:
+            return
+
+        self._file = open(self.path, "a+b")
+        # Growing the file to the same size is harmless if several workers race here
+        if os.fstat(self._file.fileno()).st_size < self.size:
+            self._file.truncate(self.size)
+        self._mmap = mmap.mmap(self._file.fileno(), self.size)
+
+    def _write_lock(self) -> "_FileLock":
+        return _FileLock(f"{self.path}.lock")
+
+    def _read(self) -> Dict[str, dict]:
+        return self._read_document().entries
+
+    def _read_document(self) -> "_Document":
+        self._open()
+        for _ in range(_READ_ATTEMPTS):
+            sequence, length = _HEADER.unpack_from(self._mmap, 0)
+            if sequence % 2:
+                # A write is in progress
+                time.sleep(0)
+                continue
+            decoded_sequence, decoded_document = self._decoded
+            if sequence == decoded_sequence:
+                return decoded_document
+            if not length:
+                # Nothing was written yet
+                return _Document({}, 0, None)
+
+            encoded_document = self._mmap[_HEADER.size:_HEADER.size + length]
+            if _HEADER.unpack_from(self._mmap, 0)[0] != sequence:
+                continue
+
+            document = _Document(**json.loads(encoded_document))
+            self._decoded = (sequence, document)
+            return document
+
+        # A writer that died mid-write leaves the sequence odd until
+        # the next write, until then every entry is treated as missing
+        return self._decoded[1]._replace(entries={})
+
+    def _locked_document(self) -> "_Document":
+        """
+        Returns the shared document to be replaced, the caller must hold the
+        write lock. The epoch starts over in a new scope on the first write,
+        or if a writer died mid-write and the previous document is lost.
+        """
+        self._open()
+        sequence, length = _HEADER.unpack_from(self._mmap, 0)
+        if sequence % 2 or not length:
+            return _Document({}, 0, secrets.token_hex(4))
+        return self._read_document()
+
+    def _write(self, entries: Dict[str, dict], epoch: int, scope: str):
+        """
+        Replaces the shared document, the caller must hold the write lock
+        """
+        encoded_document = json.dumps(_Document(entries, epoch, scope)._asdict()).encode()
+        if _HEADER.size + len(encoded_document) > self.size:
+            raise ValueError("Shared rate cache entries don't fit in the shared memory size")
+
+        sequence = _HEADER.unpack_from(self._mmap, 0)[0]
+        # Already odd if a writer died mid-write
+        if sequence % 2 == 0:
+            sequence += 1
+        _HEADER.pack_into(self._mmap, 0, sequence, 0)
+        self._mmap[_HEADER.size:_HEADER.size + len(encoded_document)] = encoded_document
+        _HEADER.pack_into(self._mmap, 0, sequence + 1, len(encoded_document))
+
+    async def _load(self, shared_key: str, loader: Callable[[], Awaitable[Any]], refresh: bool = False) -> Any:
+        while True:
+            # Waiting for the lock blocks, so it is done on a worker thread
+            claimed, entry = await asyncio.to_thread(self._claim, shared_key, refresh)
+            if entry is not None:
+                return entry["value"]
+            if claimed:
+                break
+            await self._wait_for_load(shared_key)
+
+        try:
+            value = await loader()
+        except Exception:
+            # Lets the next worker load the value without waiting for the claim to expire
+            await asyncio.to_thread(self._release_claim, shared_key)
+            raise
+
+        await asyncio.to_thread(self._publish, shared_key, value)
+        return value
+
+    def _claim(self, shared_key: str, refresh: bool) -> Tuple[bool, Optional[dict]]:
+        """
+        Returns the entry if another worker has loaded a usable value
+        meanwhile. Otherwise claims the load of the entry, unless another
+        worker is loading it, and returns whether it was claimed.
+        """
+        with self._write_lock():
+            document = self._locked_document()
+            entry = document.entries.get(shared_key)
+            if entry is None:
+                entry = {}
+
+            now = self._clock()
+            if "value" in entry and now - entry["fetched_at"] < self.ttl - (self.refresh_ahead if refresh else 0):
+                return False, entry
+            if entry.get("loading_until", 0) > now:
+                return False, None
+
+            entries = {**document.entries, shared_key: {**entry, "loading_until": now + self.load_timeout}}
+            self._write(entries, document.epoch, document.scope)
+            return True, None
+
+    async def _wait_for_load(self, shared_key: str):
+        """
+        Waits until the worker that claimed the load of the entry
+        publishes it, gives up or lets the claim expire
+        """
+        while True:
+            await asyncio.sleep(_CLAIM_POLL_INTERVAL)
+            entry = self._read().get(shared_key)
+            if entry is None or entry.get("loading_until", 0) <= self._clock():
+                return
+
+    def _publish(self, shared_key: str, value: Any):
+        with self._write_lock():
+            document = self._locked_document()
+            epoch = document.epoch
+            previous_entry = document.entries.get(shared_key, {})
+            # Compared as read back from the file, e.g. with tuples turned into lists
+            if "value" in previous_entry and previous_entry["value"] != json.loads(json.dumps(value)):
+                epoch += 1
+            entries = {**document.entries, shared_key: {"value": value, "fetched_at": self._clock()}}
+            self._write(entries, epoch, document.scope)
+
+    def _release_claim(self, shared_key: str):
+        with self._write_lock():
+            document = self._locked_document()
+            entry = document.entries.get(shared_key)
+            if entry is None or "loading_until" not in entry:
+                return
+
+            entry = {name: field for name, field in entry.items() if name != "loading_until"}
+            if entry:
+                entries = {**document.entries, shared_key: entry}
+            else:
+                entries = {key: other_entry for key, other_entry in document.entries.items() if key != shared_key}
+            self._write(entries, document.epoch, document.scope)
+
+    def _try_become_refresher(self) -> bool:
+        if self._election_file is not None:
+            return True
+
+        election_file = open(f"{self.path}.refresher", "a+b")
+        try:
+            fcntl.flock(election_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            election_file.close()
+            return False
+
+        self._election_file = election_file
+        return True
+
+    def _due_for_refresh(self) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+        if not self._try_become_refresher():
+            return []
+
+        due = []
+        entries = self._read()
+        now = self._clock()
+        for shared_key, loader in list(self._loaders.items()):
+            entry = entries.get(shared_key)
+            if entry is None or "value" not in entry or now - entry["fetched_at"] >= self.ttl - self.refresh_ahead:
+                due.append((shared_key, loader))
+        return due
+
+
+class _FileLock:
+    """
+    Exclusive flock on a lock file, usable as a context manager. The file is
+    opened on every acquire, flocks taken through separate opens exclude each
+    other within a process as well as across processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        lock_file = open(self.path, "a+b")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            lock_file.close()
+            raise
+        self._file = lock_file
+
+    def release(self):
+        # Closing the file releases the lock
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,32 @@
+import argparse
+import asyncio
+import sys
+
+from settings import api_settings
+
+from services.ledger_service import LedgerService
+
+
+# Compaction job for the wallet ledger, meant to run periodically, for example:
+#   python compact_ledger.py --interval 100
+# Wallets with enough new ledger entries get a snapshot, which keeps
+# historical balance queries from reading more than a bounded number of entries.
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot wallets with enough new ledger entries")
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=api_settings.ledger_snapshot_interval,
+        help="entries since the latest snapshot after which a wallet gets a new one",
+    )
+    parser.add_argument("--concurrency", type=int, default=16, help="wallets compacted at once")
+    args = parser.parse_args()
+
+    api_settings.ledger_snapshot_interval = args.interval
+    snapshots = asyncio.run(LedgerService.compact(args.concurrency))
+    print(f"Wrote {snapshots} snapshots", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import argparse
+import sys
+
+from services.export_service import WalletExporter
+
+
+# Exports every wallet for analytics or reconciliation, for example:
+#   python export_wallets.py --format csv --convert --output wallets.csv --checkpoint wallets.checkpoint
+# Running the same command again after an interruption resumes the export.
+
+def report_progress(stats):
+    print(f"{stats.rows} rows, {stats.rows_per_second:,.0f} rows/s", file=sys.stderr, end="\r")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export every wallet as NDJSON or CSV")
+    parser.add_argument("--format", choices=WalletExporter.FORMATS, default="ndjson")
+    parser.add_argument("--segments", type=int, default=4, help="number of parallel scan segments")
+    parser.add_argument("--convert", action="store_true", help="convert balances to local currency")
+    parser.add_argument("--output", help="output file, defaults to stdout")
+    parser.add_argument("--checkpoint", help="file used to save and resume progress")
+    args = parser.parse_args()
+
+    exporter = WalletExporter(
+        output_format=args.format,
+        total_segments=args.segments,
+        convert=args.convert,
+        checkpoint_path=args.checkpoint,
+        on_progress=report_progress,
+    )
+
+    if args.output:
+        with open(args.output, "a" if exporter.is_resuming else "w", newline="") as output:
+            stats = exporter.export(output)
+    else:
+        stats = exporter.export(sys.stdout)
+
+    print(f"\nExported {stats.rows} rows in {stats.elapsed:.2f}s ({stats.rows_per_second:,.0f} rows/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
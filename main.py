@@ -1,69 +1,285 @@
-from typing import Annotated
+import hashlib
+import json
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Annotated, Optional, Tuple
 
 from botocore.exceptions import ClientError
+from pydantic import BaseModel
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 
+import metrics
+from settings import api_settings
+
+from clients.exchange_rates import ExchangeRateClientFactory
+from clients.exchange_rates.base import BaseExchangeRateClient
+
 from models.auth import Token
 from models.util import NonNegativeDecimal
-from models.wallet import ClientWallet, CommonWalletData, Currency
+from models.wallet import (
+    ClientWallet, CommonWalletData, Currency, LocalCurrency, WalletBatchUpdate, WalletBulkRequest
+)
 
+from services.admission_control import AdmissionControlMiddleware
+from services.idempotency import IdempotencyKeyReused, IdempotencyRecord
 from services.wallet_service import WalletService
-from services.auth_service import AuthService
+from services.auth_service import AuthService, jwt_secret
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep exchange rates warm so requests don't wait on the NBP API when they expire
+    exchange_rate_clients = [ExchangeRateClientFactory.get_client(currency) for currency in LocalCurrency]
+    for exchange_rate_client in exchange_rate_clients:
+        exchange_rate_client.start_refresher()
+    # The signing key is fetched before serving requests, so no request blocks the event loop on it
+    await jwt_secret.load()
+    jwt_secret.start_refresher()
+    yield
+    await jwt_secret.stop_refresher()
+    for exchange_rate_client in exchange_rate_clients:
+        await exchange_rate_client.stop_refresher()
+    await BaseExchangeRateClient.close_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(AdmissionControlMiddleware)
+# Added last so it wraps admission control and counts rejected requests too
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Lets clients retry a wallet mutation without applying it twice
+IdempotencyKey = Annotated[Optional[str], Header(alias="Idempotency-Key", min_length=1, max_length=255)]
+# Lets polling clients skip downloading a wallet that hasn't changed
+IfNoneMatch = Annotated[Optional[str], Header(alias="If-None-Match")]
+
+
+class ModelResponse(Response):
+    """
+    JSON response for a model that was already validated, written straight
+    to bytes by pydantic-core. FastAPI passes a returned Response through as
+    is, so the model isn't validated a second time against the route's
+    response_model, which still documents the schema.
+    """
+    media_type = "application/json"
+
+    def render(self, content: BaseModel) -> bytes:
+        with metrics.stage_duration.time("serialization"):
+            return content.__pydantic_serializer__.to_json(content)
+
+
+def replay(response: Response, record: Optional[IdempotencyRecord]):
+    """
+    Answers a retried request with the response stored for its idempotency key
+    """
+    if record is not None:
+        response.status_code = record.status_code
+        response.headers["Idempotent-Replayed"] = "true"
 
-app = FastAPI()
 
+def wallet_etag(user_id: str, version: int, rate_version: Optional[Tuple[str, int]] = None) -> str:
+    """
+    Returns the ETag of a wallet read, made from the wallet version and, for
+    converted wallets, the scope and epoch of the rates. Epochs are counted per
+    process, or per host with the shared rate cache, the scope keeps the same
+    epoch of another counter from matching. The user id is hashed in, so a
+    client that switches users never gets a 304 for another user's wallet.
+    """
+    user_tag = hashlib.blake2b(user_id.encode(), digest_size=6).hexdigest()
+    if rate_version is None:
+        return f'"{user_tag}-{version}"'
+    rate_epoch_scope, rate_epoch = rate_version
+    return f'"{user_tag}-{version}-{rate_epoch_scope}.{rate_epoch}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Weak comparison of an If-None-Match header with the current ETag
+    """
+    if if_none_match is None:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in (candidate.removeprefix("W/") for candidate in candidates)
+
+
+async def conditional_wallet_response(user_id: str, if_none_match: Optional[str], convert: bool) -> Response:
+    """
+    Answers a wallet read with the wallet and its ETag, or with a 304 if the
+    client already has the current one. The version index is checked first,
+    so an unchanged wallet is usually answered without reading DynamoDB.
+    """
+    if if_none_match is not None:
+        indexed_version = await WalletService.get_indexed_version(user_id, convert)
+        if indexed_version is not None:
+            etag = wallet_etag(user_id, *indexed_version)
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    if convert:
+        versioned_wallet = await WalletService.get_versioned_local_currency_wallet(user_id)
+        if versioned_wallet.rate_version is None:
+            # Without cached rates there is no telling when the conversion changes
+            return ModelResponse(versioned_wallet.wallet)
+    else:
+        versioned_wallet = await WalletService.get_versioned_original_wallet(user_id)
+
+    etag = wallet_etag(user_id, versioned_wallet.version, versioned_wallet.rate_version)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return ModelResponse(versioned_wallet.wallet, headers={"ETag": etag})
 
-@app.get("/wallet/original")
-async def get_original_wallet(user_id: Annotated[str, Depends(AuthService.get_user_id)]) -> CommonWalletData:
+
+def idempotency_key_reused() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail="Idempotency key was already used for a different request",
+    )
+
+
+@app.get("/wallet/original", response_model=CommonWalletData)
+async def get_original_wallet(
+        user_id: Annotated[str, Depends(AuthService.get_user_id)],
+        if_none_match: IfNoneMatch = None,
+) -> Response:
     """
     Returns an object containing wallet balances
     without conversions to local currency
     """
-    data = WalletService.get_original_wallet(user_id)
-    return data
+    return await conditional_wallet_response(user_id, if_none_match, convert=False)
 
 
-@app.get("/wallet")
-async def get_wallet(user_id: Annotated[str, Depends(AuthService.get_user_id)]) -> ClientWallet:
+@app.get("/wallet", response_model=ClientWallet)
+async def get_wallet(
+        user_id: Annotated[str, Depends(AuthService.get_user_id)],
+        if_none_match: IfNoneMatch = None,
+) -> Response:
     """
     Returns an object containing wallet balances
     converted to local currency, as well as the sum of all balances
     """
-    data = WalletService.get_local_currency_wallet(user_id)
-    return data
+    return await conditional_wallet_response(user_id, if_none_match, convert=True)
+
+
+@app.get("/wallet/history", response_model=CommonWalletData)
+async def get_wallet_history(
+        at: datetime,
+        user_id: Annotated[str, Depends(AuthService.get_user_id)]
+) -> ModelResponse:
+    """
+    Returns an object containing wallet balances as they were at
+    the given time, without conversions to local currency
+    """
+    # Without the ledger there is no history, only the current balances
+    if not api_settings.wallet_ledger_enabled:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Wallet history is not enabled",
+        )
+    data = await WalletService.get_historical_wallet(user_id, at)
+    if data is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Wallet history not found for the given time",
+        )
+    return ModelResponse(data)
 
 
 @app.post("/wallet/add/{currency_code}/{balance}")
 async def add_balance_to_wallet(
         currency_code: Currency,
         balance: NonNegativeDecimal,
-        user_id: Annotated[str, Depends(AuthService.get_user_id)]
+        user_id: Annotated[str, Depends(AuthService.get_user_id)],
+        response: Response,
+        idempotency_key: IdempotencyKey = None,
 ):
     """
     Adds a given quantity of a currency to the wallet
     """
-    WalletService.add_to_wallet(user_id, currency_code, balance)
+    try:
+        replayed_record = await WalletService.add_to_wallet(user_id, currency_code, balance, idempotency_key)
+    except IdempotencyKeyReused:
+        raise idempotency_key_reused()
+    replay(response, replayed_record)
 
 
 @app.post("/wallet/subtract/{currency_code}/{balance}")
 async def subtract_balance_from_wallet(
         currency_code: Currency,
         balance: NonNegativeDecimal,
-        user_id: Annotated[str, Depends(AuthService.get_user_id)]
+        user_id: Annotated[str, Depends(AuthService.get_user_id)],
+        response: Response,
+        idempotency_key: IdempotencyKey = None,
 ):
     """
     Removes a given quantity of a currency from the wallet
     """
     try:
-        WalletService.subtract_from_wallet(user_id, currency_code, balance)
+        replayed_record = await WalletService.subtract_from_wallet(user_id, currency_code, balance, idempotency_key)
+    except IdempotencyKeyReused:
+        raise idempotency_key_reused()
+    except ClientError as error:
+        if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Can't subtract more than balance",
+            )
+        raise
+    replay(response, replayed_record)
+
+
+@app.post("/wallet/batch")
+async def update_wallet_batch(
+        batch_update: WalletBatchUpdate,
+        user_id: Annotated[str, Depends(AuthService.get_user_id)],
+        response: Response,
+        idempotency_key: IdempotencyKey = None,
+):
+    """
+    Applies several signed balance changes to the wallet at once,
+    either all of them are applied or none of them is
+    """
+    try:
+        replayed_record = await WalletService.apply_balance_changes(user_id, batch_update.changes, idempotency_key)
+    except IdempotencyKeyReused:
+        raise idempotency_key_reused()
     except ClientError as error:
         if error.response["Error"]["Code"] == "ConditionalCheckFailedException":
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Can't subtract more than balance",
             )
+        raise
+    replay(response, replayed_record)
+
+
+@app.post("/admin/wallets")
+async def get_wallets_bulk(
+        bulk_request: WalletBulkRequest,
+        admin_user_id: Annotated[str, Depends(AuthService.get_admin_user_id)],
+        convert: bool = False,
+) -> StreamingResponse:
+    """
+    Streams the wallets of the given users as NDJSON, one
+    {"user_id": ..., "wallet": ...} object per line. The wallet is null
+    for users without one, and converted to local currency if `convert` is set.
+    """
+    async def wallet_lines():
+        async for user_id, wallet in WalletService.get_wallets(bulk_request.user_ids, convert):
+            # The wallet is serialized by pydantic-core and spliced in, rather than dumped to a dict first
+            encoded_wallet = wallet.model_dump_json() if wallet is not None else "null"
+            yield f'{{"user_id": {json.dumps(user_id)}, "wallet": {encoded_wallet}}}\n'
+
+    return StreamingResponse(wallet_lines(), media_type="application/x-ndjson")
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    """
+    Returns the metrics of this process in the Prometheus text format
+    """
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.post("/token")
@@ -72,7 +288,7 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
     Ingests a username/password combo and returns a token
     if the user information is valid
     """
-    user = AuthService.authenticate_user(form_data.username, form_data.password)
+    user = await AuthService.authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,322 @@
+import bisect
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from settings import api_settings
+
+# Seconds, from a cached lookup to a slow upstream call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (name, labels, value) of a sample produced by a collector
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class _Metric:
+
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def _labels(self, label_values: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, label_values))
+
+
+class Counter(_Metric):
+    """
+    Value that only goes up, one per combination of label values
+    """
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        if api_settings.metrics_enabled:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def samples(self) -> List[Sample]:
+        return [(self.name, self._labels(label_values), value) for label_values, value in self._values.items()]
+
+    def clear(self):
+        self._values.clear()
+
+
+class _HistogramValues:
+
+    __slots__ = ("bucket_counts", "sum", "count")
+
+    def __init__(self, bucket_count: int):
+        # Observations per bucket, made cumulative when rendered
+        self.bucket_counts = [0] * bucket_count
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values in fixed buckets, plus their sum and count
+    """
+
+    metric_type = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Iterable[str] = (),
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[tuple, _HistogramValues] = {}
+
+    def observe(self, value: float, *label_values: str):
+        if not api_settings.metrics_enabled:
+            return
+        values = self._values.get(label_values)
+        if values is None:
+            # The last bucket is +Inf
+            values = self._values[label_values] = _HistogramValues(len(self.buckets) + 1)
+        values.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        values.sum += value
+        values.count += 1
+
+    def time(self, *label_values: str) -> "_Timer":
+        """
+        Context manager observing how long its block took
+        """
+        return _Timer(self, label_values)
+
+    def count(self, *label_values: str) -> int:
+        values = self._values.get(label_values)
+        return values.count if values is not None else 0
+
+    def samples(self) -> List[Sample]:
+        samples = []
+        for label_values, values in self._values.items():
+            labels = self._labels(label_values)
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip((*self.buckets, float("inf")), values.bucket_counts):
+                cumulative_count += bucket_count
+                samples.append((f"{self.name}_bucket", {**labels, "le": _format_value(upper_bound)}, cumulative_count))
+            samples.append((f"{self.name}_sum", labels, values.sum))
+            samples.append((f"{self.name}_count", labels, values.count))
+        return samples
+
+    def clear(self):
+        self._values.clear()
+
+
+class _Timer:
+
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class MetricsRegistry:
+    """
+    Metrics of this process, rendered in the Prometheus text format.
+
+    Counters and histograms are updated as things happen. Values that other
+    components already count, such as cache hits, are read at scrape time
+    from collectors instead, so they cost nothing on the request path.
+
+    Updates aren't locked, they are made from the event loop thread.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Tuple[str, str, str, Callable[[], Iterable[Sample]]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Iterable[str] = (),
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, name: str, metric_type: str, documentation: str, collect: Callable[[], Iterable[Sample]]):
+        """
+        Registers a metric whose samples are produced by `collect` when the metrics are rendered
+        """
+        self._collectors.append((name, metric_type, documentation, collect))
+
+    def add_cache(self, cache_name: str, get_cache: Callable[[], object]):
+        """
+        Exposes the hits, misses and hit ratio of a cache with `hits` and `misses`
+        counters, `get_cache` returns the cache in use when the metrics are rendered
+        """
+        labels = {"cache": cache_name}
+        self.add_collector("cache_hits_total", "counter", "Cache lookups served from the cache",
+                           lambda: [("cache_hits_total", labels, get_cache().hits)])
+        self.add_collector("cache_misses_total", "counter", "Cache lookups that missed",
+                           lambda: [("cache_misses_total", labels, get_cache().misses)])
+        self.add_collector("cache_hit_ratio", "gauge", "Share of cache lookups served from the cache",
+                           lambda: [("cache_hit_ratio", labels, _hit_ratio(get_cache()))])
+
+    def render(self) -> str:
+        families: Dict[str, Tuple[str, str, List[Sample]]] = {}
+        for metric in self._metrics.values():
+            families[metric.name] = (metric.metric_type, metric.documentation, metric.samples())
+        # Collectors of the same metric name, e.g. one per cache, share one family
+        for name, metric_type, documentation, collect in self._collectors:
+            families.setdefault(name, (metric_type, documentation, []))[2].extend(collect())
+
+        lines = []
+        for name, (metric_type, documentation, samples) in families.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        """
+        Resets every counter and histogram, collectors keep their own counts
+        """
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def _register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+
+def _hit_ratio(cache) -> float:
+    lookups = cache.hits + cache.misses
+    return cache.hits / lookups if lookups else 0.0
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+def _escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+registry = MetricsRegistry()
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests handled, by route and status code", ("method", "route", "status")
+)
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time spent handling HTTP requests", ("method", "route")
+)
+# Where a request spends its time: jwt_decode, wallet_read, exchange_rates, conversion, serialization
+stage_duration = registry.histogram(
+    "request_stage_duration_seconds", "Time spent in each stage of serving a request", ("stage",)
+)
+dynamodb_request_duration = registry.histogram(
+    "dynamodb_request_duration_seconds", "Time spent waiting for DynamoDB calls", ("table", "operation")
+)
+dynamodb_consumed_capacity = registry.counter(
+    "dynamodb_consumed_capacity_units_total", "Capacity units consumed by DynamoDB calls", ("table", "operation")
+)
+dynamodb_errors = registry.counter(
+    "dynamodb_errors_total", "DynamoDB calls that failed, by error code", ("table", "operation", "code")
+)
+exchange_rate_request_duration = registry.histogram(
+    "exchange_rate_request_duration_seconds", "Time spent on exchange rate API requests, retries included"
+)
+
+
+class StatusRecordingSend:
+    """
+    ASGI send callable that passes messages on to `send` and keeps the status
+    code of the response, 500 if the app fails before starting a response
+    """
+
+    __slots__ = ("send", "status_code")
+
+    def __init__(self, send):
+        self.send = send
+        self.status_code = 500
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.status_code = message["status"]
+        await self.send(message)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting and timing HTTP requests. Requests are labelled
+    with the path template of the route they matched, so values in the path
+    don't create a new series each.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not api_settings.metrics_enabled:
+            await self.app(scope, receive, send)
+            return
+
+        send_with_status = StatusRecordingSend(send)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the scope
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            http_request_duration.observe(time.perf_counter() - started, scope["method"], route_path)
+            http_requests.inc(scope["method"], route_path, str(send_with_status.status_code))
+
+
+def record_consumed_capacity(operation: str, consumed_capacity: Optional[object]):
+    """
+    Adds the ConsumedCapacity of a DynamoDB response, which is a list
+    for operations that can touch several tables
+    """
+    if consumed_capacity is None:
+        return
+    if isinstance(consumed_capacity, dict):
+        consumed_capacity = [consumed_capacity]
+    for table_capacity in consumed_capacity:
+        dynamodb_consumed_capacity.inc(
+            table_capacity["TableName"], operation, amount=float(table_capacity.get("CapacityUnits", 0))
+        )
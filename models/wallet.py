@@ -1,6 +1,7 @@
-from typing import Dict
+from decimal import Decimal
+from typing import Dict, List
 
-from pydantic import BaseModel, NonNegativeFloat, PositiveFloat, UUID4
+from pydantic import BaseModel, Field, NonNegativeFloat, PositiveFloat, UUID4, field_validator
 
 from enum import Enum
 
@@ -39,5 +40,25 @@ class ClientWallet(CommonWalletData):
     total: PositiveFloat
 
 
+class BalanceChange(BaseModel):
+    """
+    A signed change to one currency holding,
+    positive amounts add and negative amounts subtract
+    """
+    currency: Currency
+    amount: Decimal
+
+    @field_validator("amount")
+    @classmethod
+    def amount_not_zero(cls, amount: Decimal) -> Decimal:
+        if amount == 0:
+            raise ValueError("amount should not be zero")
+        return amount
+
+
+class WalletBatchUpdate(BaseModel):
+    changes: List[BalanceChange] = Field(min_length=1, max_length=100)
 
 
+class WalletBulkRequest(BaseModel):
+    user_ids: List[str] = Field(min_length=1, max_length=100000)
@@ -1,11 +1,15 @@
 import uvicorn
 
-from test.fixtures.create_database_resources import create_users_table, create_wallets_table
+from test.fixtures.create_database_resources import (
+    create_idempotency_table, create_ledger_table, create_users_table, create_wallets_table
+)
 from test.fixtures.util import set_fake_aws_credentials
 
 set_fake_aws_credentials()
 create_users_table()
 create_wallets_table()
+create_idempotency_table()
+create_ledger_table()
 
 if __name__ == "__main__":
         from main import app
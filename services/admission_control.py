@@ -0,0 +1,267 @@
+import math
+import time
+from enum import IntEnum
+from typing import Dict, Optional, Tuple
+
+from cachetools import LRUCache
+from fastapi import HTTPException, status
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+import metrics
+from settings import api_settings
+
+from services.auth_service import AuthService
+
+
+class Priority(IntEnum):
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+
+# Share of the adaptive concurrency limit each priority may use. Lower
+# priorities are shed first, which keeps headroom for cheap wallet reads.
+PRIORITY_SHARES = {
+    Priority.HIGH: 1.0,
+    Priority.NORMAL: 0.85,
+    Priority.LOW: 0.6,
+}
+
+# Routes not listed here are NORMAL
+ROUTE_PRIORITIES = {
+    "GET /wallet/original": Priority.HIGH,
+    "POST /token": Priority.LOW,
+    "POST /admin/wallets": Priority.LOW,
+}
+
+# Latency of these routes doesn't say much about load, logins are slow
+# by design and exports stream, so they don't steer the adaptive limit
+UNSAMPLED_ROUTES = {"POST /token", "POST /admin/wallets"}
+
+# Never limited, so the API can still be observed while it sheds load
+EXEMPT_ROUTES = {"GET /metrics"}
+
+# Status code and detail of the response for each reason a request is rejected
+REJECTIONS: Dict[str, Tuple[int, str]] = {
+    "user_rate_limit": (status.HTTP_429_TOO_MANY_REQUESTS, "Too many requests, please retry later"),
+    "route_limit": (status.HTTP_503_SERVICE_UNAVAILABLE, "Server is busy, please retry later"),
+    "overload": (status.HTTP_503_SERVICE_UNAVAILABLE, "Server is busy, please retry later"),
+}
+
+
+class TokenBuckets:
+    """
+    Token bucket per key, refilled at `rate` tokens per second up to `burst`.
+
+    Only the most recently used `maxsize` buckets are kept, a key whose
+    bucket was evicted starts again with a full one.
+    """
+
+    def __init__(self, rate: float, burst: int, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        # key -> (tokens, last refill)
+        self._buckets = LRUCache(maxsize=maxsize)
+
+    def take(self, key: str) -> float:
+        """
+        Takes a token from the key's bucket, returns 0 if there was one
+        or else the seconds until the bucket has a token again
+        """
+        now = time.monotonic()
+        tokens, refilled_at = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - refilled_at) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        return 0
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Concurrency limit adjusted with AIMD from the latency of finished requests.
+
+    While requests finish within `target_latency` and the limit is being used,
+    it grows by about one per round of requests. A slower request, or one that
+    failed with a server error, cuts it by `backoff`, at most once per
+    `target_latency` so that one burst of slow requests counts once.
+    """
+
+    def __init__(
+            self,
+            initial_limit: int,
+            min_limit: int,
+            max_limit: int,
+            target_latency: float,
+            backoff: float = 0.9,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self._decreased_at = 0.0
+
+    def try_acquire(self, share: float = 1.0) -> bool:
+        if self.in_flight >= max(1.0, self.limit * share):
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, latency: Optional[float], overloaded: bool = False):
+        """
+        Frees a slot, `latency` is None for requests that shouldn't adjust the limit
+        """
+        self.in_flight -= 1
+        if latency is None:
+            return
+
+        if overloaded or latency > self.target_latency:
+            now = time.monotonic()
+            if now - self._decreased_at >= self.target_latency:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._decreased_at = now
+        elif self.in_flight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class AdmissionController:
+    """
+    Decides which requests are served and which are rejected straight away.
+
+    A request is rejected with a 429 once its user runs out of tokens, and
+    with a 503 once its route is at its own concurrency limit or its priority
+    has used up its share of the adaptive limit. Rejections are immediate, so
+    overload shows up as fast errors rather than as latency for everyone.
+    """
+
+    def __init__(self):
+        self.user_buckets = TokenBuckets(
+            rate=api_settings.user_rate_limit,
+            burst=api_settings.user_rate_limit_burst,
+            maxsize=api_settings.user_rate_limit_size,
+        )
+        self.limit = AdaptiveConcurrencyLimit(
+            initial_limit=api_settings.admission_initial_limit,
+            min_limit=api_settings.admission_min_limit,
+            max_limit=api_settings.admission_max_limit,
+            target_latency=api_settings.admission_target_latency,
+        )
+        self.route_limits: Dict[str, int] = dict(api_settings.admission_route_limits)
+        self.route_in_flight: Dict[str, int] = {}
+
+    def try_acquire(self, route_key: str) -> Optional[str]:
+        """
+        Takes a slot for a request to the route,
+        returns the reason if there is none
+        """
+        route_limit = self.route_limits.get(route_key)
+        if route_limit is not None and self.route_in_flight.get(route_key, 0) >= route_limit:
+            return "route_limit"
+        if not self.limit.try_acquire(PRIORITY_SHARES[ROUTE_PRIORITIES.get(route_key, Priority.NORMAL)]):
+            return "overload"
+        self.route_in_flight[route_key] = self.route_in_flight.get(route_key, 0) + 1
+        return None
+
+    def release(self, route_key: str, latency: float, status_code: int):
+        self.route_in_flight[route_key] -= 1
+        self.limit.release(
+            None if route_key in UNSAMPLED_ROUTES else latency,
+            overloaded=status_code >= 500,
+        )
+
+
+admission_controller = AdmissionController()
+
+admission_rejections = metrics.registry.counter(
+    "admission_rejections_total", "Requests rejected by admission control, by reason", ("route", "reason")
+)
+metrics.registry.add_collector(
+    "admission_concurrency_limit", "gauge", "Current adaptive concurrency limit",
+    lambda: [("admission_concurrency_limit", {}, admission_controller.limit.limit)],
+)
+metrics.registry.add_collector(
+    "admission_in_flight_requests", "gauge", "Requests currently holding an admission slot",
+    lambda: [("admission_in_flight_requests", {}, admission_controller.limit.in_flight)],
+)
+
+
+class AdmissionControlMiddleware:
+    """
+    ASGI middleware applying the AdmissionController before requests are routed.
+
+    Requests with a valid bearer token are rate limited per user id, as
+    resolved by AuthService.get_user_id, whose verified token cache makes
+    the route's own lookup a cache hit. Requests without one, such as logins,
+    are only subject to the route and adaptive limits.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not api_settings.admission_control_enabled:
+            await self.app(scope, receive, send)
+            return
+
+        route_key = self._match_route(scope)
+        if route_key in EXEMPT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        controller = admission_controller
+        user_id = await self._get_user_id(scope)
+        if user_id is not None:
+            retry_after = controller.user_buckets.take(user_id)
+            if retry_after:
+                await self._reject(scope, receive, send, route_key, "user_rate_limit", retry_after)
+                return
+
+        reason = controller.try_acquire(route_key)
+        if reason is not None:
+            await self._reject(scope, receive, send, route_key, reason, retry_after=1)
+            return
+
+        send_with_status = metrics.StatusRecordingSend(send)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            controller.release(route_key, time.perf_counter() - started, send_with_status.status_code)
+
+    @staticmethod
+    def _match_route(scope) -> str:
+        """
+        Returns "METHOD /path/template" of the route the request will be routed to
+        """
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                # Lets the metrics label rejected requests with their route too
+                scope["route"] = route
+                return f"{scope['method']} {route.path}"
+        return f"{scope['method']} unmatched"
+
+    @staticmethod
+    async def _get_user_id(scope) -> Optional[str]:
+        scheme, _, token = Headers(scope=scope).get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            return None
+        try:
+            return await AuthService.get_user_id(token)
+        except HTTPException:
+            # The route rejects the request itself
+            return None
+
+    @staticmethod
+    async def _reject(scope, receive, send, route_key: str, reason: str, retry_after: float):
+        admission_rejections.inc(route_key, reason)
+        status_code, detail = REJECTIONS[reason]
+        response = JSONResponse(
+            {"detail": detail}, status_code=status_code, headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+        await response(scope, receive, send)
@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta, timezone
-from typing import Annotated
+from typing import Annotated, Optional
 
 import jwt
 from fastapi import Depends, HTTPException, status
@@ -7,47 +7,94 @@ from fastapi.security import OAuth2PasswordBearer
 from jwt.exceptions import InvalidTokenError
 from passlib.context import CryptContext
 
+import metrics
 from settings import api_settings
 
-from clients.aws import secrets_client, users_table
+from clients.aws import SecretProvider, secrets_client, async_users_table
 
 from models.auth import UserData, Token
 
+from services.token_cache import VerifiedTokenCache
+from services.user_cache import MISSING, UserRecordCache
+from services.worker_pool import BoundedWorkerPool
 
-SECRET_KEY = secrets_client.get_secret_value(api_settings.jwt_secret_key_name)["SecretString"]
+
+# Fetched when the API starts rather than at import, and refreshed in the
+# background while it runs. Cached tokens are dropped once the key changes.
+jwt_secret = SecretProvider(
+    secrets_client, api_settings.jwt_secret_key_name, refresh_interval=api_settings.jwt_secret_refresh_interval
+)
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hash of a random password nobody knows, with the same cost as real hashes. Logins
+# with an unknown username are checked against it, so they take as long as the others.
+DUMMY_PASSWORD_HASH = "$2b$12$uKvRGxML3eizE3MKliqokOKQISKvp6t06mWHmrAro8syhoc9YJZAW"
+# bcrypt is deliberately slow, so it runs on a small dedicated pool
+# instead of the event loop that serves every other request
+password_hashing_pool = BoundedWorkerPool(
+    max_workers=api_settings.password_hashing_workers,
+    max_queue=api_settings.password_hashing_queue_size,
+    name="password-hashing",
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# Clients reuse their token until it expires, so repeated
+# requests skip decoding and validating it again
+verified_token_cache = VerifiedTokenCache(maxsize=api_settings.verified_token_cache_size)
+user_cache = UserRecordCache(
+    maxsize=api_settings.user_cache_size,
+    ttl=api_settings.user_cache_ttl,
+    negative_ttl=api_settings.user_cache_negative_ttl,
+)
 
 
 class AuthService:
 
     @staticmethod
-    def get_user_data(username: str) -> UserData:
-        data = users_table.get_item(
+    async def get_user_data(username: str) -> Optional[UserData]:
+        """
+        Returns the user's record, or None if the username doesn't exist
+        """
+        cached = user_cache.get(username)
+        if cached is not None:
+            return None if cached is MISSING else cached
+
+        data = await async_users_table.get_item(
             Key={
                 "username": username
             },
         )
 
-        return UserData(**data["Item"])
+        user = UserData(**data["Item"]) if "Item" in data else None
+        user_cache.set(username, user)
+        return user
 
     @staticmethod
-    def _verify_password(plain_password, hashed_password):
-        return pwd_context.verify(plain_password, hashed_password)
+    async def save_user(user: UserData):
+        """
+        Creates or replaces a user record, logins through
+        this process see the new record right away
+        """
+        user_cache.invalidate(user.username)
+        await async_users_table.put_item(Item=user.model_dump())
+        user_cache.set(user.username, user)
 
     @staticmethod
-    def _get_password_hash(password):
-        return pwd_context.hash(password)
+    async def _verify_password(plain_password, hashed_password):
+        return await password_hashing_pool.run(pwd_context.verify, plain_password, hashed_password)
 
     @staticmethod
-    def authenticate_user(username: str, password: str):
-        user = AuthService.get_user_data(username)
+    async def _get_password_hash(password):
+        return await password_hashing_pool.run(pwd_context.hash, password)
+
+    @staticmethod
+    async def authenticate_user(username: str, password: str):
+        user = await AuthService.get_user_data(username)
         if not user:
+            await AuthService._verify_password(password, DUMMY_PASSWORD_HASH)
             return False
-        if not AuthService._verify_password(password, user.hashed_password):
+        if not await AuthService._verify_password(password, user.hashed_password):
             return False
         return user
 
@@ -60,26 +107,47 @@ class AuthService:
         else:
             expire = datetime.now(timezone.utc) + timedelta(minutes=15)
         to_encode.update({"exp": expire})
-        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+        encoded_jwt = jwt.encode(to_encode, jwt_secret.get(), algorithm=ALGORITHM)
         return Token(access_token=encoded_jwt, token_type="bearer")
 
 
     @staticmethod
     async def get_user_id(token: Annotated[str, Depends(oauth2_scheme)]) -> str:
-        credentials_exception = HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id is None:
+        with metrics.stage_duration.time("jwt_decode"):
+            secret_key = await jwt_secret.load()
+            user_id = verified_token_cache.get(token, secret_key)
+            if user_id is not None:
+                return user_id
+
+            credentials_exception = HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Could not validate credentials",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+            try:
+                payload = jwt.decode(token, secret_key, algorithms=[ALGORITHM])
+                user_id = payload.get("sub")
+                if user_id is None:
+                    raise credentials_exception
+                if "exp" in payload:
+                    verified_token_cache.set(token, secret_key, user_id, payload["exp"])
+                return user_id
+            except InvalidTokenError:
                 raise credentials_exception
-            return user_id
-        except InvalidTokenError:
-            raise credentials_exception
-
-
-
 
+    @staticmethod
+    async def get_admin_user_id(token: Annotated[str, Depends(oauth2_scheme)]) -> str:
+        """
+        Same as get_user_id, but only lets back-office users through
+        """
+        user_id = await AuthService.get_user_id(token)
+        if user_id not in api_settings.admin_user_ids:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Not enough permissions",
+            )
+        return user_id
+
+
+metrics.registry.add_cache("verified_token", lambda: verified_token_cache)
+metrics.registry.add_cache("user_record", lambda: user_cache)
@@ -0,0 +1,99 @@
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, Iterable, List, Mapping, Tuple, Union
+
+# Converted amounts are expressed in minor units of the local currency (grosze for PLN)
+MINOR_UNIT_DIGITS = 2
+_MINOR_UNIT_SCALE = 10 ** MINOR_UNIT_DIGITS
+
+Number = Union[Decimal, float, int]
+# Converted balances per currency and their total, in minor units
+ConvertedBalances = Tuple[Dict[str, int], int]
+
+
+@lru_cache(maxsize=1024)
+def _float_ratio(value: float) -> Tuple[int, int]:
+    # Rates arrive as floats parsed from JSON, the shortest repr of the
+    # float gives back the decimal that was published, e.g. 4.3148
+    return Decimal(repr(value)).as_integer_ratio()
+
+
+def to_ratio(value: Number) -> Tuple[int, int]:
+    """
+    Exact (numerator, denominator) of a balance or rate, floats are read as the decimal they were written as
+    """
+    if isinstance(value, float):
+        return _float_ratio(value)
+    return value.as_integer_ratio()
+
+
+class ConversionEngine:
+    """
+    Converts balances into local currency using exact integer arithmetic.
+
+    Balances (Decimal from DynamoDB) and rates (decimals published by NBP) are
+    turned into exact integer fractions once, so no float ever enters the
+    calculation. Rounding is defined as follows:
+
+    - Each converted balance is the exact product balance * rate, rounded to
+      MINOR_UNIT_DIGITS decimals with round half to even.
+    - The total is the sum of the rounded balances, which is exact in minor
+      units, so the balances shown to a user always add up to the total.
+
+    `convert_many` converts a batch of wallets in one call, for bulk
+    reads and exports.
+    """
+
+    def __init__(self, exchange_rates: Mapping[str, Number]):
+        # Each rate is kept as its currency code, numerator * 10^MINOR_UNIT_DIGITS and denominator.
+        # Enum currencies hash like their value, so balances keyed either way find their rate
+        self._rates: Dict[str, Tuple[str, int, int]] = {}
+        for currency, rate in exchange_rates.items():
+            currency = str(getattr(currency, "value", currency))
+            numerator, denominator = to_ratio(rate)
+            self._rates[currency] = (currency, numerator * _MINOR_UNIT_SCALE, denominator)
+
+    def convert(self, balances: Mapping[str, Number]) -> ConvertedBalances:
+        """
+        Converts one wallet's balances, returning minor units per currency and their total
+        """
+        return self.convert_many((balances,))[0]
+
+    def convert_many(self, wallets: Iterable[Mapping[str, Number]]) -> List[ConvertedBalances]:
+        """
+        Converts many wallets with the same rates, raises KeyError
+        for a currency that has no rate
+        """
+        rates = self._rates
+        converted_wallets = []
+
+        # to_ratio and the division rounding half to even are inlined,
+        # this loop runs once per balance in bulk conversions
+        for balances in wallets:
+            converted_balances = {}
+            total = 0
+            for currency, balance in balances.items():
+                currency, rate_numerator, rate_denominator = rates[currency]
+                if isinstance(balance, float):
+                    balance_numerator, balance_denominator = _float_ratio(balance)
+                else:
+                    balance_numerator, balance_denominator = balance.as_integer_ratio()
+
+                denominator = balance_denominator * rate_denominator
+                converted_balance, remainder = divmod(balance_numerator * rate_numerator, denominator)
+                doubled_remainder = 2 * remainder
+                if doubled_remainder > denominator or (doubled_remainder == denominator and converted_balance % 2):
+                    converted_balance += 1
+
+                converted_balances[currency] = converted_balance
+                total += converted_balance
+            converted_wallets.append((converted_balances, total))
+
+        return converted_wallets
+
+    @staticmethod
+    def to_major_units(minor_units: int) -> float:
+        """
+        Nearest float to an amount in minor units, which prints as the exact decimal
+        """
+        return minor_units / _MINOR_UNIT_SCALE
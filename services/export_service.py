@@ -0,0 +1,247 @@
+import asyncio
+import csv
+import json
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, TextIO
+
+from clients.aws import wallets_table
+from clients.exchange_rates import ExchangeRateClientFactory
+from clients.exchange_rates.base import BaseExchangeRateClient
+
+from models.wallet import Currency, LocalCurrency, StoredWallet
+
+from services.currency_conversion import ConversionEngine
+from services.wallet_service import WALLET_ATTRIBUTES
+
+# Queue messages sent by the segment workers to the writer
+_ROW, _PAGE_DONE, _SEGMENT_FAILED = range(3)
+
+
+class ExportStats:
+
+    def __init__(self):
+        self.rows = 0
+        self.pages = 0
+        self.started_at = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+class WalletExporter:
+    """
+    Exports every wallet in the wallets table as NDJSON or CSV.
+
+    The table is read with a parallel scan, one worker thread per segment.
+    Workers hand rows to the writer through a bounded queue, so memory use
+    doesn't grow with the size of the table. When converting to local
+    currency, one rate snapshot is taken before the scan and used for every row.
+
+    With a checkpoint file, the LastEvaluatedKey of each segment is saved once
+    the rows of a page are written, and a later run with the same checkpoint
+    continues from there. A crash between writing rows and saving the
+    checkpoint can repeat those rows on resume, never skip them.
+    """
+
+    FORMATS = ("ndjson", "csv")
+
+    def __init__(
+            self,
+            output_format: str = "ndjson",
+            total_segments: int = 4,
+            convert: bool = False,
+            checkpoint_path: Optional[str] = None,
+            page_size: int = 1000,
+            on_progress: Optional[Callable[[ExportStats], None]] = None,
+    ):
+        if output_format not in self.FORMATS:
+            raise ValueError(f"Unsupported export format {output_format}")
+
+        self.output_format = output_format
+        self.total_segments = total_segments
+        self.convert = convert
+        self.checkpoint_path = checkpoint_path
+        self.page_size = page_size
+        self.on_progress = on_progress
+        self.stats = ExportStats()
+        self._rows = queue.Queue(maxsize=page_size * 2)
+        self._stop = threading.Event()
+        self._conversion_engines: Dict[LocalCurrency, ConversionEngine] = {}
+
+    @property
+    def is_resuming(self) -> bool:
+        return self.checkpoint_path is not None and os.path.exists(self.checkpoint_path)
+
+    def export(self, output: TextIO) -> ExportStats:
+        """
+        Writes every wallet to the output and returns the export stats,
+        when resuming the output should be opened for appending
+        """
+        checkpoint = self._load_checkpoint()
+        if self.convert:
+            self._conversion_engines = {
+                local_currency: ConversionEngine(exchange_rates)
+                for local_currency, exchange_rates in asyncio.run(self._take_rate_snapshot()).items()
+            }
+
+        writer = self._build_writer(output)
+        pending_segments = [
+            segment for segment in range(self.total_segments) if not checkpoint[segment]["done"]
+        ]
+        workers = [
+            threading.Thread(
+                target=self._scan_segment,
+                args=(segment, checkpoint[segment]["last_evaluated_key"]),
+                daemon=True,
+            )
+            for segment in pending_segments
+        ]
+        for worker in workers:
+            worker.start()
+
+        try:
+            remaining_segments = len(workers)
+            while remaining_segments:
+                message = self._rows.get()
+                if message[0] == _ROW:
+                    writer(message[1])
+                    self.stats.rows += 1
+                elif message[0] == _PAGE_DONE:
+                    _, segment, last_evaluated_key = message
+                    output.flush()
+                    checkpoint[segment] = {
+                        "last_evaluated_key": last_evaluated_key,
+                        "done": last_evaluated_key is None,
+                    }
+                    self._save_checkpoint(checkpoint)
+                    self.stats.pages += 1
+                    if last_evaluated_key is None:
+                        remaining_segments -= 1
+                    if self.on_progress is not None:
+                        self.on_progress(self.stats)
+                else:
+                    raise message[2]
+        finally:
+            self._stop.set()
+            # Unblock workers waiting on a full queue so they can exit
+            while any(worker.is_alive() for worker in workers):
+                try:
+                    self._rows.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+        return self.stats
+
+    async def _take_rate_snapshot(self) -> Dict[LocalCurrency, Dict[str, float]]:
+        try:
+            return {
+                local_currency: await ExchangeRateClientFactory.get_client(local_currency).get_rates(list(Currency))
+                for local_currency in LocalCurrency
+            }
+        finally:
+            await BaseExchangeRateClient.close_http_client()
+
+    def _scan_segment(self, segment: int, exclusive_start_key: Optional[dict]):
+        scan_args = {
+            "Segment": segment,
+            "TotalSegments": self.total_segments,
+            "ProjectionExpression": ", ".join(WALLET_ATTRIBUTES),
+            "Limit": self.page_size,
+        }
+
+        try:
+            while not self._stop.is_set():
+                if exclusive_start_key is not None:
+                    scan_args["ExclusiveStartKey"] = exclusive_start_key
+
+                page = wallets_table.scan(**scan_args)
+                for row in self._build_rows(page["Items"]):
+                    self._put((_ROW, row))
+
+                exclusive_start_key = page.get("LastEvaluatedKey")
+                self._put((_PAGE_DONE, segment, exclusive_start_key))
+                if exclusive_start_key is None:
+                    return
+        except Exception as error:
+            self._put((_SEGMENT_FAILED, segment, error))
+
+    def _put(self, message: tuple):
+        while not self._stop.is_set():
+            try:
+                self._rows.put(message, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _build_rows(self, items: List[dict]) -> List[dict]:
+        wallets = [StoredWallet(**item) for item in items]
+        rows = [
+            {"user_id": str(wallet.user_id), "local_currency": wallet.local_currency.value}
+            for wallet in wallets
+        ]
+
+        if not self.convert:
+            for row, wallet in zip(rows, wallets):
+                row["balances"] = {currency.value: balance for currency, balance in wallet.balances.items()}
+            return rows
+
+        # The page is converted in one batch per local currency, from the stored Decimal balances
+        for local_currency, engine in self._conversion_engines.items():
+            indexes = [index for index, wallet in enumerate(wallets) if wallet.local_currency == local_currency]
+            converted_wallets = engine.convert_many([items[index]["balances"] for index in indexes])
+            for index, (converted_balances, total) in zip(indexes, converted_wallets):
+                rows[index]["balances"] = {
+                    currency: ConversionEngine.to_major_units(balance)
+                    for currency, balance in converted_balances.items()
+                }
+                rows[index]["total"] = ConversionEngine.to_major_units(total)
+
+        return rows
+
+    def _build_writer(self, output: TextIO) -> Callable[[dict], None]:
+        if self.output_format == "ndjson":
+            return lambda row: output.write(json.dumps(row) + "\n")
+
+        fieldnames = ["user_id", "local_currency", *(currency.value for currency in Currency)]
+        if self.convert:
+            fieldnames.append("total")
+
+        csv_writer = csv.DictWriter(output, fieldnames=fieldnames)
+        if not self.is_resuming:
+            csv_writer.writeheader()
+
+        def write_csv_row(row: dict):
+            balances = row.pop("balances")
+            csv_writer.writerow({**row, **balances})
+
+        return write_csv_row
+
+    def _load_checkpoint(self) -> Dict[int, dict]:
+        checkpoint = {segment: {"last_evaluated_key": None, "done": False} for segment in range(self.total_segments)}
+
+        if self.is_resuming:
+            with open(self.checkpoint_path) as checkpoint_file:
+                saved_checkpoint = json.load(checkpoint_file)
+            if saved_checkpoint["total_segments"] != self.total_segments:
+                raise ValueError("Can't resume an export with a different number of segments")
+            checkpoint.update({int(segment): state for segment, state in saved_checkpoint["segments"].items()})
+
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint: Dict[int, dict]):
+        if self.checkpoint_path is None:
+            return
+
+        # Written to a temporary file first so a crash can't leave a truncated checkpoint
+        temporary_path = f"{self.checkpoint_path}.tmp"
+        with open(temporary_path, "w") as checkpoint_file:
+            json.dump({"total_segments": self.total_segments, "segments": checkpoint}, checkpoint_file)
+        os.replace(temporary_path, self.checkpoint_path)
@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+import json
+from decimal import Decimal
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from cachetools import TTLCache
+
+
+class IdempotencyKeyReused(ValueError):
+    """
+    Raised when an idempotency key is sent again with a different request
+    """
+
+
+class IdempotencyRecord:
+
+    __slots__ = ("fingerprint", "status_code", "expires_at")
+
+    def __init__(self, fingerprint: str, status_code: int, expires_at: int):
+        self.fingerprint = fingerprint
+        # Wallet mutations respond without a body, so the status code is the whole stored response
+        self.status_code = status_code
+        self.expires_at = expires_at
+
+
+def fingerprint_balance_changes(balance_changes: Dict[str, Decimal]) -> str:
+    """
+    Identifies a set of balance changes, so that a key reused
+    for a different request can be told apart from a retry
+    """
+    normalized_changes = sorted((str(currency), str(Decimal(amount).normalize())) for currency, amount in balance_changes.items())
+    return hashlib.sha256(json.dumps(normalized_changes).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    In-process side of idempotency keys. Recently completed keys are kept in
+    a bounded TTL cache, and concurrent requests with the same key share a
+    single attempt, so hot duplicates never reach DynamoDB. The DynamoDB
+    record written with the balance update remains the source of truth.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._completed = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._in_flight: Dict[Tuple, asyncio.Future] = {}
+        self.hits = 0
+
+    def get(self, scoped_key: str) -> Optional[IdempotencyRecord]:
+        record = self._completed.get(scoped_key)
+        if record is not None:
+            self.hits += 1
+        return record
+
+    def set(self, scoped_key: str, record: IdempotencyRecord):
+        self._completed[scoped_key] = record
+
+    async def single_flight(self, scoped_key: str, attempt: Callable[[], Awaitable]) -> Tuple[object, bool]:
+        """
+        Runs the attempt unless one with the same key is already running,
+        returns its result and whether this call was the one that ran it
+        """
+        loop = asyncio.get_running_loop()
+        in_flight_key = (loop, scoped_key)
+        in_flight = self._in_flight.get(in_flight_key)
+        if in_flight is not None:
+            self.hits += 1
+            return await asyncio.shield(in_flight), False
+
+        future = self._in_flight[in_flight_key] = loop.create_future()
+        try:
+            result = await attempt()
+        except BaseException as error:
+            future.set_exception(error)
+            # Marked as retrieved so a failure nobody else waited on isn't logged
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, True
+        finally:
+            del self._in_flight[in_flight_key]
+
+    def clear(self):
+        self._completed.clear()
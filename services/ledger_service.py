@@ -0,0 +1,267 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import AsyncIterator, Dict, Optional
+
+from settings import api_settings
+
+from clients.aws import async_ledger_table, async_wallets_table
+
+from models.wallet import Currency
+
+# Ledger entries and snapshots share the ledger table, told apart by the prefix of their sort key
+ENTRY_PREFIX = "E#"
+SNAPSHOT_PREFIX = "S#"
+# Position of a wallet that hasn't been changed since the ledger was enabled
+OPENING_POSITION = "0" * 16
+# Sorts after every position with the same timestamp
+POSITION_UPPER_BOUND = "~"
+
+
+class LedgerService:
+    """
+    Append-only history of wallet changes.
+
+    Every change to a wallet appends an entry holding the signed changes
+    per currency, written in the same transaction as the update. Entries
+    are sorted by their position, the microsecond timestamp of the change
+    followed by a random suffix. The wallet item records the position and
+    count of its latest entry, and only accepts an entry positioned after
+    it, so it is always an exact snapshot of the balances at that position
+    even when writers race or their clocks disagree.
+
+    Changes made while the ledger is disabled record their position in the
+    wallet's `unledgered_change` instead. History is only answered from the
+    wallet's first entry on, and after its latest unledgered change.
+
+    Compaction copies wallets into snapshot items every
+    `ledger_snapshot_interval` entries. Balances at a point in time are
+    then rebuilt from the closest snapshot and the entries in between,
+    instead of replaying the whole history.
+    """
+
+    @staticmethod
+    def new_position(after: Optional[str] = None) -> str:
+        """
+        Returns a position for an entry written now, or just after the
+        `after` position if the clock hasn't gone past it
+        """
+        timestamp = time.time_ns() // 1000
+        if after is not None:
+            timestamp = max(timestamp, int(after[:16]) + 1)
+        return f"{timestamp:016d}#{uuid.uuid4().hex}"
+
+    @staticmethod
+    async def latest_position(user_id: str) -> Optional[str]:
+        """
+        Returns the position of the wallet's latest entry, or None if there is no such wallet
+        """
+        wallet = await LedgerService._wallet_snapshot(user_id)
+        return wallet["position"] if wallet is not None else None
+
+    @staticmethod
+    def build_entry(user_id: str, position: str, balance_changes: Dict[str, Decimal]) -> dict:
+        """
+        Builds the TransactWriteItems entry appending a ledger entry
+        """
+        return {
+            "Put": {
+                "TableName": async_ledger_table.name,
+                "Item": {
+                    "user_id": user_id,
+                    "entry_key": ENTRY_PREFIX + position,
+                    "changes": {Currency(currency).value: amount for currency, amount in balance_changes.items()},
+                },
+            },
+        }
+
+    @staticmethod
+    async def get_balances_at(user_id: str, at: datetime) -> Optional[Dict[str, Decimal]]:
+        """
+        Rebuilds a wallet's balances as they were at the given time, or returns
+        None if there is no such wallet or its history doesn't cover the time
+        """
+        at_position = LedgerService._position_at(at) + POSITION_UPPER_BOUND
+
+        wallet = await LedgerService._wallet_snapshot(user_id)
+        if wallet is None:
+            return None
+        earliest_position = await LedgerService._earliest_position(user_id)
+        # Balances before the first entry, or before a change missing from the ledger, aren't known
+        if earliest_position is None or at_position < max(earliest_position, wallet["unledgered_change"]):
+            return None
+
+        snapshot = await LedgerService._closest_snapshot(user_id, at_position, before=True)
+        # A snapshot from before the latest unledgered change is missing it
+        if snapshot is not None and snapshot["position"] >= wallet["unledgered_change"]:
+            balances = dict(snapshot["balances"])
+            # Entries after the snapshot up to the requested time are applied forwards
+            async for entry in LedgerService._entries(user_id, snapshot["position"], at_position):
+                LedgerService._apply(balances, entry["changes"], 1)
+            return balances
+
+        snapshot = await LedgerService._closest_snapshot(user_id, at_position, before=False) or wallet
+
+        # Entries after the requested time up to the snapshot are undone
+        balances = dict(snapshot["balances"])
+        async for entry in LedgerService._entries(user_id, at_position, snapshot["position"], include_end=True):
+            LedgerService._apply(balances, entry["changes"], -1)
+        return balances
+
+    @staticmethod
+    async def compact_wallet(user_id: str) -> bool:
+        """
+        Writes a snapshot of the wallet if it has had at least `ledger_snapshot_interval`
+        entries since its latest snapshot, returns True if one was written
+        """
+        wallet = await LedgerService._wallet_snapshot(user_id)
+        if wallet is None or wallet["position"] == OPENING_POSITION:
+            return False
+
+        latest_snapshot = await LedgerService._closest_snapshot(user_id, POSITION_UPPER_BOUND, before=True)
+        entries_since_snapshot = wallet["entry_count"] - (latest_snapshot["entry_count"] if latest_snapshot else 0)
+        if entries_since_snapshot < api_settings.ledger_snapshot_interval:
+            return False
+
+        await async_ledger_table.put_item(Item={
+            "user_id": user_id,
+            "entry_key": SNAPSHOT_PREFIX + wallet["position"],
+            "balances": wallet["balances"],
+            "entry_count": wallet["entry_count"],
+        })
+        return True
+
+    @staticmethod
+    async def compact(concurrency: int = 16) -> int:
+        """
+        Compaction job, snapshots every wallet that is due for one
+        and returns the number of snapshots written
+        """
+        scan_args = {
+            "ProjectionExpression": "user_id",
+            # Wallets without enough entries for a snapshot are skipped
+            "FilterExpression": "ledger_entry_count >= :interval",
+            "ExpressionAttributeValues": {":interval": api_settings.ledger_snapshot_interval},
+        }
+        semaphore = asyncio.Semaphore(concurrency)
+        snapshots = 0
+
+        async def compact_with_limit(user_id: str) -> bool:
+            async with semaphore:
+                return await LedgerService.compact_wallet(user_id)
+
+        while True:
+            page = await async_wallets_table.scan(**scan_args)
+            results = await asyncio.gather(*(compact_with_limit(item["user_id"]) for item in page["Items"]))
+            snapshots += sum(results)
+
+            if "LastEvaluatedKey" not in page:
+                return snapshots
+            scan_args["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    @staticmethod
+    def _position_at(at: datetime) -> str:
+        if at.tzinfo is None:
+            at = at.replace(tzinfo=timezone.utc)
+        timestamp = max(int(at.timestamp() * 1_000_000), 0)
+        return f"{timestamp:016d}"
+
+    @staticmethod
+    def _apply(balances: Dict[str, Decimal], changes: Dict[str, Decimal], sign: int):
+        for currency, amount in changes.items():
+            balances[currency] = balances.get(currency, Decimal(0)) + sign * amount
+
+    @staticmethod
+    async def _closest_snapshot(user_id: str, position: str, before: bool) -> Optional[dict]:
+        """
+        Returns the latest snapshot at or before the position,
+        or the earliest one after it
+        """
+        bounds = (SNAPSHOT_PREFIX, SNAPSHOT_PREFIX + position) if before \
+            else (SNAPSHOT_PREFIX + position, SNAPSHOT_PREFIX + POSITION_UPPER_BOUND)
+        response = await async_ledger_table.query(
+            KeyConditionExpression="user_id = :user_id AND entry_key BETWEEN :start AND :end",
+            ExpressionAttributeValues={":user_id": user_id, ":start": bounds[0], ":end": bounds[1]},
+            ScanIndexForward=not before,
+            Limit=1,
+        )
+        if not response["Items"]:
+            return None
+
+        snapshot = response["Items"][0]
+        return {
+            "position": snapshot["entry_key"][len(SNAPSHOT_PREFIX):],
+            "balances": snapshot["balances"],
+            "entry_count": snapshot["entry_count"],
+        }
+
+    @staticmethod
+    async def _earliest_position(user_id: str) -> Optional[str]:
+        """
+        Returns the position of the wallet's first entry, or of its first
+        snapshot if it has no entries, or None if it has neither
+        """
+        # Entries sort before snapshots
+        response = await async_ledger_table.query(
+            KeyConditionExpression="user_id = :user_id",
+            ExpressionAttributeValues={":user_id": user_id},
+            ProjectionExpression="entry_key",
+            Limit=1,
+        )
+        if not response["Items"]:
+            return None
+        return response["Items"][0]["entry_key"].split("#", 1)[1]
+
+    @staticmethod
+    async def _wallet_snapshot(user_id: str) -> Optional[dict]:
+        """
+        Reads the wallet itself as a snapshot at its latest ledger entry
+        """
+        response = await async_wallets_table.get_item(
+            Key={"user_id": user_id},
+            ProjectionExpression="balances, ledger_entry, ledger_entry_count, unledgered_change",
+            ConsistentRead=True,
+        )
+        wallet = response.get("Item")
+        if wallet is None:
+            return None
+
+        return {
+            "position": wallet.get("ledger_entry", OPENING_POSITION),
+            "balances": wallet["balances"],
+            "entry_count": wallet.get("ledger_entry_count", 0),
+            "unledgered_change": wallet.get("unledgered_change", ""),
+        }
+
+    @staticmethod
+    async def _entries(user_id: str, start: str, end: str, include_end: bool = False) -> AsyncIterator[dict]:
+        """
+        Yields the ledger entries positioned after `start` and before `end`
+        """
+        if start >= end:
+            return
+
+        query_args = {
+            "KeyConditionExpression": "user_id = :user_id AND entry_key BETWEEN :start AND :end",
+            "ExpressionAttributeValues": {
+                ":user_id": user_id,
+                ":start": ENTRY_PREFIX + start,
+                ":end": ENTRY_PREFIX + end,
+            },
+            "ProjectionExpression": "entry_key, changes",
+        }
+
+        while True:
+            page = await async_ledger_table.query(**query_args)
+            for entry in page["Items"]:
+                # BETWEEN includes both bounds
+                position = entry["entry_key"][len(ENTRY_PREFIX):]
+                if position == start or (position == end and not include_end):
+                    continue
+                yield entry
+
+            if "LastEvaluatedKey" not in page:
+                return
+            query_args["ExclusiveStartKey"] = page["LastEvaluatedKey"]
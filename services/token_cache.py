@@ -0,0 +1,56 @@
+import hashlib
+import time
+from typing import Optional
+
+from cachetools import LRUCache
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU of bearer tokens that already passed JWT validation.
+
+    Tokens are keyed by their SHA-256 digest and map to the user id and
+    expiry from their payload. An entry is dropped once the token expires,
+    and the whole cache is cleared when the signing key changes.
+    """
+
+    def __init__(self, maxsize: int):
+        self._cache = LRUCache(maxsize=maxsize)
+        self._signing_key = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(value: str) -> bytes:
+        return hashlib.sha256(value.encode()).digest()
+
+    def _check_signing_key(self, signing_key: str):
+        if signing_key != self._signing_key:
+            self._cache.clear()
+            self._signing_key = signing_key
+
+    def get(self, token: str, signing_key: str) -> Optional[str]:
+        """
+        Returns the user id of a cached token,
+        or None if the token has to be validated
+        """
+        self._check_signing_key(signing_key)
+        token_digest = self._digest(token)
+        entry = self._cache.get(token_digest)
+
+        if entry is not None:
+            user_id, expires_at = entry
+            if expires_at > time.time():
+                self.hits += 1
+                return user_id
+            del self._cache[token_digest]
+
+        self.misses += 1
+        return None
+
+    def set(self, token: str, signing_key: str, user_id: str, expires_at: float):
+        self._check_signing_key(signing_key)
+        self._cache[self._digest(token)] = (user_id, expires_at)
+
+    def clear(self):
+        self._cache.clear()
@@ -0,0 +1,79 @@
+import time
+from typing import Callable, Optional, Union
+
+from cachetools import TTLCache
+
+from settings import api_settings
+
+from models.auth import UserData
+
+
+class _Missing:
+    """
+    Cached in place of a user record for usernames that don't exist
+    """
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+
+class UserRecordCache:
+    """
+    Per-process cache of user records keyed by username, used by logins.
+
+    Usernames that don't exist are cached too, with their own shorter TTL,
+    so repeated logins with unknown usernames don't each cost a DynamoDB read.
+    Records saved through this process replace the cached entry, changes made
+    by other processes become visible once the entry's TTL runs out.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float, clock: Callable[[], float] = time.monotonic):
+        self._records = TTLCache(maxsize=maxsize, ttl=ttl, timer=clock)
+        self._missing = TTLCache(maxsize=maxsize, ttl=negative_ttl, timer=clock)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return api_settings.user_cache_enabled
+
+    def get(self, username: str) -> Union[UserData, _Missing, None]:
+        """
+        Returns the cached record, MISSING if the username is known
+        not to exist, or None if DynamoDB has to be read
+        """
+        if not self.enabled:
+            return None
+
+        record = self._records.get(username)
+        if record is None and username in self._missing:
+            record = MISSING
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return record
+
+    def set(self, username: str, record: Optional[UserData]):
+        """
+        Caches a record read from or written to DynamoDB, None caches the username as missing
+        """
+        if not self.enabled:
+            return
+        if record is None:
+            self._records.pop(username, None)
+            self._missing[username] = True
+        else:
+            self._missing.pop(username, None)
+            self._records[username] = record
+
+    def invalidate(self, username: str):
+        self._records.pop(username, None)
+        self._missing.pop(username, None)
+
+    def clear(self):
+        self._records.clear()
+        self._missing.clear()
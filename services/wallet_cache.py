@@ -0,0 +1,142 @@
+from typing import Any, Dict, Hashable, Optional, Set
+
+from cachetools import LRUCache, TTLCache
+
+from settings import api_settings
+
+
+class WalletCache:
+    """
+    Per-process read-through cache of raw wallet items keyed by user id.
+
+    Writes made through this process replace the cached item with the one
+    returned by DynamoDB, so a user always reads their own writes. Writes
+    made by other processes become visible once the entry's TTL runs out.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Used to tell whether a write finished while a read was in flight
+        self._write_sequence = 0
+        self._last_writes = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._writes_in_flight: Dict[str, int] = {}
+        self._contended_users: Set[str] = set()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return api_settings.wallet_cache_enabled
+
+    def get(self, user_id: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+
+        item = self._cache.get(user_id)
+        if item is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return item
+
+    def read_marker(self) -> int:
+        """
+        Taken before reading a wallet from DynamoDB and passed
+        back to `set_read` once the read has completed
+        """
+        return self._write_sequence
+
+    def set_read(self, user_id: str, item: dict, read_marker: int):
+        """
+        Caches an item read from DynamoDB unless a write to the
+        same wallet overlapped with the read, which could make it stale
+        """
+        if not self.enabled or user_id in self._writes_in_flight:
+            return
+        if self._last_writes.get(user_id, -1) > read_marker:
+            return
+        self._cache[user_id] = item
+
+    def begin_write(self, user_id: str):
+        if user_id in self._writes_in_flight:
+            self._contended_users.add(user_id)
+        self._writes_in_flight[user_id] = self._writes_in_flight.get(user_id, 0) + 1
+
+    def end_write(self, user_id: str, item: Optional[dict]):
+        """
+        Replaces the cached item with the one returned by a write, or drops
+        it if the write failed or overlapped with another write to the
+        same wallet, since responses may then arrive out of order
+        """
+        self._write_sequence += 1
+        self._last_writes[user_id] = self._write_sequence
+
+        contended = user_id in self._contended_users
+        remaining_writes = self._writes_in_flight.pop(user_id, 1) - 1
+        if remaining_writes:
+            self._writes_in_flight[user_id] = remaining_writes
+        else:
+            self._contended_users.discard(user_id)
+
+        if item is None or contended or not self.enabled:
+            self._cache.pop(user_id, None)
+        else:
+            self._cache[user_id] = item
+
+    def clear(self):
+        self._cache.clear()
+        self._last_writes.clear()
+
+
+class ConvertedWalletCache:
+    """
+    Memoizes wallets converted to local currency.
+
+    An entry is only reused while both the wallet and the exchange rates it
+    was converted with are unchanged, so a hit returns exactly what a fresh
+    conversion would have produced.
+    """
+
+    def __init__(self, maxsize: int):
+        self._cache = LRUCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return api_settings.converted_wallet_cache_enabled
+
+    def get(self, user_id: str, wallet_version: Hashable, rate_version: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+
+        entry = self._cache.get(user_id)
+        if entry is not None and entry[0] == wallet_version and entry[1] == rate_version:
+            self.hits += 1
+            return entry[2]
+
+        self.misses += 1
+        return None
+
+    def set(self, user_id: str, wallet_version: Hashable, rate_version: Hashable, converted_wallet: Any):
+        if self.enabled:
+            self._cache[user_id] = (wallet_version, rate_version, converted_wallet)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class WalletVersionIndex(WalletCache):
+    """
+    Per-process index of the latest known version of each wallet, used to
+    answer conditional reads without reading the wallet from DynamoDB.
+
+    Entries hold the wallet's `version` and `local_currency`, and are kept
+    up to date like WalletCache entries: writes made through this process
+    replace them, writes made by other processes become visible once the
+    entry's TTL runs out.
+    """
+
+    @property
+    def enabled(self) -> bool:
+        return api_settings.wallet_version_index_enabled
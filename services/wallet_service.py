@@ -1,9 +1,47 @@
+import asyncio
+import random
+import time
+from collections import deque
+from datetime import datetime
 from decimal import Decimal
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple, Type
 
-from clients.aws import wallets_table
+import metrics
+from settings import api_settings
+
+from botocore.exceptions import ClientError
+
+from clients.aws import async_idempotency_table, async_wallets_table, transact_write_items
 from clients.exchange_rates import ExchangeRateClientFactory
+from clients.exchange_rates.base import BaseExchangeRateClient
+
+from models.wallet import BalanceChange, ClientWallet, CommonWalletData, Currency, LocalCurrency
+
+from services.currency_conversion import ConversionEngine
+from services.ledger_service import LedgerService
+from services.idempotency import (
+    IdempotencyKeyReused, IdempotencyRecord, IdempotencyStore, fingerprint_balance_changes
+)
+from services.wallet_cache import ConvertedWalletCache, WalletCache, WalletVersionIndex
+from services.write_coalescer import WriteCoalescer
+
+# Attributes of a wallet item that are read by the service
+WALLET_ATTRIBUTES = ("balances", "local_currency", "user_id", "version")
+# Attributes kept in the wallet version index
+VERSION_INDEX_ATTRIBUTES = ("local_currency", "version")
+# Maximum number of keys DynamoDB accepts in a single BatchGetItem request
+BATCH_GET_SIZE = 100
+# Attempts at finding a ledger position after the wallet's latest entry
+LEDGER_POSITION_ATTEMPTS = 5
 
-from models.wallet import StoredWallet, ClientWallet, CommonWalletData
+
+class VersionedWallet(NamedTuple):
+    wallet: CommonWalletData
+    # Incremented by every balance change, 0 for wallets never changed by the API
+    version: int
+    # Scope and epoch of the exchange rates a converted wallet was computed with,
+    # None for wallets that weren't converted or whose rates aren't cached
+    rate_version: Optional[Tuple[str, int]] = None
 
 
 class WalletService:
@@ -11,96 +49,653 @@ class WalletService:
     Service allowing interaction with user currency holdings
     """
 
+    wallet_cache = WalletCache(maxsize=api_settings.wallet_cache_size, ttl=api_settings.wallet_cache_ttl)
+    converted_wallet_cache = ConvertedWalletCache(maxsize=api_settings.converted_wallet_cache_size)
+    version_index = WalletVersionIndex(
+        maxsize=api_settings.wallet_version_index_size,
+        ttl=api_settings.wallet_version_index_ttl,
+    )
+    write_coalescer = WriteCoalescer(
+        write=lambda user_id, balance_changes: WalletService._modify_balance(user_id, balance_changes),
+        window=api_settings.write_coalescing_window,
+        max_batch=api_settings.write_coalescing_max_batch,
+    )
+    idempotency_store = IdempotencyStore(
+        maxsize=api_settings.idempotency_cache_size,
+        ttl=api_settings.idempotency_key_ttl,
+    )
+
     @staticmethod
-    def get_original_wallet(user_id: str) -> CommonWalletData:
+    async def get_original_wallet(user_id: str) -> CommonWalletData:
         """
         Retrieve wallet data without performing any sort of conversion
         """
-        data = WalletService._fetch_raw_wallet(user_id)
-        return CommonWalletData(**data)
+        return (await WalletService.get_versioned_original_wallet(user_id)).wallet
 
     @staticmethod
-    def get_local_currency_wallet(user_id: str) -> ClientWallet:
+    async def get_local_currency_wallet(user_id: str) -> ClientWallet:
         """
         Retrieve wallet data and convert
         foreign holdings into user's local currency
         """
-        data = WalletService._fetch_raw_wallet(user_id)
-        wallet = StoredWallet(**data)
+        return (await WalletService.get_versioned_local_currency_wallet(user_id)).wallet
+
+    @staticmethod
+    async def get_versioned_original_wallet(user_id: str) -> VersionedWallet:
+        """
+        Retrieve wallet data without conversion, along with its version
+        """
+        data = await WalletService._fetch_raw_wallet(user_id)
+        return VersionedWallet(CommonWalletData(**data), int(data.get("version", 0)))
+
+    @staticmethod
+    async def get_versioned_local_currency_wallet(user_id: str) -> VersionedWallet:
+        """
+        Retrieve the wallet converted into user's local currency, along
+        with its version and the version of the rates it was converted with
+        """
+        data = await WalletService._fetch_raw_wallet(user_id)
+        converted_wallet, rate_version = await WalletService._convert_wallet_with_rate_version(user_id, data)
+        return VersionedWallet(converted_wallet, int(data.get("version", 0)), rate_version)
+
+    @staticmethod
+    async def get_indexed_version(
+            user_id: str,
+            convert: bool = False,
+    ) -> Optional[Tuple[int, Optional[Tuple[str, int]]]]:
+        """
+        Returns the wallet version and, if `convert` is set, the current rate
+        version of the user's local currency from the version index, without
+        reading DynamoDB. Returns None when the wallet isn't indexed, or when
+        `convert` is set and the rates aren't cached or changed meanwhile.
+        """
+        entry = WalletService.version_index.get(user_id)
+        if entry is None:
+            return None
+        if not convert:
+            return int(entry.get("version", 0)), None
+
+        local_currency = LocalCurrency(entry.get("local_currency", LocalCurrency.PLN))
+        exchange_rate_client = ExchangeRateClientFactory.get_client(local_currency)
+        # The index doesn't know which currencies the wallet holds, so every rate is read
+        _, rate_version = await WalletService._get_rates_with_version(exchange_rate_client, list(Currency))
+        if rate_version is None:
+            return None
+        return int(entry.get("version", 0)), rate_version
+
+    @staticmethod
+    async def get_historical_wallet(user_id: str, at: datetime) -> Optional[CommonWalletData]:
+        """
+        Retrieve wallet balances as they were at the given time from
+        the ledger, or None if the user has no wallet or the ledger
+        doesn't cover the time
+        """
+        balances = await LedgerService.get_balances_at(user_id, at)
+        if balances is None:
+            return None
+        return CommonWalletData(balances=balances)
+
+    @staticmethod
+    async def get_wallets(
+            user_ids: Iterable[str],
+            convert: bool = False,
+    ) -> AsyncIterator[Tuple[str, Optional[CommonWalletData]]]:
+        """
+        Retrieve the wallets of many users, yielding (user_id, wallet) pairs
+        as they are read. Wallets are read with BatchGetItem in chunks of
+        BATCH_GET_SIZE keys, a few chunks at a time, and the wallet is None
+        for users that don't have one. If `convert` is set the wallets are
+        converted to local currency like in `get_local_currency_wallet`.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        chunks = [user_ids[index:index + BATCH_GET_SIZE] for index in range(0, len(user_ids), BATCH_GET_SIZE)]
+        in_flight = deque()
 
-        exchange_rate_client = ExchangeRateClientFactory.get_client(wallet.local_currency)
-        converted_balances = {}
-        balance_total = 0
+        try:
+            for chunk in chunks:
+                in_flight.append(asyncio.create_task(WalletService._fetch_raw_wallets(chunk)))
+                if len(in_flight) < api_settings.bulk_read_concurrency:
+                    continue
+                async for result in WalletService._build_wallets(await in_flight.popleft(), convert):
+                    yield result
 
-        for currency, balance in wallet.balances.items():
-            exchange_rate = exchange_rate_client.get_rate(currency)
-            converted_balance = round(balance * exchange_rate, 2)
-            converted_balances[currency] = converted_balance
-            balance_total += converted_balance
+            while in_flight:
+                async for result in WalletService._build_wallets(await in_flight.popleft(), convert):
+                    yield result
+        finally:
+            # Stop reading ahead if the consumer went away
+            for task in in_flight:
+                task.cancel()
 
-        balance_total = round(balance_total, 2)
-        return ClientWallet(balances=converted_balances, total=balance_total)
+    @staticmethod
+    async def _build_wallets(items: Dict[str, Optional[dict]], convert: bool):
+        for user_id, data in items.items():
+            if data is None:
+                yield user_id, None
+            elif convert:
+                yield user_id, await WalletService._convert_wallet(user_id, data)
+            else:
+                yield user_id, CommonWalletData(**data)
 
     @staticmethod
-    def add_to_wallet(user_id: str, currency_code: str, balance: Decimal):
+    async def _convert_wallet(user_id: str, data: dict) -> ClientWallet:
+        """
+        Converts a raw wallet item into the user's local currency
         """
-        Add a given quantity to a user's currency holding
+        return (await WalletService._convert_wallet_with_rate_version(user_id, data))[0]
+
+    @staticmethod
+    def _rate_version(exchange_rate_client: Type[BaseExchangeRateClient]) -> Optional[Tuple[str, int]]:
+        """
+        Returns the scope and epoch of the client's cached rates,
+        or None if results computed from its rates can't be reused
+        """
+        rate_epoch = exchange_rate_client.rate_epoch()
+        rate_epoch_scope = exchange_rate_client.rate_epoch_scope()
+        if rate_epoch is None or rate_epoch_scope is None:
+            return None
+        return rate_epoch_scope, rate_epoch
+
+    @staticmethod
+    async def _get_rates_with_version(
+            exchange_rate_client: Type[BaseExchangeRateClient],
+            currency_codes: Iterable[str],
+    ) -> Tuple[Dict[str, float], Optional[Tuple[str, int]]]:
+        """
+        Returns the rates and the version they were read at, None if the rates aren't
+        cached or changed while being read. Reading the rates lets the rate cache expire
+        and refresh them, so results memoized per version aren't served from old rates.
+        """
+        # The epoch is read before the rates so a result is never tagged as newer than it is
+        rate_version = WalletService._rate_version(exchange_rate_client)
+        # All rates are requested up front so that cache misses
+        # are fetched concurrently instead of one after the other
+        with metrics.stage_duration.time("exchange_rates"):
+            exchange_rates = await exchange_rate_client.get_rates(currency_codes)
+        if rate_version != WalletService._rate_version(exchange_rate_client):
+            return exchange_rates, None
+        return exchange_rates, rate_version
+
+    @staticmethod
+    async def _convert_wallet_with_rate_version(
+            user_id: str,
+            data: dict,
+    ) -> Tuple[ClientWallet, Optional[Tuple[str, int]]]:
+        """
+        Converts a raw wallet item into the user's local currency, returns
+        the converted wallet and the version of the rates it was converted with
+        """
+        local_currency = LocalCurrency(data.get("local_currency", LocalCurrency.PLN))
+        exchange_rate_client = ExchangeRateClientFactory.get_client(local_currency)
+
+        # A converted wallet can be reused until either the wallet or the rates change
+        exchange_rates, rate_version = await WalletService._get_rates_with_version(
+            exchange_rate_client, data["balances"].keys()
+        )
+        wallet_version = WalletService._wallet_version(data)
+        if rate_version is not None:
+            converted_wallet = WalletService.converted_wallet_cache.get(
+                user_id, wallet_version, (exchange_rate_client, rate_version)
+            )
+            if converted_wallet is not None:
+                return converted_wallet, rate_version
+
+        # Balances are converted straight from the stored Decimals, without a float round-trip
+        with metrics.stage_duration.time("conversion"):
+            converted_wallet = WalletService.convert_with_rates(data["balances"], exchange_rates)
+
+        if rate_version is not None:
+            WalletService.converted_wallet_cache.set(
+                user_id, wallet_version, (exchange_rate_client, rate_version), converted_wallet
+            )
+        return converted_wallet, rate_version
+
+    @staticmethod
+    def convert_with_rates(balances: Mapping[str, Decimal], exchange_rates: Dict[str, float]) -> ClientWallet:
+        """
+        Converts every balance with its rate, see ConversionEngine for how
+        balances are rounded and how the total is formed
+        """
+        converted_balances, total = ConversionEngine(exchange_rates).convert(balances)
+        return WalletService._to_client_wallet(converted_balances, total)
+
+    @staticmethod
+    def _to_client_wallet(converted_balances: Dict[str, int], total: int) -> ClientWallet:
+        return ClientWallet(
+            balances={
+                currency: ConversionEngine.to_major_units(balance) for currency, balance in converted_balances.items()
+            },
+            total=ConversionEngine.to_major_units(total),
+        )
+
+    @staticmethod
+    async def add_to_wallet(
+            user_id: str,
+            currency_code: str,
+            balance: Decimal,
+            idempotency_key: Optional[str] = None,
+    ) -> Optional[IdempotencyRecord]:
+        """
+        Add a given quantity to a user's currency holding, returns the stored
+        record if the request replays an earlier one with the same idempotency key
         """
         if balance > 0:
-            WalletService._modify_balance(user_id, currency_code, balance)
+            return await WalletService._modify_single_balance(user_id, currency_code, balance, idempotency_key)
         else:
             raise ValueError("balance value should be positive")
 
     @staticmethod
-    def subtract_from_wallet(user_id: str, currency_code: str, balance: Decimal):
+    async def subtract_from_wallet(
+            user_id: str,
+            currency_code: str,
+            balance: Decimal,
+            idempotency_key: Optional[str] = None,
+    ) -> Optional[IdempotencyRecord]:
         """
-        Remove a given quantity from a user's currency holding
+        Remove a given quantity from a user's currency holding, returns the stored
+        record if the request replays an earlier one with the same idempotency key
         """
         if balance > 0:
             balance = balance * -1
-            WalletService._modify_balance(user_id, currency_code, balance)
+            return await WalletService._modify_single_balance(user_id, currency_code, balance, idempotency_key)
         else:
             raise ValueError("balance value should be positive")
 
     @staticmethod
-    def _modify_balance(user_id: str, currency_code: str, balance: Decimal):
+    async def apply_balance_changes(
+            user_id: str,
+            balance_changes: Iterable[BalanceChange],
+            idempotency_key: Optional[str] = None,
+    ) -> Optional[IdempotencyRecord]:
         """
-        Helper function that will directly modify a user's currency holding
+        Apply several signed balance changes to a user's wallet at once.
+        Changes to the same currency are summed, and either every change
+        is applied or none of them is. Returns the stored record if the
+        request replays an earlier one with the same idempotency key.
         """
+        net_changes = {}
+        for balance_change in balance_changes:
+            net_changes[balance_change.currency] = net_changes.get(balance_change.currency, 0) + balance_change.amount
+
+        net_changes = {currency: amount for currency, amount in net_changes.items() if amount != 0}
+        if idempotency_key is not None:
+            return await WalletService._modify_balance_idempotently(user_id, net_changes, idempotency_key)
+        if net_changes:
+            await WalletService._modify_balance(user_id, net_changes)
+
+    @staticmethod
+    async def _modify_single_balance(
+            user_id: str,
+            currency_code: str,
+            balance: Decimal,
+            idempotency_key: Optional[str] = None,
+    ) -> Optional[IdempotencyRecord]:
+        """
+        Changes one currency holding, going through the write
+        coalescer when it is enabled for hot wallets
+        """
+        if idempotency_key is not None:
+            # The key has to be written in the same transaction as the
+            # change, so these writes can't be merged with others
+            return await WalletService._modify_balance_idempotently(
+                user_id, {currency_code: balance}, idempotency_key
+            )
+        if api_settings.write_coalescing_enabled:
+            await WalletService.write_coalescer.submit(user_id, currency_code, balance)
+        else:
+            await WalletService._modify_balance(user_id, {currency_code: balance})
+
+    @staticmethod
+    def _build_balance_update(
+            user_id: str,
+            balance_changes: Dict[str, Decimal],
+            ledger_position: Optional[str] = None,
+    ) -> dict:
+        """
+        Builds the arguments of an update applying every change
+        to a user's currency holdings in a single atomic update,
+        and recording the ledger entry written with it if there is one,
+        or else the position of a change missing from the ledger
+        """
+        # Every update bumps the wallet version, which conditional reads are answered from
+        update_clauses = ["version :versionIncrement"]
+        conditions = []
+        attribute_names = {}
+        attribute_values = {":versionIncrement": 1}
+
+        for index, (currency_code, balance) in enumerate(balance_changes.items()):
+            attribute_names[f"#currency{index}"] = currency_code
+            attribute_values[f":balVal{index}"] = balance
+            # ADD will also subtract if we pass a negative number
+            update_clauses.append(f"balances.#currency{index} :balVal{index}")
+
+            # We should not be able to subtract from the balance
+            # in a way that would cause it to become negative...
+            if balance < 0:
+                # ...so let's add an update condition to make sure
+                # that if we subtract from a currency that the currency holding won't go below zero
+                attribute_values[f":absbalVal{index}"] = abs(balance)
+                conditions.append(f"balances.#currency{index} >= :absbalVal{index}")
+
+        update_expression = "ADD " + ", ".join(update_clauses)
+        if ledger_position is not None:
+            # Makes the wallet a snapshot of the ledger as of its latest entry
+            attribute_values[":ledgerEntry"] = ledger_position
+            attribute_values[":ledgerEntryCount"] = 1
+            update_expression += ", ledger_entry_count :ledgerEntryCount SET ledger_entry = :ledgerEntry"
+            # Entries committed out of order would leave the wallet at an earlier position than its balances
+            conditions.append("(attribute_not_exists(ledger_entry) OR ledger_entry < :ledgerEntry)")
+        else:
+            # History from before this change can't be rebuilt from the ledger
+            attribute_values[":unledgeredChange"] = LedgerService.new_position()
+            update_expression += " SET unledgered_change = :unledgeredChange"
+
         query_args = {
             "Key": {
                 'user_id': user_id
             },
-            # ADD will also subtract if we pass a negative number
-            "UpdateExpression": "ADD balances.#currency :balVal",
-            "ExpressionAttributeNames": {
-                '#currency': currency_code,
-            },
-            "ExpressionAttributeValues": {
-                ':balVal': balance,
-            },
+            "UpdateExpression": update_expression,
+            "ExpressionAttributeNames": attribute_names,
+            "ExpressionAttributeValues": attribute_values,
         }
 
-        # We should not be able to subtract from the balance
-        # in a way that would cause it to become negative...
-        if balance < 0:
-            # ...so let's add an update condition to make sure
-            # that if we subtract from a currency that the currency holding won't go below zero
-            query_args["ExpressionAttributeValues"][":absbalVal"] = abs(balance)
-            query_args["ConditionExpression"] = "balances.#currency >= :absbalVal"
+        if conditions:
+            query_args["ConditionExpression"] = " AND ".join(conditions)
+
+        return query_args
+
+    @staticmethod
+    def _build_balance_transaction(
+            user_id: str,
+            balance_changes: Dict[str, Decimal],
+            ledger_position: Optional[str],
+    ) -> List[dict]:
+        """
+        Builds the TransactWriteItems entries applying the changes,
+        with their ledger entry at the position if there is one
+        """
+        transact_items = [{
+            "Update": {
+                "TableName": async_wallets_table.name,
+                **WalletService._build_balance_update(user_id, balance_changes, ledger_position),
+            },
+        }]
+        if ledger_position is not None:
+            transact_items.append(LedgerService.build_entry(user_id, ledger_position, balance_changes))
+        return transact_items
+
+    @staticmethod
+    async def _transact_in_ledger_order(user_id: str, build_items: Callable[[Optional[str]], List[dict]]):
+        """
+        Runs the transaction built by `build_items` for a new ledger position, or
+        for None when the ledger is disabled. A wallet only accepts entries after
+        its latest one, so a transaction that lost a race with a later entry, or
+        was positioned by a clock behind the other writers', is retried after it.
+        """
+        if not api_settings.wallet_ledger_enabled:
+            await transact_write_items(build_items(None))
+            return
+
+        after_position = None
+        for attempt in range(LEDGER_POSITION_ATTEMPTS):
+            ledger_position = LedgerService.new_position(after_position)
+            transact_items = build_items(ledger_position)
+            try:
+                await transact_write_items(transact_items)
+                return
+            except ClientError as error:
+                if error.response["Error"]["Code"] != "TransactionCanceledException":
+                    raise
+                failed_items = [
+                    "Update" in item for item, reason in zip(transact_items, error.response.get("CancellationReasons", []))
+                    if reason.get("Code") not in (None, "None")
+                ]
+                # Only a wallet update that failed on its own may have failed on the position
+                if failed_items != [True] or attempt == LEDGER_POSITION_ATTEMPTS - 1:
+                    raise
+                latest_position = await LedgerService.latest_position(user_id)
+                if latest_position is None or latest_position < ledger_position:
+                    # The balance condition failed
+                    raise
+                after_position = latest_position
+
+    @staticmethod
+    def _begin_write(user_id: str):
+        WalletService.wallet_cache.begin_write(user_id)
+        WalletService.version_index.begin_write(user_id)
+
+    @staticmethod
+    def _end_write(user_id: str, item: Optional[dict]):
+        """
+        Refreshes the wallet cache and version index with the item
+        returned by a write, or drops their entries if there is none
+        """
+        if item is None:
+            WalletService.wallet_cache.end_write(user_id, None)
+            WalletService.version_index.end_write(user_id, None)
+            return
+        WalletService.wallet_cache.end_write(user_id, {key: item[key] for key in WALLET_ATTRIBUTES if key in item})
+        WalletService.version_index.end_write(
+            user_id, {key: item[key] for key in VERSION_INDEX_ATTRIBUTES if key in item}
+        )
+
+    @staticmethod
+    def _condition_failure() -> ClientError:
+        """
+        Reports a transaction cancelled by a balance condition like a failed
+        update_item, so callers handle both the same way
+        """
+        return ClientError(
+            {"Error": {"Code": "ConditionalCheckFailedException", "Message": "The conditional request failed"}},
+            "TransactWriteItems",
+        )
+
+    @staticmethod
+    async def _modify_balance(user_id: str, balance_changes: Dict[str, Decimal]):
+        """
+        Helper function that will directly modify a user's currency holdings,
+        every change is applied in a single atomic update
+        """
+        if api_settings.wallet_ledger_enabled:
+            await WalletService._modify_balance_with_ledger(user_id, balance_changes)
+            return
+
+        query_args = WalletService._build_balance_update(user_id, balance_changes)
+        # The updated item is used to refresh the wallet cache
+        query_args["ReturnValues"] = "ALL_NEW"
+
+        WalletService._begin_write(user_id)
+        try:
+            response = await async_wallets_table.update_item(**query_args)
+        except BaseException:
+            WalletService._end_write(user_id, None)
+            raise
+
+        WalletService._end_write(user_id, response["Attributes"])
 
-        wallets_table.update_item(**query_args)
+    @staticmethod
+    async def _modify_balance_with_ledger(user_id: str, balance_changes: Dict[str, Decimal]):
+        """
+        Applies the changes and appends their ledger entry in one transaction
+        """
+        WalletService._begin_write(user_id)
+        try:
+            await WalletService._transact_in_ledger_order(
+                user_id,
+                lambda ledger_position: WalletService._build_balance_transaction(
+                    user_id, balance_changes, ledger_position
+                ),
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] != "TransactionCanceledException":
+                raise
+            reasons = error.response.get("CancellationReasons", [])
+            if any(reason.get("Code") == "ConditionalCheckFailed" for reason in reasons):
+                raise WalletService._condition_failure() from error
+            raise
+        finally:
+            # A transaction doesn't return the updated item, so the cached one is dropped
+            WalletService._end_write(user_id, None)
+
+    @staticmethod
+    async def _modify_balance_idempotently(
+            user_id: str,
+            balance_changes: Dict[str, Decimal],
+            idempotency_key: str,
+    ) -> Optional[IdempotencyRecord]:
+        """
+        Applies the changes at most once per idempotency key and returns the
+        stored record if they had already been applied. Keys are scoped to the
+        user, and reusing one for different changes raises IdempotencyKeyReused.
+        """
+        scoped_key = f"{user_id}#{idempotency_key}"
+        fingerprint = fingerprint_balance_changes(balance_changes)
+
+        record = WalletService.idempotency_store.get(scoped_key)
+        replayed = record is not None
+        if record is None:
+            # Duplicates arriving while the first request is
+            # still being written wait for its outcome
+            (record, applied), ran_here = await WalletService.idempotency_store.single_flight(
+                scoped_key,
+                lambda: WalletService._write_idempotently(user_id, scoped_key, fingerprint, balance_changes),
+            )
+            replayed = not (ran_here and applied)
+
+        if record.fingerprint != fingerprint:
+            raise IdempotencyKeyReused("Idempotency key was already used for a different request")
+        return record if replayed else None
 
     @staticmethod
-    def _fetch_raw_wallet(user_id: str):
+    async def _write_idempotently(
+            user_id: str,
+            scoped_key: str,
+            fingerprint: str,
+            balance_changes: Dict[str, Decimal],
+    ) -> Tuple[IdempotencyRecord, bool]:
         """
-        Retrieves raw wallet information from dynamodb
+        Writes the idempotency record and the balance changes in one
+        transaction, or reads the record left by an earlier request.
+        Returns the record and whether the changes were applied now.
         """
-        wallet_data = wallets_table.get_item(
-            Key={
-                "user_id": user_id
+        now = int(time.time())
+        record = IdempotencyRecord(fingerprint, 200, now + api_settings.idempotency_key_ttl)
+        key_item = {
+            "Put": {
+                "TableName": async_idempotency_table.name,
+                "Item": {
+                    "idempotency_key": scoped_key,
+                    "user_id": user_id,
+                    "fingerprint": record.fingerprint,
+                    "status_code": record.status_code,
+                    # Used as the table's TTL attribute, DynamoDB deletes expired
+                    # keys lazily so the condition also accepts expired records
+                    "expires_at": record.expires_at,
+                },
+                "ConditionExpression": "attribute_not_exists(idempotency_key) OR expires_at < :now",
+                "ExpressionAttributeValues": {":now": now},
             },
-            ProjectionExpression="balances, local_currency, user_id"
+        }
+
+        def build_items(ledger_position: Optional[str]) -> List[dict]:
+            if not balance_changes:
+                return [key_item]
+            return [key_item, *WalletService._build_balance_transaction(user_id, balance_changes, ledger_position)]
+
+        WalletService._begin_write(user_id)
+        try:
+            await WalletService._transact_in_ledger_order(user_id, build_items)
+        except ClientError as error:
+            if error.response["Error"]["Code"] != "TransactionCanceledException":
+                raise
+            key_reason, *wallet_reasons = error.response.get("CancellationReasons", [])
+            if key_reason.get("Code") == "ConditionalCheckFailed":
+                record = await WalletService._read_idempotency_record(scoped_key)
+                if record is None:
+                    raise
+                WalletService.idempotency_store.set(scoped_key, record)
+                return record, False
+            if any(reason.get("Code") == "ConditionalCheckFailed" for reason in wallet_reasons):
+                raise WalletService._condition_failure() from error
+            raise
+        finally:
+            # A transaction doesn't return the updated item, so the cached one is dropped
+            WalletService._end_write(user_id, None)
+
+        WalletService.idempotency_store.set(scoped_key, record)
+        return record, True
+
+    @staticmethod
+    async def _read_idempotency_record(scoped_key: str) -> Optional[IdempotencyRecord]:
+        response = await async_idempotency_table.get_item(
+            Key={"idempotency_key": scoped_key},
+            ConsistentRead=True,
         )
+        item = response.get("Item")
+        if item is None:
+            return None
+        return IdempotencyRecord(item["fingerprint"], int(item["status_code"]), int(item["expires_at"]))
+
+    @staticmethod
+    def _wallet_version(data: dict):
+        """
+        Hashable summary of everything a wallet conversion depends on
+        """
+        return data.get("local_currency"), tuple(sorted(data["balances"].items()))
+
+    @staticmethod
+    async def _fetch_raw_wallets(user_ids: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        Retrieves up to BATCH_GET_SIZE raw wallets with BatchGetItem,
+        keys that DynamoDB leaves unprocessed are retried with backoff
+        """
+        items = dict.fromkeys(user_ids)
+        request = {
+            "Keys": [{"user_id": user_id} for user_id in user_ids],
+            "ProjectionExpression": ", ".join(WALLET_ATTRIBUTES),
+        }
+
+        for attempt in range(api_settings.batch_get_max_retries + 1):
+            if attempt:
+                await asyncio.sleep(random.uniform(0, api_settings.batch_get_retry_backoff * 2 ** attempt))
+
+            response = await async_wallets_table.batch_get_item(request)
+            for item in response["Responses"].get(async_wallets_table.name, []):
+                items[item["user_id"]] = item
+
+            request = response.get("UnprocessedKeys", {}).get(async_wallets_table.name)
+            if not request:
+                return items
+
+        raise RuntimeError(f"DynamoDB left {len(request['Keys'])} wallet keys unprocessed")
+
+    @staticmethod
+    async def _fetch_raw_wallet(user_id: str):
+        """
+        Retrieves raw wallet information from the wallet cache or dynamodb
+        """
+        with metrics.stage_duration.time("wallet_read"):
+            cached_item = WalletService.wallet_cache.get(user_id)
+            if cached_item is not None:
+                return cached_item
+
+            read_marker = WalletService.wallet_cache.read_marker()
+            index_read_marker = WalletService.version_index.read_marker()
+            wallet_data = await async_wallets_table.get_item(
+                Key={
+                    "user_id": user_id
+                },
+                ProjectionExpression=", ".join(WALLET_ATTRIBUTES)
+            )
+
+            item = wallet_data["Item"]
+            WalletService.wallet_cache.set_read(user_id, item, read_marker)
+            WalletService.version_index.set_read(
+                user_id, {key: item[key] for key in VERSION_INDEX_ATTRIBUTES if key in item}, index_read_marker
+            )
+            return item
+
 
-        return wallet_data["Item"]
+metrics.registry.add_cache("wallet", lambda: WalletService.wallet_cache)
+metrics.registry.add_cache("converted_wallet", lambda: WalletService.converted_wallet_cache)
+metrics.registry.add_cache("wallet_version_index", lambda: WalletService.version_index)
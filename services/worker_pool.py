@@ -0,0 +1,44 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from fastapi import HTTPException, status
+
+
+class BoundedWorkerPool:
+    """
+    Thread pool for CPU-heavy work that would otherwise block the event loop.
+
+    At most `max_workers` jobs run at once and `max_queue` more may wait for a
+    worker. Anything beyond that is rejected straight away with a 503, so a
+    burst of expensive requests can't pile up and starve the rest of the API.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, name: str):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    @property
+    def is_saturated(self) -> bool:
+        return self.pending >= self.max_workers + self.max_queue
+
+    async def run(self, func: Callable, *args):
+        if self.is_saturated:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please retry later",
+                headers={"Retry-After": "1"},
+            )
+
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
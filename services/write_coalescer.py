@@ -0,0 +1,142 @@
+import asyncio
+from decimal import Decimal
+from typing import Awaitable, Callable, Dict, Hashable, List, Set, Tuple
+
+from botocore.exceptions import ClientError
+
+
+class _PendingChange:
+
+    __slots__ = ("amount", "future")
+
+    def __init__(self, amount: Decimal, future: asyncio.Future):
+        self.amount = amount
+        self.future = future
+
+
+class WriteCoalescer:
+    """
+    Merges balance changes to the same wallet currency into fewer writes.
+
+    Changes submitted for a (user_id, currency) pair within `window` seconds
+    of the first one are summed and applied with a single write, or sooner
+    once `max_batch` changes are waiting. Every caller waits until the write
+    carrying its change has committed.
+
+    As with batch updates, the non-negative guard is checked against the
+    net change. If the merged write is rejected, the additions are applied
+    together and then every subtraction is tried on its own, in the order it
+    was submitted. Only callers whose own subtraction can't be covered get
+    the ConditionalCheckFailedException.
+    """
+
+    def __init__(
+            self,
+            write: Callable[[str, Dict[str, Decimal]], Awaitable],
+            window: float,
+            max_batch: int,
+    ):
+        self._write = write
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: Dict[Hashable, List[_PendingChange]] = {}
+        # References to running flushes so they aren't garbage collected
+        self._flushes: Set[asyncio.Task] = set()
+        self.submitted = 0
+        self.writes = 0
+
+    async def submit(self, user_id: str, currency_code: str, amount: Decimal):
+        loop = asyncio.get_running_loop()
+        # Futures can only be resolved from their own event loop
+        key = (loop, user_id, currency_code)
+        change = _PendingChange(amount, loop.create_future())
+        self.submitted += 1
+
+        pending_changes = self._pending.get(key)
+        if pending_changes is None:
+            pending_changes = self._pending[key] = [change]
+            self._start(loop, self._flush_after_window(key, pending_changes))
+        else:
+            pending_changes.append(change)
+            if len(pending_changes) >= self.max_batch:
+                self._take(key, pending_changes)
+                self._start(loop, self._flush(user_id, currency_code, pending_changes))
+
+        await change.future
+
+    def _start(self, loop: asyncio.AbstractEventLoop, flush: Awaitable):
+        task = loop.create_task(flush)
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    def _take(self, key: Hashable, pending_changes: List[_PendingChange]) -> bool:
+        """
+        Removes a batch from the pending batches, returns False if it was already taken
+        """
+        if self._pending.get(key) is not pending_changes:
+            return False
+        del self._pending[key]
+        return True
+
+    async def _flush_after_window(self, key: Tuple, pending_changes: List[_PendingChange]):
+        await asyncio.sleep(self.window)
+        if self._take(key, pending_changes):
+            _, user_id, currency_code = key
+            await self._flush(user_id, currency_code, pending_changes)
+
+    async def _flush(self, user_id: str, currency_code: str, pending_changes: List[_PendingChange]):
+        net_amount = sum((change.amount for change in pending_changes), Decimal(0))
+
+        try:
+            if net_amount != 0:
+                await self._apply(user_id, currency_code, net_amount)
+        except ClientError as error:
+            if not self._is_condition_failure(error) or len(pending_changes) == 1:
+                self._resolve(pending_changes, error)
+                return
+            await self._flush_one_by_one(user_id, currency_code, pending_changes)
+            return
+        except Exception as error:
+            self._resolve(pending_changes, error)
+            return
+
+        self._resolve(pending_changes)
+
+    async def _flush_one_by_one(self, user_id: str, currency_code: str, pending_changes: List[_PendingChange]):
+        additions = [change for change in pending_changes if change.amount > 0]
+        subtractions = [change for change in pending_changes if change.amount < 0]
+
+        if additions:
+            try:
+                await self._apply(user_id, currency_code, sum(change.amount for change in additions))
+            except Exception as error:
+                self._resolve(pending_changes, error)
+                return
+            self._resolve(additions)
+
+        for change in subtractions:
+            try:
+                await self._apply(user_id, currency_code, change.amount)
+            except Exception as error:
+                self._resolve([change], error)
+            else:
+                self._resolve([change])
+
+    async def _apply(self, user_id: str, currency_code: str, amount: Decimal):
+        self.writes += 1
+        await self._write(user_id, {currency_code: amount})
+
+    @staticmethod
+    def _is_condition_failure(error: ClientError) -> bool:
+        return error.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+    @staticmethod
+    def _resolve(changes: List[_PendingChange], error: Exception = None):
+        for change in changes:
+            # A caller that gave up waiting has a cancelled future
+            if change.future.done():
+                continue
+            if error is None:
+                change.future.set_result(None)
+            else:
+                change.future.set_exception(error)
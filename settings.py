@@ -1,15 +1,106 @@
+from typing import Dict, List, Optional
+
 from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
     nbp_api_url: str = "https://api.nbp.pl/api"
     nbp_api_conversion_endpoint: str = "exchangerates/rates/c/%s?format=json"
+    nbp_api_table_endpoint: str = "exchangerates/tables/c?format=json"
+    nbp_api_mode: str = "table"
+    # NBP serves tables for at most this many days per date range request
+    nbp_api_table_range_endpoint: str = "exchangerates/tables/c/%s/%s?format=json"
+    nbp_api_max_range_days: int = 93
+    # Local SQLite store of historical rates, also used to warm the rate cache after a
+    # restart. Relative to the directory the API is started from, current rates are
+    # fetched from NBP as usual when the store can't be opened.
+    rate_store_path: str = "exchange_rates.sqlite3"
+    # A rate "as of" a date comes from a table published at most this many days before it
+    rate_store_lookback_days: int = 7
+    # Shared HTTP client used by the exchange rate clients, timeouts are in seconds
+    exchange_rate_connect_timeout: float = 2.0
+    exchange_rate_read_timeout: float = 5.0
+    exchange_rate_max_connections: int = 10
+    exchange_rate_max_retries: int = 2
+    exchange_rate_retry_backoff: float = 0.1
+    exchange_rate_circuit_failure_threshold: int = 5
+    exchange_rate_circuit_reset_timeout: float = 30.0
     aws_region: str = "us-east-1"
     cache_ttl: int = 60
+    # Expired rates are still served for this many seconds while being refreshed
+    cache_stale_grace: int = 30
+    # Cached rates are refreshed in the background this many seconds before expiring
+    cache_refresh_ahead: int = 5
+    # Directory of the rate cache shared by the worker processes on a host,
+    # e.g. a tmpfs such as /dev/shm. Each process has its own cache if unset.
+    shared_rate_cache_dir: Optional[str] = None
+    # Logins beyond workers + queue size are rejected with a 503
+    password_hashing_workers: int = 2
+    password_hashing_queue_size: int = 16
+    verified_token_cache_size: int = 10000
+    # Per-process cache of user records read by logins. Usernames that don't exist
+    # are cached for user_cache_negative_ttl seconds, changes made by other
+    # processes are only seen once an entry expires.
+    user_cache_enabled: bool = True
+    user_cache_size: int = 10000
+    user_cache_ttl: int = 30
+    user_cache_negative_ttl: int = 10
     jwt_secret_key_name: str = "JWT_SECRET_KEY"
+    # The signing key is fetched on first use and then again every this many seconds
+    jwt_secret_refresh_interval: float = 300
     environment: str = "LOCAL"
     wallets_table_name: str = "user_wallets"
     users_table_name: str = "user_data"
+    idempotency_table_name: str = "wallet_idempotency_keys"
+    # Idempotency keys are remembered for this many seconds, recently
+    # used keys are also kept in memory to skip DynamoDB for hot duplicates
+    idempotency_key_ttl: int = 86400
+    idempotency_cache_size: int = 10000
+    # Appends every wallet change to the ledger table, in the same transaction
+    # as the update, so balances can be read at a point in time
+    wallet_ledger_enabled: bool = False
+    ledger_table_name: str = "wallet_ledger"
+    # Compaction snapshots a wallet once it has this many entries since its latest snapshot
+    ledger_snapshot_interval: int = 100
+    # Per-process cache of wallet items, writes from other
+    # processes are only seen once an entry expires
+    wallet_cache_enabled: bool = False
+    wallet_cache_size: int = 10000
+    wallet_cache_ttl: int = 5
+    # Per-process index of wallet versions, lets conditional wallet reads be
+    # answered with a 304 without reading DynamoDB. Like the wallet cache,
+    # writes from other processes are only seen once an entry expires.
+    wallet_version_index_enabled: bool = False
+    wallet_version_index_size: int = 100000
+    wallet_version_index_ttl: int = 5
+    # Merges add/subtract calls to the same wallet currency that arrive
+    # within the window (in seconds) into a single DynamoDB write
+    write_coalescing_enabled: bool = False
+    write_coalescing_window: float = 0.005
+    write_coalescing_max_batch: int = 100
+    # Bulk wallet reads, see WalletService.get_wallets
+    bulk_read_concurrency: int = 4
+    batch_get_max_retries: int = 5
+    batch_get_retry_backoff: float = 0.05
+    # Users allowed to call the back-office endpoints
+    admin_user_ids: List[str] = []
+    # Sheds load with fast 429/503 responses, see services/admission_control.py. The
+    # concurrency limit adapts to keep requests within admission_target_latency
+    # seconds, and each user may send user_rate_limit requests per second on average.
+    admission_control_enabled: bool = False
+    admission_initial_limit: int = 64
+    admission_min_limit: int = 4
+    admission_max_limit: int = 512
+    admission_target_latency: float = 0.25
+    # Concurrency limits of single routes, keyed by "METHOD /path/template"
+    admission_route_limits: Dict[str, int] = {"POST /token": 32, "POST /admin/wallets": 2}
+    user_rate_limit: float = 20
+    user_rate_limit_burst: int = 40
+    user_rate_limit_size: int = 100000
+    # Request, stage latency, cache and DynamoDB metrics served on /metrics
+    metrics_enabled: bool = True
+    converted_wallet_cache_enabled: bool = True
+    converted_wallet_cache_size: int = 10000
 
 
 
@@ -1,23 +1,143 @@
 from fastapi.testclient import TestClient
 
-from test.fixtures.util import set_fake_aws_credentials
+from test.fixtures.util import FakeClock, set_fake_aws_credentials
 
 from moto import mock_aws
 
 import pytest
 
-from test.fixtures.create_database_resources import create_users_table, create_wallets_table
+from settings import api_settings
+
+from test.fixtures.create_database_resources import (
+    create_idempotency_table, create_ledger_table, create_users_table, create_wallets_table
+)
+from test.fixtures.nbp_stub import NBPStubServer
+
+from clients.exchange_rates.base import BaseExchangeRateClient
+from clients.exchange_rates.http import CircuitBreaker, HTTPClientMetrics
+from clients.exchange_rates.nbp_client import NBPExchangeRateClient, NBPTableExchangeRateClient
 
 
 @pytest.fixture
 def aws_credentials():
    set_fake_aws_credentials()
 
+@pytest.fixture
+def nbp_stub(monkeypatch):
+    server = NBPStubServer().start()
+    monkeypatch.setattr(api_settings, "nbp_api_url", server.api_url)
+    yield server
+    server.stop()
+
+@pytest.fixture(autouse=True)
+def rate_store(monkeypatch, tmp_path):
+    """
+    Gives every test an empty local rate store
+    """
+    monkeypatch.setattr(api_settings, "rate_store_path", str(tmp_path / "exchange_rates.sqlite3"))
+    return NBPExchangeRateClient.get_rate_store()
+
+@pytest.fixture
+def exchange_rate_http(monkeypatch):
+    """
+    Gives the exchange rate clients a fresh circuit
+    breaker and metrics, and retries without waiting
+    """
+    monkeypatch.setattr(api_settings, "exchange_rate_retry_backoff", 0)
+    monkeypatch.setattr(BaseExchangeRateClient, "http_metrics", HTTPClientMetrics())
+    monkeypatch.setattr(BaseExchangeRateClient, "_circuit_breaker", CircuitBreaker(
+        failure_threshold=api_settings.exchange_rate_circuit_failure_threshold,
+        reset_timeout=api_settings.exchange_rate_circuit_reset_timeout,
+    ))
+    return BaseExchangeRateClient
+
+@pytest.fixture
+def cold_rate_cache():
+    NBPExchangeRateClient._rate_cache.clear()
+    NBPTableExchangeRateClient._rate_cache.clear()
+
+@pytest.fixture
+def wallet_cache(monkeypatch):
+    from services.wallet_cache import WalletCache
+    from services.wallet_service import WalletService
+
+    cache = WalletCache(maxsize=api_settings.wallet_cache_size, ttl=api_settings.wallet_cache_ttl)
+    monkeypatch.setattr(api_settings, "wallet_cache_enabled", True)
+    monkeypatch.setattr(WalletService, "wallet_cache", cache)
+    return cache
+
+@pytest.fixture
+def wallet_version_index(monkeypatch):
+    from services.wallet_cache import WalletVersionIndex
+    from services.wallet_service import WalletService
+
+    index = WalletVersionIndex(maxsize=100, ttl=api_settings.wallet_version_index_ttl)
+    monkeypatch.setattr(api_settings, "wallet_version_index_enabled", True)
+    monkeypatch.setattr(WalletService, "version_index", index)
+    return index
+
+@pytest.fixture
+def converted_wallet_cache(monkeypatch):
+    from services.wallet_cache import ConvertedWalletCache
+    from services.wallet_service import WalletService
+
+    cache = ConvertedWalletCache(maxsize=api_settings.converted_wallet_cache_size)
+    monkeypatch.setattr(WalletService, "converted_wallet_cache", cache)
+    return cache
+
+@pytest.fixture
+def user_cache_clock():
+    return FakeClock()
+
+@pytest.fixture
+def user_cache(monkeypatch, user_cache_clock):
+    from services import auth_service
+    from services.user_cache import UserRecordCache
+
+    cache = UserRecordCache(maxsize=100, ttl=api_settings.user_cache_ttl, negative_ttl=1, clock=user_cache_clock)
+    monkeypatch.setattr(api_settings, "user_cache_enabled", True)
+    monkeypatch.setattr(auth_service, "user_cache", cache)
+    return cache
+
+@pytest.fixture
+def admission_control(monkeypatch):
+    from services import admission_control
+    from services.admission_control import AdmissionController
+
+    monkeypatch.setattr(api_settings, "admission_control_enabled", True)
+    controller = AdmissionController()
+    monkeypatch.setattr(admission_control, "admission_controller", controller)
+    return controller
+
+@pytest.fixture
+def idempotency_store(monkeypatch):
+    from services.idempotency import IdempotencyStore
+    from services.wallet_service import WalletService
+
+    store = IdempotencyStore(maxsize=api_settings.idempotency_cache_size, ttl=api_settings.idempotency_key_ttl)
+    monkeypatch.setattr(WalletService, "idempotency_store", store)
+    return store
+
+@pytest.fixture
+def metrics_registry():
+    import metrics
+
+    metrics.registry.clear()
+    yield metrics.registry
+    metrics.registry.clear()
+
+@pytest.fixture
+def wallet_ledger(monkeypatch):
+    monkeypatch.setattr(api_settings, "wallet_ledger_enabled", True)
+    monkeypatch.setattr(api_settings, "ledger_snapshot_interval", 5)
+
 @pytest.fixture()
-def mocked_aws(aws_credentials):
+def mocked_aws(aws_credentials, nbp_stub):
     with mock_aws():
         from main import app
         create_users_table()
         create_wallets_table()
+        create_idempotency_table()
+        create_ledger_table()
         yield TestClient(app)
 
@@ -0,0 +1,45 @@
+# Table C rates served by the stubbed NBP API,
+# values are taken from a real NBP response.
+DEFAULT_EXCHANGE_RATES = {
+    "JPY": {"currency": "jen (Japonia)", "bid": 0.025, "ask": 0.0255},
+    "EUR": {"currency": "euro", "bid": 4.2294, "ask": 4.3148},
+    "USD": {"currency": "dolar amerykański", "bid": 3.6664, "ask": 3.7404},
+}
+
+EFFECTIVE_DATE = "2025-06-13"
+
+# Table C rates served by the stubbed NBP date range endpoint, keyed by effective
+# date. Sample values around the start of 2025, with no tables on the weekend
+# of 4-5 January and on the 1st and 6th which are public holidays in Poland.
+HISTORICAL_EXCHANGE_RATES = {
+    "2024-12-30": {
+        "JPY": {"currency": "jen (Japonia)", "bid": 0.02571, "ask": 0.02623},
+        "EUR": {"currency": "euro", "bid": 4.2306, "ask": 4.3160},
+        "USD": {"currency": "dolar amerykański", "bid": 4.0553, "ask": 4.1373},
+    },
+    "2024-12-31": {
+        "JPY": {"currency": "jen (Japonia)", "bid": 0.02584, "ask": 0.02636},
+        "EUR": {"currency": "euro", "bid": 4.2307, "ask": 4.3161},
+        "USD": {"currency": "dolar amerykański", "bid": 4.0502, "ask": 4.1320},
+    },
+    "2025-01-02": {
+        "JPY": {"currency": "jen (Japonia)", "bid": 0.02590, "ask": 0.02642},
+        "EUR": {"currency": "euro", "bid": 4.2214, "ask": 4.3066},
+        "USD": {"currency": "dolar amerykański", "bid": 4.0644, "ask": 4.1466},
+    },
+    "2025-01-03": {
+        "JPY": {"currency": "jen (Japonia)", "bid": 0.02611, "ask": 0.02663},
+        "EUR": {"currency": "euro", "bid": 4.2212, "ask": 4.3064},
+        "USD": {"currency": "dolar amerykański", "bid": 4.1019, "ask": 4.1847},
+    },
+    "2025-01-07": {
+        "JPY": {"currency": "jen (Japonia)", "bid": 0.02568, "ask": 0.02620},
+        "EUR": {"currency": "euro", "bid": 4.2175, "ask": 4.3027},
+        "USD": {"currency": "dolar amerykański", "bid": 4.0413, "ask": 4.1229},
+    },
+    "2025-01-08": {
+        "JPY": {"currency": "jen (Japonia)", "bid": 0.02574, "ask": 0.02626},
+        "EUR": {"currency": "euro", "bid": 4.2136, "ask": 4.2988},
+        "USD": {"currency": "dolar amerykański", "bid": 4.0757, "ask": 4.1581},
+    },
+}
@@ -1,3 +1,5 @@
+import uuid
+
 import boto3
 from settings import api_settings
 
@@ -63,3 +65,81 @@ def create_users_table():
         users_table = dynamo_resource.Table(api_settings.users_table_name)
 
         users_table.put_item(Item=DEFAULT_USER_RECORD)
+
+def create_extra_wallets(count: int) -> list:
+    """
+    Adds `count` wallets for random users and returns their user ids
+    """
+    _, dynamo_resource, _ = get_db_resources()
+    wallets_table = dynamo_resource.Table(api_settings.wallets_table_name)
+    user_ids = [str(uuid.uuid4()) for _ in range(count)]
+
+    with wallets_table.batch_writer() as batch:
+        for index, user_id in enumerate(user_ids):
+            batch.put_item(Item={
+                **DEFAULT_WALLET_DATA,
+                "user_id": user_id,
+                "balances": {"JPY": index, "USD": 1, "EUR": 2},
+            })
+
+    return user_ids
+
+def create_idempotency_table():
+    dynamo_client, _, tables = get_db_resources()
+
+    if api_settings.idempotency_table_name not in tables:
+        dynamo_client.create_table(
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'idempotency_key',
+                    'AttributeType': 'S'
+                },
+            ],
+            TableName=api_settings.idempotency_table_name,
+            KeySchema=[
+                {
+                    'AttributeName': 'idempotency_key',
+                    'KeyType': 'HASH'
+                },
+            ],
+            BillingMode='PAY_PER_REQUEST',
+            TableClass='STANDARD'
+        )
+
+        dynamo_client.update_time_to_live(
+            TableName=api_settings.idempotency_table_name,
+            TimeToLiveSpecification={
+                'Enabled': True,
+                'AttributeName': 'expires_at'
+            }
+        )
+
+def create_ledger_table():
+    dynamo_client, _, tables = get_db_resources()
+
+    if api_settings.ledger_table_name not in tables:
+        dynamo_client.create_table(
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'user_id',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'entry_key',
+                    'AttributeType': 'S'
+                },
+            ],
+            TableName=api_settings.ledger_table_name,
+            KeySchema=[
+                {
+                    'AttributeName': 'user_id',
+                    'KeyType': 'HASH'
+                },
+                {
+                    'AttributeName': 'entry_key',
+                    'KeyType': 'RANGE'
+                },
+            ],
+            BillingMode='PAY_PER_REQUEST',
+            TableClass='STANDARD'
+        )
@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from test.data.exchange_rates import DEFAULT_EXCHANGE_RATES, EFFECTIVE_DATE, HISTORICAL_EXCHANGE_RATES
+
+# Longest date range the NBP API accepts
+MAX_RANGE_DAYS = 93
+
+
+# Small HTTP server that imitates the parts of the NBP API we use,
+# so that tests and benchmarks don't depend on api.nbp.pl being reachable.
+
+class NBPStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, rates=None, delay: float = 0.0, history=None):
+        super().__init__(("127.0.0.1", 0), NBPStubRequestHandler)
+        self.rates = rates if rates is not None else DEFAULT_EXCHANGE_RATES
+        # Tables served by the date range endpoint, keyed by effective date
+        self.history = history if history is not None else HISTORICAL_EXCHANGE_RATES
+        self.delay = delay
+        # Number of upcoming requests that should get a 500 response
+        self.failures_remaining = 0
+        self.request_paths = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/api"
+
+    @property
+    def request_count(self) -> int:
+        return len(self.request_paths)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class NBPStubRequestHandler(BaseHTTPRequestHandler):
+
+    # Keeps connections open between requests like the real API does
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server: NBPStubServer = self.server
+        with server._lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            self._handle()
+        finally:
+            with server._lock:
+                server.in_flight -= 1
+
+    def _handle(self):
+        server: NBPStubServer = self.server
+        path = self.path.split("?")[0].rstrip("/")
+        server.request_paths.append(path)
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        if server.failures_remaining:
+            server.failures_remaining -= 1
+            return self._respond(500, "500 InternalServerError")
+
+        parts = path.split("/")
+        # /api/exchangerates/rates/c/{code}
+        if parts[2:5] == ["exchangerates", "rates", "c"] and len(parts) == 6:
+            code = parts[5].upper()
+            if code not in server.rates:
+                return self._respond(404, "404 NotFound - Not Found - Brak danych")
+            rate = server.rates[code]
+            return self._respond(200, {
+                "table": "C",
+                "currency": rate["currency"],
+                "code": code,
+                "rates": [{
+                    "no": "113/C/NBP/2025",
+                    "effectiveDate": EFFECTIVE_DATE,
+                    "bid": rate["bid"],
+                    "ask": rate["ask"],
+                }],
+            })
+
+        # /api/exchangerates/tables/c
+        if parts[2:] == ["exchangerates", "tables", "c"]:
+            return self._respond(200, [{
+                "table": "C",
+                "no": "113/C/NBP/2025",
+                "tradingDate": EFFECTIVE_DATE,
+                "effectiveDate": EFFECTIVE_DATE,
+                "rates": [
+                    {"currency": rate["currency"], "code": code, "bid": rate["bid"], "ask": rate["ask"]}
+                    for code, rate in server.rates.items()
+                ],
+            }])
+
+        # /api/exchangerates/tables/c/{startDate}/{endDate}
+        if parts[2:5] == ["exchangerates", "tables", "c"] and len(parts) == 7:
+            start, end = date.fromisoformat(parts[5]), date.fromisoformat(parts[6])
+            if (end - start).days >= MAX_RANGE_DAYS:
+                return self._respond(400, "400 BadRequest - Przekroczony limit 93 dni / Limit of 93 days has been exceeded")
+            tables = [
+                {
+                    "table": "C",
+                    "no": f"{index + 1:03d}/C/NBP/{effective_date[:4]}",
+                    "tradingDate": effective_date,
+                    "effectiveDate": effective_date,
+                    "rates": [
+                        {"currency": rate["currency"], "code": code, "bid": rate["bid"], "ask": rate["ask"]}
+                        for code, rate in rates.items()
+                    ],
+                }
+                for index, (effective_date, rates) in enumerate(sorted(server.history.items()))
+                if start.isoformat() <= effective_date <= end.isoformat()
+            ]
+            if not tables:
+                return self._respond(404, "404 NotFound - Not Found - Brak danych")
+            return self._respond(200, tables)
+
+        return self._respond(400, "400 BadRequest - Bad Request")
+
+    def _respond(self, status_code: int, body):
+        payload = json.dumps(body).encode() if not isinstance(body, str) else body.encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json" if not isinstance(body, str) else "text/plain")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,154 @@
+import time
+
+import pytest
+
+from test.data.users import DEFAULT_USER_RECORD
+
+from services.admission_control import AdaptiveConcurrencyLimit, TokenBuckets
+
+
+@pytest.fixture
+def headers(mocked_aws):
+    from services.auth_service import AuthService
+
+    token = AuthService.create_access_token(data={"sub": DEFAULT_USER_RECORD["user_id"]})
+    return {"Authorization": f"Bearer {token.access_token}"}
+
+
+class TestTokenBuckets:
+
+    def test_burst_then_refill(self, monkeypatch):
+        """
+        Ensure that a key can spend its burst straight away
+        and then gets one token back per 1 / rate seconds
+        """
+        now = 1000.0
+        monkeypatch.setattr(time, "monotonic", lambda: now)
+        buckets = TokenBuckets(rate=2, burst=3, maxsize=10)
+
+        assert [buckets.take("user") for _ in range(3)] == [0, 0, 0]
+        assert buckets.take("user") == pytest.approx(0.5)
+        assert buckets.take("other-user") == 0
+
+        now += 0.5
+
+        assert buckets.take("user") == 0
+        assert buckets.take("user") == pytest.approx(0.5)
+
+
+class TestAdaptiveConcurrencyLimit:
+
+    def test_increases_while_fast_and_used(self):
+        """
+        Check that the limit grows additively while requests
+        are fast and at least half of it is in use
+        """
+        limit = AdaptiveConcurrencyLimit(initial_limit=4, min_limit=1, max_limit=5, target_latency=0.1)
+
+        for _ in range(3):
+            assert limit.try_acquire()
+        limit.release(0.01)
+
+        assert limit.limit == 4.25
+
+        limit.release(0.01)
+        limit.release(0.01)
+
+        assert limit.limit == 4.25
+        assert limit.in_flight == 0
+
+    def test_decreases_once_per_window(self, monkeypatch):
+        """
+        Verify that slow or failed requests cut the limit multiplicatively,
+        once per target latency, and never below the minimum
+        """
+        now = 1000.0
+        monkeypatch.setattr(time, "monotonic", lambda: now)
+        limit = AdaptiveConcurrencyLimit(initial_limit=10, min_limit=8, max_limit=20, target_latency=0.1, backoff=0.5)
+
+        for _ in range(3):
+            limit.try_acquire()
+        limit.release(0.5)
+        limit.release(0.01, overloaded=True)
+
+        assert limit.limit == 8
+
+        now += 1
+        limit.release(None)
+
+        assert limit.limit == 8
+        assert limit.in_flight == 0
+
+    def test_share(self):
+        """
+        Ensure that a priority can only use its share of the limit
+        """
+        limit = AdaptiveConcurrencyLimit(initial_limit=4, min_limit=1, max_limit=5, target_latency=0.1)
+
+        assert limit.try_acquire(share=0.5)
+        assert limit.try_acquire(share=0.5)
+        assert not limit.try_acquire(share=0.5)
+        assert limit.try_acquire()
+
+
+class TestAdmissionControlMiddleware:
+
+    def test_user_rate_limit(self, mocked_aws, admission_control, headers):
+        """
+        Check that a user who runs out of tokens gets a fast
+        429 with a Retry-After header, other users are unaffected
+        """
+        admission_control.user_buckets = TokenBuckets(rate=0.5, burst=2, maxsize=10)
+
+        statuses = [mocked_aws.get("/wallet/original", headers=headers).status_code for _ in range(3)]
+
+        assert statuses == [200, 200, 429]
+        res = mocked_aws.get("/wallet/original", headers=headers)
+        assert res.headers["Retry-After"] == "2"
+        assert res.json() == {"detail": "Too many requests, please retry later"}
+        assert mocked_aws.get("/wallet/original").status_code == 401
+
+    def test_priorities(self, mocked_aws, admission_control, headers):
+        """
+        Ensure that wallet reads are still served once conversions
+        and logins are shed, while the limit is nearly used up
+        """
+        admission_control.limit.limit = 10
+        admission_control.limit.in_flight = 8
+
+        assert mocked_aws.get("/wallet/original", headers=headers).status_code == 200
+        assert mocked_aws.get("/wallet", headers=headers).status_code == 200
+
+        admission_control.limit.in_flight = 9
+
+        assert mocked_aws.get("/wallet/original", headers=headers).status_code == 200
+        res = mocked_aws.get("/wallet", headers=headers)
+        assert res.status_code == 503
+        assert res.headers["Retry-After"] == "1"
+        assert mocked_aws.post("/token", data={"username": "pjauvin", "password": "supermariobros"}).status_code == 503
+        assert admission_control.limit.in_flight == 9
+
+    def test_route_limit(self, mocked_aws, admission_control, metrics_registry):
+        """
+        Verify that a route at its concurrency limit is rejected,
+        that the rejection is counted and /metrics is never limited
+        """
+        admission_control.route_limits["POST /token"] = 1
+        admission_control.route_in_flight["POST /token"] = 1
+        admission_control.limit.limit = admission_control.limit.in_flight = 0
+
+        res = mocked_aws.post("/token", data={"username": "pjauvin", "password": "supermariobros"})
+        metrics = mocked_aws.get("/metrics").text.splitlines()
+
+        assert res.status_code == 503
+        assert 'admission_rejections_total{route="POST /token",reason="route_limit"} 1' in metrics
+        assert 'http_requests_total{method="POST",route="/token",status="503"} 1' in metrics
+
+    def test_disabled(self, mocked_aws, admission_control, headers, monkeypatch):
+        """
+        Check that nothing is limited while admission control is off
+        """
+        monkeypatch.setattr("settings.api_settings.admission_control_enabled", False)
+        admission_control.limit.limit = admission_control.limit.in_flight = 0
+
+        assert mocked_aws.get("/wallet", headers=headers).status_code == 200
@@ -1,8 +1,14 @@
+import json
 import os
+from datetime import datetime, timezone
 
 import pytest
 
+from test.data.exchange_rates import DEFAULT_EXCHANGE_RATES
 from test.data.wallets import DEFAULT_WALLET_DATA
+from test.fixtures.create_database_resources import create_extra_wallets
+
+from settings import api_settings
 
 from models.wallet import CommonWalletData, ClientWallet
 
@@ -117,6 +123,31 @@ class TestAPI:
 
         assert res.status_code == 401
 
+    def test_wallet_response_schema(self, mocked_aws, login):
+        """
+        Wallets are returned as pre-serialized JSON, check that the
+        documented schema and the content type are unaffected
+        """
+        schema = mocked_aws.get("/openapi.json").json()
+        response_schemas = {
+            path: schema["paths"][path]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+            for path in ("/wallet", "/wallet/original", "/wallet/history")
+        }
+
+        assert response_schemas == {
+            "/wallet": {"$ref": "#/components/schemas/ClientWallet"},
+            "/wallet/original": {"$ref": "#/components/schemas/CommonWalletData"},
+            "/wallet/history": {"$ref": "#/components/schemas/CommonWalletData"},
+        }
+
+        res = mocked_aws.get(
+            url="/wallet/original",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.headers["content-type"] == "application/json"
+        assert res.json() == {"balances": DEFAULT_WALLET_DATA["balances"]}
+
     def test_add_balance(self, mocked_aws, login):
         """
         Ensure that the user can add to a particular
@@ -234,6 +265,27 @@ class TestAPI:
 
         assert response["balances"]["USD"] ==  target_value
 
+    def test_subtract_balance_failed_write(self, mocked_aws, login, monkeypatch):
+        """
+        Check that a write that failed for another reason than the
+        balance isn't answered with a 200, so the client retries it
+        """
+        from botocore.exceptions import ClientError
+
+        from services.wallet_service import WalletService
+
+        async def conflicting_subtract(*args):
+            raise ClientError({"Error": {"Code": "TransactionCanceledException"}}, "TransactWriteItems")
+
+        monkeypatch.setattr(WalletService, "subtract_from_wallet", conflicting_subtract)
+
+        # The test client raises the errors that the API answers with a 500
+        with pytest.raises(ClientError):
+            mocked_aws.post(
+                url="/wallet/subtract/USD/5",
+                headers={'Authorization': f"Bearer {login["access_token"]}", "Idempotency-Key": "retry-me"}
+            )
+
     def test_subtract_balance_negative(self, mocked_aws, login):
         """
         Verify that an invalid value can't be
@@ -281,3 +333,483 @@ class TestAPI:
         assert response["balances"]["USD"] ==  target_value
 
 
+    def test_retrieve_wallet_conversion(self, mocked_aws, login, cold_rate_cache):
+        """
+        Check that every balance is converted with its own rate
+        and rounded before being added to the total
+        """
+        res = mocked_aws.get(
+            url="/wallet",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        response = res.json()
+
+        expected_total = 0
+        for currency, balance in DEFAULT_WALLET_DATA["balances"].items():
+            expected_balance = round(balance * DEFAULT_EXCHANGE_RATES[currency]["ask"], 2)
+            assert response["balances"][currency] == expected_balance
+            expected_total += expected_balance
+
+        assert response["total"] == round(expected_total, 2)
+
+    def test_retrieve_wallet_fetches_rates_concurrently(self, mocked_aws, login, nbp_stub, cold_rate_cache, monkeypatch):
+        """
+        Ensure that missing exchange rates are
+        requested at the same time rather than one by one
+        """
+        monkeypatch.setattr(api_settings, "nbp_api_mode", "rates")
+        nbp_stub.delay = 0.2
+
+        res = mocked_aws.get(
+            url="/wallet",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.status_code == 200
+        assert nbp_stub.max_in_flight == len(DEFAULT_WALLET_DATA["balances"])
+
+    def test_retrieve_wallet_single_table_request(self, mocked_aws, login, nbp_stub, cold_rate_cache):
+        """
+        Ensure that a cold cache is filled
+        with a single request to the NBP table endpoint
+        """
+        res = mocked_aws.get(
+            url="/wallet",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.status_code == 200
+        assert nbp_stub.request_paths == ["/api/exchangerates/tables/c"]
+
+    def test_batch_update(self, mocked_aws, login):
+        """
+        Ensure that several currencies can be
+        changed with a single request
+        """
+        res = mocked_aws.post(
+            url="/wallet/batch",
+            json={"changes": [
+                {"currency": "JPY", "amount": "100"},
+                {"currency": "USD", "amount": "-5"},
+                {"currency": "EUR", "amount": "-100"},
+            ]},
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.status_code == 200
+
+        res = mocked_aws.get(
+            url="/wallet/original",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        response = res.json()
+
+        assert response["balances"]["JPY"] == DEFAULT_WALLET_DATA["balances"]["JPY"] + 100
+        assert response["balances"]["USD"] == DEFAULT_WALLET_DATA["balances"]["USD"] - 5
+        assert response["balances"]["EUR"] == 0
+
+    def test_batch_update_too_big(self, mocked_aws, login):
+        """
+        Ensure that a batch where one subtraction would leave a
+        negative balance is rejected without applying any change
+        """
+        res = mocked_aws.post(
+            url="/wallet/batch",
+            json={"changes": [
+                {"currency": "JPY", "amount": "100"},
+                {"currency": "USD", "amount": "-1"},
+                {"currency": "EUR", "amount": "-500"},
+            ]},
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.status_code == 400
+
+        res = mocked_aws.get(
+            url="/wallet/original",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.json()["balances"] == DEFAULT_WALLET_DATA["balances"]
+
+    def test_batch_update_net_change(self, mocked_aws, login):
+        """
+        Check that changes to the same currency are combined
+        and the non-negative guard applies to their sum
+        """
+        res = mocked_aws.post(
+            url="/wallet/batch",
+            json={"changes": [
+                {"currency": "USD", "amount": "10"},
+                {"currency": "USD", "amount": "-25"},
+            ]},
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.status_code == 200
+
+        res = mocked_aws.post(
+            url="/wallet/batch",
+            json={"changes": [
+                {"currency": "USD", "amount": "1"},
+                {"currency": "USD", "amount": "-7"},
+            ]},
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.status_code == 400
+
+        res = mocked_aws.get(
+            url="/wallet/original",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.json()["balances"]["USD"] == DEFAULT_WALLET_DATA["balances"]["USD"] - 15
+
+    def test_batch_update_invalid(self, mocked_aws, login):
+        """
+        Verify that empty batches and zero
+        amounts are rejected
+        """
+        for changes in ([], [{"currency": "USD", "amount": "0"}], [{"currency": "GBP", "amount": "1"}]):
+            res = mocked_aws.post(
+                url="/wallet/batch",
+                json={"changes": changes},
+                headers={'Authorization': f"Bearer {login["access_token"]}"}
+            )
+
+            assert res.status_code == 422
+
+    def test_batch_update_authorisation(self, mocked_aws, login):
+        """
+        Ensure that a batch can only be
+        applied with the correct authorisation
+        """
+        res = mocked_aws.post(
+            url="/wallet/batch",
+            json={"changes": [{"currency": "USD", "amount": "1"}]},
+            headers={'Authorization': f"Bearer zooweemama"}
+        )
+
+        assert res.status_code == 401
+
+    def test_bulk_wallets(self, mocked_aws, login, monkeypatch):
+        """
+        Check that back-office users can read many
+        wallets at once as NDJSON
+        """
+        monkeypatch.setattr(api_settings, "admin_user_ids", [DEFAULT_WALLET_DATA["user_id"]])
+        user_ids = create_extra_wallets(250)
+        missing_user_id = "00000000-0000-4000-8000-000000000000"
+
+        res = mocked_aws.post(
+            url="/admin/wallets",
+            json={"user_ids": [*user_ids, DEFAULT_WALLET_DATA["user_id"], missing_user_id]},
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.status_code == 200
+        assert res.headers["content-type"] == "application/x-ndjson"
+
+        wallets = {line["user_id"]: line["wallet"] for line in map(json.loads, res.text.splitlines())}
+
+        assert len(wallets) == 252
+        assert wallets[missing_user_id] is None
+        assert wallets[DEFAULT_WALLET_DATA["user_id"]] == {"balances": DEFAULT_WALLET_DATA["balances"]}
+        assert wallets[user_ids[7]]["balances"]["JPY"] == 7
+
+    def test_bulk_wallets_converted(self, mocked_aws, login, monkeypatch):
+        """
+        Check that bulk wallets can be converted to local currency
+        """
+        monkeypatch.setattr(api_settings, "admin_user_ids", [DEFAULT_WALLET_DATA["user_id"]])
+
+        res = mocked_aws.post(
+            url="/admin/wallets?convert=true",
+            json={"user_ids": [DEFAULT_WALLET_DATA["user_id"]]},
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        bulk_wallet = json.loads(res.text)["wallet"]
+
+        res = mocked_aws.get(
+            url="/wallet",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert bulk_wallet == res.json()
+
+    def test_bulk_wallets_authorisation(self, mocked_aws, login):
+        """
+        Ensure that only back-office users
+        can read other users' wallets
+        """
+        res = mocked_aws.post(
+            url="/admin/wallets",
+            json={"user_ids": [DEFAULT_WALLET_DATA["user_id"]]},
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.status_code == 403
+
+    def test_add_balance_idempotent(self, mocked_aws, login, idempotency_store):
+        """
+        Ensure that a retried request with the same
+        idempotency key is only applied once
+        """
+        headers = {
+            'Authorization': f"Bearer {login["access_token"]}",
+            'Idempotency-Key': "0d6f4c1e-add",
+        }
+
+        first = mocked_aws.post(url="/wallet/add/JPY/100", headers=headers)
+        retry = mocked_aws.post(url="/wallet/add/JPY/100", headers=headers)
+
+        assert first.status_code == 200
+        assert "Idempotent-Replayed" not in first.headers
+        assert retry.status_code == 200
+        assert retry.headers["Idempotent-Replayed"] == "true"
+
+        res = mocked_aws.get(
+            url="/wallet/original",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.json()["balances"]["JPY"] == DEFAULT_WALLET_DATA["balances"]["JPY"] + 100
+
+    def test_idempotency_key_reused(self, mocked_aws, login, idempotency_store):
+        """
+        Check that an idempotency key can't be
+        reused for a different request
+        """
+        headers = {
+            'Authorization': f"Bearer {login["access_token"]}",
+            'Idempotency-Key': "0d6f4c1e-reused",
+        }
+
+        res = mocked_aws.post(url="/wallet/subtract/USD/5", headers=headers)
+
+        assert res.status_code == 200
+
+        res = mocked_aws.post(url="/wallet/subtract/USD/6", headers=headers)
+
+        assert res.status_code == 422
+
+        res = mocked_aws.post(
+            url="/wallet/batch",
+            json={"changes": [{"currency": "USD", "amount": "-5"}]},
+            headers=headers,
+        )
+
+        # The same net change is the same request, whichever route it came through
+        assert res.status_code == 200
+        assert res.headers["Idempotent-Replayed"] == "true"
+
+    def test_wallet_history(self, mocked_aws, login, wallet_ledger):
+        """
+        Check that the wallet can be read as it was before a change
+        was made, but not from before the ledger's first entry
+        """
+        headers = {'Authorization': f"Bearer {login["access_token"]}"}
+        before_ledger = datetime.now(timezone.utc).isoformat()
+
+        assert mocked_aws.post(url="/wallet/add/USD/5", headers=headers).status_code == 200
+        before_change = datetime.now(timezone.utc).isoformat()
+        assert mocked_aws.post(url="/wallet/add/USD/1", headers=headers).status_code == 200
+
+        res = mocked_aws.get(url="/wallet/history", params={"at": before_change}, headers=headers)
+
+        assert res.json()["balances"]["USD"] == DEFAULT_WALLET_DATA["balances"]["USD"] + 5
+
+        res = mocked_aws.get(url="/wallet/history", params={"at": before_ledger}, headers=headers)
+
+        assert res.status_code == 404
+        assert res.json() == {"detail": "Wallet history not found for the given time"}
+
+    def test_wallet_history_disabled(self, mocked_aws, login):
+        """
+        Ensure that wallet history isn't served from
+        the current balances when the ledger is off
+        """
+        res = mocked_aws.get(
+            url="/wallet/history",
+            params={"at": datetime.now(timezone.utc).isoformat()},
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+
+        assert res.status_code == 404
+        assert res.json() == {"detail": "Wallet history is not enabled"}
+
+    def test_wallet_etag_after_balance_changes(self, mocked_aws, login):
+        """
+        Ensure that a wallet read with the current ETag is answered with
+        a 304, and that adding or subtracting gives the wallet a new ETag
+        """
+        headers = {'Authorization': f"Bearer {login["access_token"]}"}
+
+        res = mocked_aws.get(url="/wallet/original", headers=headers)
+        etag = res.headers["ETag"]
+
+        res = mocked_aws.get(url="/wallet/original", headers={**headers, 'If-None-Match': etag})
+
+        assert res.status_code == 304
+        assert res.headers["ETag"] == etag
+        assert res.content == b""
+
+        etags = [etag]
+        for path in ("/wallet/add/JPY/100", "/wallet/subtract/JPY/50"):
+            assert mocked_aws.post(url=path, headers=headers).status_code == 200
+
+            res = mocked_aws.get(url="/wallet/original", headers={**headers, 'If-None-Match': etag})
+
+            assert res.status_code == 200
+            assert res.headers["ETag"] not in etags
+            etag = res.headers["ETag"]
+            etags.append(etag)
+
+        assert res.json()["balances"]["JPY"] == DEFAULT_WALLET_DATA["balances"]["JPY"] + 50
+
+    def test_wallet_etag_with_ledger(self, mocked_aws, login, wallet_ledger, wallet_version_index):
+        """
+        Check that changes written in a transaction with their
+        ledger entry give the wallet a new ETag too
+        """
+        headers = {'Authorization': f"Bearer {login["access_token"]}"}
+        etag = mocked_aws.get(url="/wallet/original", headers=headers).headers["ETag"]
+
+        assert mocked_aws.post(url="/wallet/add/USD/5", headers=headers).status_code == 200
+
+        res = mocked_aws.get(url="/wallet/original", headers={**headers, 'If-None-Match': etag})
+
+        assert res.status_code == 200
+        assert res.headers["ETag"] != etag
+
+    def test_wallet_etag_after_rate_refresh(self, mocked_aws, login, cold_rate_cache):
+        """
+        Verify that the ETag of the converted wallet changes when
+        the exchange rates are reloaded, while the original one doesn't
+        """
+        from clients.exchange_rates.nbp_client import NBPTableExchangeRateClient
+
+        headers = {'Authorization': f"Bearer {login["access_token"]}"}
+        etag = mocked_aws.get(url="/wallet", headers=headers).headers["ETag"]
+        original_etag = mocked_aws.get(url="/wallet/original", headers=headers).headers["ETag"]
+
+        assert etag != original_etag
+        assert mocked_aws.get(url="/wallet", headers={**headers, 'If-None-Match': etag}).status_code == 304
+
+        NBPTableExchangeRateClient._rate_cache.clear()
+
+        res = mocked_aws.get(url="/wallet", headers={**headers, 'If-None-Match': etag})
+
+        assert res.status_code == 200
+        assert res.headers["ETag"] != etag
+        ClientWallet.model_validate(res.json())
+        res = mocked_aws.get(url="/wallet/original", headers={**headers, 'If-None-Match': original_etag})
+        assert res.status_code == 304
+
+    @pytest.mark.parametrize("use_version_index", [False, True])
+    def test_wallet_after_rates_expire(
+            self, mocked_aws, nbp_stub, login, cold_rate_cache, tmp_path, monkeypatch, request, use_version_index
+    ):
+        """
+        Check that a memoized conversion, or a 304 from the version index,
+        isn't served once the rates it was computed from have expired
+        """
+        from clients.exchange_rates.nbp_client import NBPTableExchangeRateClient
+        from test.fixtures.util import FakeClock
+
+        if use_version_index:
+            request.getfixturevalue("wallet_version_index")
+        clock = FakeClock()
+        monkeypatch.setattr(NBPTableExchangeRateClient._rate_cache, "_clock", clock)
+
+        headers = {'Authorization': f"Bearer {login["access_token"]}"}
+        res = mocked_aws.get(url="/wallet", headers=headers)
+        etag = res.headers["ETag"]
+        assert mocked_aws.get(url="/wallet", headers={**headers, 'If-None-Match': etag}).status_code == 304
+
+        nbp_stub.rates = {code: {**rate, "ask": rate["ask"] * 2} for code, rate in DEFAULT_EXCHANGE_RATES.items()}
+        # Today's table would otherwise be read back from the rate store
+        monkeypatch.setattr(api_settings, "rate_store_path", str(tmp_path / "new_rates.sqlite3"))
+        clock.now += api_settings.cache_ttl + api_settings.cache_stale_grace
+
+        new_res = mocked_aws.get(url="/wallet", headers={**headers, 'If-None-Match': etag})
+
+        assert new_res.status_code == 200
+        # The rates are reloaded during the read, so the new wallet may not get an ETag at all
+        assert new_res.headers.get("ETag") != etag
+        assert new_res.json()["total"] != res.json()["total"]
+
+    def test_wallet_not_modified_from_version_index(self, mocked_aws, login, cold_rate_cache, wallet_version_index):
+        """
+        Ensure that a conditional read of an unchanged wallet is answered
+        from the version index, without reading the wallet from DynamoDB
+        """
+        import metrics
+
+        headers = {'Authorization': f"Bearer {login["access_token"]}"}
+        etag = mocked_aws.get(url="/wallet", headers=headers).headers["ETag"]
+        reads = metrics.dynamodb_request_duration.count(api_settings.wallets_table_name, "GetItem")
+
+        res = mocked_aws.get(url="/wallet", headers={**headers, 'If-None-Match': f'"other", W/{etag}'})
+
+        assert res.status_code == 304
+        assert wallet_version_index.hits == 1
+
+        # The index is updated with the version returned by the write
+        assert mocked_aws.post(url="/wallet/add/JPY/100", headers=headers).status_code == 200
+        res = mocked_aws.get(url="/wallet", headers={**headers, 'If-None-Match': etag})
+        assert res.status_code == 200
+        etag = res.headers["ETag"]
+
+        assert mocked_aws.get(url="/wallet", headers={**headers, 'If-None-Match': etag}).status_code == 304
+        assert metrics.dynamodb_request_duration.count(api_settings.wallets_table_name, "GetItem") == reads + 1
+
+    def test_metrics(self, mocked_aws, login, metrics_registry, exchange_rate_http, cold_rate_cache, converted_wallet_cache):
+        """
+        Check that wallet requests show up on the metrics endpoint
+        with their route, stages and DynamoDB usage
+        """
+        for _ in range(3):
+            res = mocked_aws.get(
+                url="/wallet",
+                headers={'Authorization': f"Bearer {login["access_token"]}"}
+            )
+            assert res.status_code == 200
+
+        res = mocked_aws.post(
+            url="/wallet/subtract/USD/500",
+            headers={'Authorization': f"Bearer {login["access_token"]}"}
+        )
+        assert res.status_code == 400
+
+        res = mocked_aws.get(url="/metrics")
+
+        assert res.status_code == 200
+        assert res.headers["content-type"].startswith("text/plain")
+        samples = res.text.splitlines()
+
+        assert 'http_requests_total{method="GET",route="/wallet",status="200"} 3' in samples
+        assert 'http_requests_total{method="POST",route="/wallet/subtract/{currency_code}/{balance}",status="400"} 1' in samples
+        # Every read goes through the rate cache, loading rates into a cold cache
+        # keeps their epoch, so the later conversions are served from the cache
+        for stage, count in (
+                ("jwt_decode", 4), ("wallet_read", 3), ("exchange_rates", 3), ("conversion", 1), ("serialization", 3)
+        ):
+            assert f'request_stage_duration_seconds_count{{stage="{stage}"}} {count}' in samples
+        assert 'dynamodb_request_duration_seconds_count{table="user_wallets",operation="GetItem"} 3' in samples
+        assert 'dynamodb_consumed_capacity_units_total{table="user_wallets",operation="GetItem"} 1.5' in samples
+        assert (
+            'dynamodb_errors_total{table="user_wallets",operation="UpdateItem",code="ConditionalCheckFailedException"} 1'
+            in samples
+        )
+        assert 'cache_hits_total{cache="converted_wallet"} 2' in samples
+        assert 'cache_misses_total{cache="converted_wallet"} 1' in samples
+        assert f'cache_hit_ratio{{cache="converted_wallet"}} {2 / 3!r}' in samples
+        assert 'exchange_rate_upstream_requests_total 1' in samples
+        assert 'exchange_rate_upstream_connections_opened_total 1' in samples
+        assert 'exchange_rate_upstream_pool_hit_ratio 0' in samples
+        assert '/metrics' not in mocked_aws.get("/openapi.json").json()["paths"]
@@ -0,0 +1,384 @@
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+from passlib.hash import bcrypt
+
+from settings import api_settings
+
+from test.data.users import DEFAULT_USER_RECORD
+
+from clients.aws import SecretProvider
+from clients.exchange_rates.base import BaseExchangeRateClient
+
+from models.auth import UserData
+
+from services.auth_service import AuthService
+from services.token_cache import VerifiedTokenCache
+from services.worker_pool import BoundedWorkerPool
+
+
+class TestBoundedWorkerPool:
+
+    def test_rejects_when_saturated(self):
+        """
+        Ensure that jobs beyond the worker and queue
+        limits are rejected instead of waiting
+        """
+        pool = BoundedWorkerPool(max_workers=1, max_queue=1, name="test")
+        release = threading.Event()
+
+        async def run():
+            running = asyncio.gather(pool.run(release.wait), pool.run(release.wait))
+            await asyncio.sleep(0)
+
+            with pytest.raises(HTTPException) as error:
+                await pool.run(release.wait)
+
+            release.set()
+            await running
+            return error.value
+
+        error = asyncio.run(run())
+        pool.shutdown()
+
+        assert error.status_code == 503
+        assert pool.rejected == 1
+        assert pool.pending == 0
+
+    def test_runs_off_event_loop(self):
+        """
+        Check that jobs run on the pool's
+        threads rather than the event loop's
+        """
+        pool = BoundedWorkerPool(max_workers=1, max_queue=0, name="test")
+
+        thread_name = asyncio.run(pool.run(lambda: threading.current_thread().name))
+        pool.shutdown()
+
+        assert thread_name.startswith("test")
+
+
+class TestAuthService:
+
+    def test_login_rejected_when_saturated(self, mocked_aws, monkeypatch):
+        """
+        Verify that logins get a fast 503 while
+        every password hashing worker is busy
+        """
+        from services.auth_service import password_hashing_pool
+
+        monkeypatch.setattr(password_hashing_pool, "pending", password_hashing_pool.max_workers + password_hashing_pool.max_queue)
+
+        res = mocked_aws.post(
+            url="/token",
+            data={
+                "username": "pjauvin",
+                "password": "supermariobros",
+                "grant_type": "password"
+            },
+            headers={'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+
+        assert res.status_code == 503
+        assert "access_token" not in res.json()
+
+    @staticmethod
+    def login(client, username="pjauvin", password="supermariobros"):
+        return client.post(
+            url="/token",
+            data={
+                "username": username,
+                "password": password,
+                "grant_type": "password"
+            },
+            headers={'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+
+    @staticmethod
+    def count_user_reads(monkeypatch):
+        from services import auth_service
+
+        reads = []
+        get_item = auth_service.async_users_table.get_item
+
+        async def counting_get_item(**kwargs):
+            reads.append(kwargs["Key"]["username"])
+            return await get_item(**kwargs)
+
+        monkeypatch.setattr(auth_service.async_users_table, "get_item", counting_get_item)
+        return reads
+
+    def test_unknown_username_cached(self, mocked_aws, user_cache, monkeypatch):
+        """
+        Ensure that unknown usernames get a 401 from a cached
+        lookup and are still checked against a password hash
+        """
+        from services import auth_service
+
+        reads = self.count_user_reads(monkeypatch)
+        verified_hashes = []
+        verify = auth_service.pwd_context.verify
+
+        def counting_verify(password, hashed_password):
+            verified_hashes.append(hashed_password)
+            return verify(password, hashed_password)
+
+        monkeypatch.setattr(auth_service.pwd_context, "verify", counting_verify)
+
+        for _ in range(3):
+            assert self.login(mocked_aws, username="mallory").status_code == 401
+
+        assert reads == ["mallory"]
+        assert verified_hashes == [auth_service.DUMMY_PASSWORD_HASH] * 3
+        assert user_cache.hits == 2
+
+    def test_user_cache_hit(self, mocked_aws, user_cache, monkeypatch):
+        """
+        Check that repeated logins of the same
+        user read their record from DynamoDB once
+        """
+        reads = self.count_user_reads(monkeypatch)
+
+        for _ in range(2):
+            assert self.login(mocked_aws).status_code == 200
+
+        assert reads == ["pjauvin"]
+
+    def test_saved_user_replaces_cached_record(self, mocked_aws, user_cache):
+        """
+        Verify that a password changed through this process
+        applies to the very next login
+        """
+        assert self.login(mocked_aws).status_code == 200
+
+        user = UserData(**{**DEFAULT_USER_RECORD, "hashed_password": bcrypt.using(rounds=4).hash("luigi")})
+        asyncio.run(AuthService.save_user(user))
+
+        assert self.login(mocked_aws).status_code == 401
+        assert self.login(mocked_aws, password="luigi").status_code == 200
+
+    def test_user_changed_by_another_process(self, mocked_aws, user_cache, user_cache_clock, monkeypatch):
+        """
+        Ensure that a password changed elsewhere applies once the cached
+        record expires, and that failed logins don't read DynamoDB again
+        """
+        from clients.aws import users_table
+
+        reads = self.count_user_reads(monkeypatch)
+        assert self.login(mocked_aws).status_code == 200
+
+        users_table.put_item(Item={**DEFAULT_USER_RECORD, "hashed_password": bcrypt.using(rounds=4).hash("luigi")})
+
+        assert self.login(mocked_aws, password="luigi").status_code == 401
+        assert reads == ["pjauvin"]
+
+        user_cache_clock.now += api_settings.user_cache_ttl
+
+        assert self.login(mocked_aws, password="luigi").status_code == 200
+        assert self.login(mocked_aws).status_code == 401
+        assert reads == ["pjauvin"] * 2
+
+    def test_missing_username_invalidated(self, mocked_aws, user_cache, user_cache_clock):
+        """
+        Check that a username cached as missing can log in once
+        it is created here, or once the entry expires if created elsewhere
+        """
+        from clients.aws import users_table
+
+        hashed_password = bcrypt.using(rounds=4).hash("luigi")
+        for username in ("luigi", "peach"):
+            assert self.login(mocked_aws, username=username, password="luigi").status_code == 401
+
+        asyncio.run(AuthService.save_user(UserData(user_id="luigi-id", username="luigi", hashed_password=hashed_password)))
+        users_table.put_item(Item={"user_id": "peach-id", "username": "peach", "hashed_password": hashed_password})
+
+        assert self.login(mocked_aws, username="luigi", password="luigi").status_code == 200
+        assert self.login(mocked_aws, username="peach", password="luigi").status_code == 401
+
+        user_cache_clock.now += 1
+
+        assert self.login(mocked_aws, username="peach", password="luigi").status_code == 200
+
+    def test_verified_token_cache(self, aws_credentials, monkeypatch):
+        """
+        Ensure that a token is only decoded the first
+        time it is used and cached afterwards
+        """
+        from services import auth_service
+        from services.auth_service import AuthService
+
+        decode_calls = []
+        decode = auth_service.jwt.decode
+
+        def counting_decode(*args, **kwargs):
+            decode_calls.append(args[0])
+            return decode(*args, **kwargs)
+
+        monkeypatch.setattr(auth_service.jwt, "decode", counting_decode)
+        monkeypatch.setattr(auth_service, "verified_token_cache", VerifiedTokenCache(maxsize=10))
+        token = AuthService.create_access_token(data={"sub": DEFAULT_USER_RECORD["user_id"]}).access_token
+
+        for _ in range(5):
+            assert asyncio.run(AuthService.get_user_id(token)) == DEFAULT_USER_RECORD["user_id"]
+
+        assert len(decode_calls) == 1
+        assert auth_service.verified_token_cache.hits == 4
+
+    def test_verified_token_cache_expiry(self, monkeypatch):
+        """
+        Check that a cached token is evicted
+        once it reaches its expiry time
+        """
+        cache = VerifiedTokenCache(maxsize=10)
+        cache.set("token", "key", "user", expires_at=time.time() + 60)
+
+        assert cache.get("token", "key") == "user"
+
+        monkeypatch.setattr(time, "time", lambda: 10 ** 12)
+
+        assert cache.get("token", "key") is None
+        assert len(cache._cache) == 0
+
+    def test_verified_token_cache_key_rotation(self):
+        """
+        Verify that rotating the signing key
+        clears every cached token
+        """
+        cache = VerifiedTokenCache(maxsize=10)
+        cache.set("token", "old-key", "user", expires_at=time.time() + 60)
+
+        assert cache.get("token", "new-key") is None
+
+        assert cache.get("token", "old-key") is None
+
+
+class RotatingSecretsClient:
+
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        if self.value is None:
+            raise RuntimeError("Secrets Manager is unavailable")
+        return {"SecretString": self.value}
+
+
+class TestSecretProvider:
+
+    def test_fetched_on_first_use(self):
+        """
+        Ensure that the secret is only fetched
+        when it is first used and then kept
+        """
+        client = RotatingSecretsClient("first-key")
+        provider = SecretProvider(client, "JWT_SECRET_KEY", refresh_interval=60)
+
+        assert client.calls == 0
+        assert provider.get() == "first-key"
+        assert provider.get() == "first-key"
+        assert client.calls == 1
+
+    def test_loaded_before_serving(self, mocked_aws, monkeypatch):
+        """
+        Ensure that the API fetches the secret when it starts,
+        so that no request waits on Secrets Manager
+        """
+        from fastapi.testclient import TestClient
+
+        import main
+        from services import auth_service
+
+        client = RotatingSecretsClient("first-key")
+        provider = SecretProvider(client, "JWT_SECRET_KEY", refresh_interval=60)
+        monkeypatch.setattr(main, "jwt_secret", provider)
+        monkeypatch.setattr(auth_service, "jwt_secret", provider)
+        # Shutting down closes the shared HTTP client, which may belong to another test's event loop
+        monkeypatch.setattr(BaseExchangeRateClient, "_http_client", None)
+
+        with TestClient(main.app) as test_client:
+            assert client.calls == 1
+            response = test_client.post("/token", data={"username": "pjauvin", "password": "supermariobros"})
+            token = response.json()["access_token"]
+            assert test_client.get("/wallet/original", headers={"Authorization": f"Bearer {token}"}).status_code == 200
+
+        assert client.calls == 1
+
+    def test_refresher_picks_up_rotation(self):
+        """
+        Check that the background refresher picks up a rotated
+        secret and keeps the current one when a refresh fails
+        """
+        client = RotatingSecretsClient("first-key")
+        provider = SecretProvider(client, "JWT_SECRET_KEY", refresh_interval=0.01)
+
+        async def run():
+            provider.start_refresher()
+            await asyncio.sleep(0.05)
+            first = provider.get()
+            client.value = "second-key"
+            await asyncio.sleep(0.05)
+            second = provider.get()
+            client.value = None
+            await asyncio.sleep(0.05)
+            failed = provider.get()
+            await provider.stop_refresher()
+            return first, second, failed
+
+        assert asyncio.run(run()) == ("first-key", "second-key", "second-key")
+
+    def test_rotation_invalidates_tokens(self, aws_credentials, monkeypatch):
+        """
+        Verify that tokens signed with the previous
+        key are rejected once the key is rotated
+        """
+        from services import auth_service
+        from services.auth_service import AuthService
+
+        client = RotatingSecretsClient("first-key")
+        monkeypatch.setattr(auth_service, "jwt_secret", SecretProvider(client, "JWT_SECRET_KEY", refresh_interval=60))
+        monkeypatch.setattr(auth_service, "verified_token_cache", VerifiedTokenCache(maxsize=10))
+        token = AuthService.create_access_token(data={"sub": DEFAULT_USER_RECORD["user_id"]}).access_token
+
+        assert asyncio.run(AuthService.get_user_id(token)) == DEFAULT_USER_RECORD["user_id"]
+
+        client.value = "second-key"
+        auth_service.jwt_secret.refresh()
+
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(AuthService.get_user_id(token))
+
+        assert error.value.status_code == 401
+        assert len(auth_service.verified_token_cache._cache) == 0
+
+    def test_import_has_no_side_effects(self):
+        """
+        Ensure that the API can be imported without AWS
+        configuration and without building any AWS client
+        """
+        env = {
+            key: value for key, value in os.environ.items()
+            if not key.startswith("AWS_")
+        }
+        env["ENVIRONMENT"] = "PROD"
+        script = (
+            "import main\n"
+            "from clients.aws import dynamo, secrets_manager\n"
+            "clients = [dynamo.dynamo_client, dynamo.dynamo_resource, dynamo.wallets_table, dynamo.users_table,\n"
+            "           dynamo.idempotency_table, dynamo.ledger_table, secrets_manager.secrets_client]\n"
+            "assert not any(client.is_built for client in clients)\n"
+        )
+
+        result = subprocess.run(
+            [sys.executable, "-c", script], env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, timeout=60
+        )
+
+        assert result.returncode == 0, result.stderr
@@ -0,0 +1,106 @@
+import random
+from decimal import Decimal, ROUND_HALF_EVEN, localcontext
+
+import pytest
+
+from services.currency_conversion import ConversionEngine
+
+from models.wallet import Currency
+
+CURRENCIES = ["EUR", "USD", "JPY"]
+CENT = Decimal("0.01")
+
+
+def reference_convert(balances: dict, exchange_rates: dict) -> tuple:
+    """
+    Straightforward Decimal implementation of the conversion rules, in minor units
+    """
+    with localcontext() as context:
+        # Enough digits for the product of any two DynamoDB numbers to be exact
+        context.prec = 100
+        converted_balances = {
+            currency: int(
+                (Decimal(balance) * Decimal(repr(exchange_rates[currency])))
+                .quantize(CENT, rounding=ROUND_HALF_EVEN)
+                .scaleb(2)
+            )
+            for currency, balance in balances.items()
+        }
+    return converted_balances, sum(converted_balances.values())
+
+
+def random_wallets(seed: int, count: int) -> list:
+    rng = random.Random(seed)
+    return [
+        {
+            currency: Decimal(rng.randint(0, 10 ** rng.randint(1, 30))).scaleb(-rng.randint(0, 10))
+            for currency in rng.sample(CURRENCIES, rng.randint(1, len(CURRENCIES)))
+        }
+        for _ in range(count)
+    ]
+
+
+def random_rates(seed: int) -> dict:
+    rng = random.Random(seed)
+    # Rates are published as floats with up to 6 decimals
+    return {currency: round(rng.uniform(0.001, 10), rng.randint(1, 6)) for currency in CURRENCIES}
+
+
+class TestConversionEngine:
+
+    @pytest.mark.parametrize("seed", range(20))
+    def test_matches_decimal_reference(self, seed):
+        exchange_rates = random_rates(seed)
+        engine = ConversionEngine(exchange_rates)
+
+        for balances in random_wallets(seed, 200):
+            assert engine.convert(balances) == reference_convert(balances, exchange_rates)
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_convert_many_matches_convert(self, seed):
+        engine = ConversionEngine(random_rates(seed))
+        wallets = random_wallets(seed, 500)
+
+        assert engine.convert_many(wallets) == [engine.convert(balances) for balances in wallets]
+
+    def test_ties_round_to_even(self):
+        engine = ConversionEngine({"EUR": 0.5, "USD": 0.5})
+
+        # 0.025 and 0.035 are exact ties, which a float product would not round reliably
+        assert engine.convert({"EUR": Decimal("0.05")}) == ({"EUR": 2}, 2)
+        assert engine.convert({"USD": Decimal("0.07")}) == ({"USD": 4}, 4)
+        assert engine.convert({"EUR": Decimal("0.0500001")}) == ({"EUR": 3}, 3)
+        assert engine.convert({"EUR": Decimal("-0.05")}) == ({"EUR": -2}, -2)
+        assert engine.convert({"USD": Decimal("-0.07")}) == ({"USD": -4}, -4)
+
+    def test_total_is_sum_of_rounded_balances(self):
+        engine = ConversionEngine({"EUR": 1, "USD": 1, "JPY": 1})
+
+        # Each balance rounds down, rounding the exact total instead would give 0.02
+        converted_balances, total = engine.convert({"EUR": Decimal("0.004"), "USD": Decimal("0.004"), "JPY": Decimal("0.004")})
+
+        assert converted_balances == {"EUR": 0, "USD": 0, "JPY": 0}
+        assert total == 0
+
+    def test_float_rates_are_read_as_published(self):
+        # 4.3148 can't be represented exactly as a float
+        engine = ConversionEngine({"EUR": 4.3148})
+
+        assert engine.convert({"EUR": Decimal("0.125")}) == ({"EUR": 54}, 54)
+        assert engine.convert({"EUR": Decimal("1000000000000")}) == ({"EUR": 431480000000000}, 431480000000000)
+
+    def test_enum_currencies(self):
+        engine = ConversionEngine({Currency.EUR: 2})
+
+        assert engine.convert({Currency.EUR: Decimal(1)}) == ({"EUR": 200}, 200)
+        assert engine.convert({"EUR": Decimal(1)}) == ({"EUR": 200}, 200)
+
+    def test_unknown_currency(self):
+        engine = ConversionEngine({"EUR": 2})
+
+        with pytest.raises(KeyError):
+            engine.convert_many([{"EUR": Decimal(1)}, {"USD": Decimal(1)}])
+
+    def test_major_units(self):
+        assert ConversionEngine.to_major_units(43148) == 431.48
+        assert str(ConversionEngine.to_major_units(10)) == "0.1"
@@ -0,0 +1,519 @@
+import asyncio
+import multiprocessing
+import time
+from datetime import date
+
+import pytest
+from fastapi import HTTPException
+
+from settings import api_settings
+
+from test.data.exchange_rates import DEFAULT_EXCHANGE_RATES, HISTORICAL_EXCHANGE_RATES
+from test.fixtures.util import FakeClock
+
+from clients.exchange_rates import ExchangeRateClientFactory
+from clients.exchange_rates.cache import RateCache
+from clients.exchange_rates.nbp_client import NBPExchangeRateClient, NBPTableExchangeRateClient, get_table_url, today
+from clients.exchange_rates.rate_store import StoredRate
+from clients.exchange_rates.shared_cache import SharedRateCache
+
+from models.wallet import Currency, LocalCurrency
+
+
+class TestNBPTableExchangeRateClient:
+
+    def test_factory_mode(self, monkeypatch):
+        """
+        Check that the factory picks the client
+        matching the configured NBP API mode
+        """
+        monkeypatch.setattr(api_settings, "nbp_api_mode", "table")
+        assert ExchangeRateClientFactory.get_client(LocalCurrency.PLN) is NBPTableExchangeRateClient
+
+        monkeypatch.setattr(api_settings, "nbp_api_mode", "rates")
+        assert ExchangeRateClientFactory.get_client(LocalCurrency.PLN) is NBPExchangeRateClient
+
+    def test_single_request_fills_cache(self, nbp_stub, cold_rate_cache):
+        """
+        Ensure that one table request caches
+        the rate of every supported currency
+        """
+        rate = asyncio.run(NBPTableExchangeRateClient.get_rate("USD"))
+
+        assert rate == DEFAULT_EXCHANGE_RATES["USD"]["ask"]
+        assert nbp_stub.request_count == 1
+
+        rates = asyncio.run(NBPTableExchangeRateClient.get_rates(list(Currency)))
+
+        assert rates == {currency: DEFAULT_EXCHANGE_RATES[currency.value]["ask"] for currency in Currency}
+        assert nbp_stub.request_count == 1
+
+    def test_rate_store_unavailable(self, nbp_stub, cold_rate_cache, tmp_path, monkeypatch):
+        """
+        Ensure that current rates are fetched from NBP when the rate store
+        can't be opened, and that historical rates are reported as unavailable
+        """
+        (tmp_path / "not-a-directory").touch()
+        monkeypatch.setattr(api_settings, "rate_store_path", str(tmp_path / "not-a-directory" / "rates.sqlite3"))
+
+        rates = asyncio.run(NBPTableExchangeRateClient.get_rates(list(Currency)))
+
+        assert rates == {currency: DEFAULT_EXCHANGE_RATES[currency.value]["ask"] for currency in Currency}
+        assert nbp_stub.request_count == 1
+
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(NBPTableExchangeRateClient.get_rate("USD", as_of=date(2025, 1, 7)))
+
+        assert error.value.status_code == 503
+
+    def test_missing_currency(self, nbp_stub, cold_rate_cache):
+        """
+        Verify that a table which doesn't list
+        a currency we hold is reported as unavailable
+        """
+        nbp_stub.rates = {"USD": DEFAULT_EXCHANGE_RATES["USD"]}
+
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(NBPTableExchangeRateClient.get_rate("EUR"))
+
+        assert error.value.status_code == 503
+
+
+class CountingLoader:
+    """
+    Loader that counts its calls and returns
+    the call number after a short delay
+    """
+
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        call_number = self.calls
+        await asyncio.sleep(self.delay)
+        return call_number
+
+
+class TestRateCache:
+
+    def test_concurrent_misses_share_fetch(self):
+        """
+        Ensure that concurrent misses for the
+        same key result in a single upstream fetch
+        """
+        cache = RateCache(ttl=60)
+        loader = CountingLoader()
+
+        async def run():
+            return await asyncio.gather(*(cache.get("USD", loader) for _ in range(50)))
+
+        assert asyncio.run(run()) == [1] * 50
+        assert loader.calls == 1
+
+    def test_stale_value_served_during_refresh(self):
+        """
+        Check that an expired value is still served within
+        the grace window while one background refresh runs
+        """
+        clock = FakeClock()
+        cache = RateCache(ttl=60, stale_grace=30, clock=clock)
+        loader = CountingLoader()
+
+        async def run():
+            await cache.get("USD", loader)
+            clock.now = 70
+
+            stale_values = await asyncio.gather(*(cache.get("USD", loader) for _ in range(20)))
+            # Let the background refresh complete
+            await asyncio.sleep(loader.delay * 2)
+
+            return stale_values, await cache.get("USD", loader)
+
+        stale_values, refreshed_value = asyncio.run(run())
+
+        assert stale_values == [1] * 20
+        assert refreshed_value == 2
+        assert loader.calls == 2
+
+    def test_value_past_grace_is_refetched(self):
+        """
+        Verify that a value older than the grace
+        window is never returned
+        """
+        clock = FakeClock()
+        cache = RateCache(ttl=60, stale_grace=30, clock=clock)
+        loader = CountingLoader()
+
+        async def run():
+            await cache.get("USD", loader)
+            clock.now = 100
+            return await asyncio.gather(*(cache.get("USD", loader) for _ in range(20)))
+
+        assert asyncio.run(run()) == [2] * 20
+        assert loader.calls == 2
+
+    def test_refresher_warms_before_expiry(self):
+        """
+        Ensure that the refresher reloads entries
+        shortly before they expire
+        """
+        clock = FakeClock()
+        cache = RateCache(ttl=60, refresh_ahead=5, refresh_interval=0.01, clock=clock)
+        loader = CountingLoader(delay=0)
+
+        async def run():
+            await cache.get("USD", loader)
+            cache.start_refresher()
+
+            clock.now = 56
+            await asyncio.sleep(0.05)
+            await cache.stop_refresher()
+
+            # Still fresh without calling the loader from the request path
+            clock.now = 61
+            return "USD" in cache
+
+        assert asyncio.run(run())
+        assert loader.calls == 2
+
+    def test_epoch_only_changes_with_values(self):
+        """
+        Check that reloading an unchanged value keeps the epoch,
+        while a changed value or clearing the cache moves it
+        """
+        clock = FakeClock()
+        cache = RateCache(ttl=60, clock=clock)
+        values = iter([1.5, 1.5, 1.6])
+
+        async def loader():
+            return next(values)
+
+        async def run():
+            epochs = []
+            for now in (0, 100, 200):
+                clock.now = now
+                await cache.get("USD", loader)
+                epochs.append(cache.epoch)
+            cache.clear()
+            epochs.append(cache.epoch)
+            return epochs
+
+        assert asyncio.run(run()) == [0, 0, 1, 2]
+
+    def test_concurrent_nbp_requests(self, nbp_stub, cold_rate_cache):
+        """
+        Check that concurrent wallet conversions on a cold
+        cache send a single request to the NBP API
+        """
+        nbp_stub.delay = 0.1
+
+        async def run():
+            return await asyncio.gather(
+                *(NBPTableExchangeRateClient.get_rates(list(Currency)) for _ in range(20))
+            )
+
+        asyncio.run(run())
+
+        assert nbp_stub.request_count == 1
+
+
+class TestExchangeRateHTTPClient:
+
+    def test_connection_reuse(self, nbp_stub, exchange_rate_http):
+        """
+        Ensure that consecutive requests to the
+        NBP API reuse a pooled connection
+        """
+        async def run():
+            for _ in range(5):
+                await exchange_rate_http._fetch(get_table_url())
+
+        asyncio.run(run())
+
+        metrics = exchange_rate_http.http_metrics
+        assert metrics.requests == 5
+        assert metrics.connections_opened == 1
+        assert metrics.pool_hit_rate == 0.8
+
+    def test_retry_server_error(self, nbp_stub, exchange_rate_http):
+        """
+        Check that server errors are retried
+        before giving up on the request
+        """
+        nbp_stub.failures_remaining = api_settings.exchange_rate_max_retries
+
+        response = asyncio.run(exchange_rate_http._fetch(get_table_url()))
+
+        assert response[0]["table"] == "C"
+        assert nbp_stub.request_count == api_settings.exchange_rate_max_retries + 1
+        assert exchange_rate_http.http_metrics.retries == api_settings.exchange_rate_max_retries
+
+    def test_circuit_breaker(self, nbp_stub, exchange_rate_http):
+        """
+        Verify that once the NBP API keeps failing
+        calls are rejected without reaching it
+        """
+        nbp_stub.failures_remaining = 1000
+        attempts_per_call = api_settings.exchange_rate_max_retries + 1
+        threshold = api_settings.exchange_rate_circuit_failure_threshold
+
+        for _ in range(threshold + 3):
+            with pytest.raises(HTTPException) as error:
+                asyncio.run(exchange_rate_http._fetch(get_table_url()))
+            assert error.value.status_code == 503
+
+        assert nbp_stub.request_count == threshold * attempts_per_call
+        assert exchange_rate_http.http_metrics.circuit_rejections == 3
+
+
+class TestHistoricalRates:
+
+    @pytest.mark.parametrize("client", [NBPExchangeRateClient, NBPTableExchangeRateClient])
+    def test_rate_as_of(self, nbp_stub, client):
+        """
+        Check that a past rate comes from the table
+        in effect on that date
+        """
+        rates = asyncio.run(client.get_rates(list(Currency), as_of=date(2025, 1, 7)))
+
+        assert rates == {
+            currency: HISTORICAL_EXCHANGE_RATES["2025-01-07"][currency.value]["ask"] for currency in Currency
+        }
+
+    def test_day_without_table(self, nbp_stub):
+        """
+        Ensure that weekends and holidays get the rate
+        from the latest table published before them
+        """
+        for as_of in (date(2025, 1, 4), date(2025, 1, 5), date(2025, 1, 6)):
+            rate = asyncio.run(NBPTableExchangeRateClient.get_rate("USD", as_of=as_of))
+
+            assert rate == HISTORICAL_EXCHANGE_RATES["2025-01-03"]["USD"]["ask"]
+
+    def test_backfilled_days_served_locally(self, nbp_stub, rate_store):
+        """
+        Verify that once a range is backfilled, lookups
+        in it don't call the NBP API again
+        """
+        asyncio.run(NBPTableExchangeRateClient.backfill(date(2024, 12, 1), date(2025, 1, 31)))
+        request_count = nbp_stub.request_count
+
+        for day in range(1, 11):
+            asyncio.run(NBPTableExchangeRateClient.get_rate("EUR", as_of=date(2025, 1, day)))
+
+        assert request_count == 1
+        assert nbp_stub.request_count == 1
+        assert rate_store.missing_days(date(2024, 12, 1), date(2025, 1, 31)) == []
+
+    def test_backfill_in_chunks(self, nbp_stub):
+        """
+        Check that long ranges are split into requests
+        the NBP API accepts
+        """
+        stored = asyncio.run(NBPTableExchangeRateClient.backfill(date(2024, 6, 1), date(2025, 1, 31)))
+
+        assert stored == len(HISTORICAL_EXCHANGE_RATES) * len(Currency)
+        assert nbp_stub.request_count == 3
+        assert all(path.count("/") == 6 for path in nbp_stub.request_paths)
+
+    def test_no_rate_before_history(self, nbp_stub):
+        """
+        Ensure that a date without any table in the days
+        before it is reported as unavailable
+        """
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(NBPTableExchangeRateClient.get_rate("USD", as_of=date(2020, 1, 1)))
+
+        assert error.value.status_code == 503
+
+    def test_current_table_stored(self, nbp_stub, cold_rate_cache, rate_store):
+        """
+        Verify that fetched tables are stored, and that a stored
+        table for today is used instead of calling the NBP API
+        """
+        asyncio.run(NBPTableExchangeRateClient.get_rate("USD"))
+
+        assert rate_store.get_rate("USD", date.fromisoformat("2025-06-13")).ask == DEFAULT_EXCHANGE_RATES["USD"]["ask"]
+
+        rate_store.add_rates(StoredRate(today(), currency.value, 1.0, 2.0) for currency in Currency)
+        NBPTableExchangeRateClient._rate_cache.clear()
+        NBPExchangeRateClient._rate_cache.clear()
+
+        assert asyncio.run(NBPTableExchangeRateClient.get_rate("USD")) == 2.0
+        assert asyncio.run(NBPExchangeRateClient.get_rate("JPY")) == 2.0
+        assert nbp_stub.request_count == 1
+
+
+def read_shared_rates(barrier, results):
+    """
+    Worker process reading rates through the shared cache, settings
+    come from the environment set up by the test
+    """
+    from clients.exchange_rates.nbp_client import NBPTableExchangeRateClient
+
+    async def run():
+        return await asyncio.gather(*(NBPTableExchangeRateClient.get_rates(list(Currency)) for _ in range(10)))
+
+    barrier.wait()
+    rates = asyncio.run(run())
+    rate_version = (NBPTableExchangeRateClient.rate_epoch_scope(), NBPTableExchangeRateClient.rate_epoch())
+    results.put((rates[0], rate_version))
+
+
+def write_shared_entries(path, stop):
+    """
+    Worker process rewriting one entry as fast as it can
+    """
+    cache = SharedRateCache(path=path, ttl=60)
+    cache._open()
+    version = 0
+    while not stop.is_set():
+        version += 1
+        with cache._write_lock():
+            cache._write({"USD": {"value": [version] * 100, "fetched_at": time.time()}}, epoch=version, scope="test")
+
+
+class TestSharedRateCache:
+
+    def test_workers_share_one_fetch(self, nbp_stub, tmp_path, monkeypatch):
+        """
+        Ensure that worker processes on a cold host send a
+        single request to the NBP API and read the same rates
+        """
+        nbp_stub.delay = 0.1
+        monkeypatch.setenv("NBP_API_URL", nbp_stub.api_url)
+        monkeypatch.setenv("SHARED_RATE_CACHE_DIR", str(tmp_path))
+        monkeypatch.setenv("RATE_STORE_PATH", str(tmp_path / "exchange_rates.sqlite3"))
+
+        context = multiprocessing.get_context("spawn")
+        workers = 4
+        barrier = context.Barrier(workers)
+        results = context.Queue()
+        processes = [context.Process(target=read_shared_rates, args=(barrier, results)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        worker_results = [results.get(timeout=60) for _ in processes]
+        for process in processes:
+            process.join()
+
+        expected_rates = {currency.value: DEFAULT_EXCHANGE_RATES[currency.value]["ask"] for currency in Currency}
+        assert all(rates == expected_rates for rates, _ in worker_results)
+        # Every worker sees the rates from the same write, so ETags computed by any of them match
+        assert len({rate_version for _, rate_version in worker_results}) == 1
+        assert nbp_stub.request_count == 1
+
+    def test_consistent_reads(self, tmp_path):
+        """
+        Check that a reader never sees an entry
+        that is half written by another process
+        """
+        path = str(tmp_path / "rates.cache")
+        context = multiprocessing.get_context("spawn")
+        stop = context.Event()
+        writer = context.Process(target=write_shared_entries, args=(path, stop))
+        writer.start()
+
+        cache = SharedRateCache(path=path, ttl=60)
+        versions = set()
+        deadline = time.monotonic() + 10
+        try:
+            while len(versions) < 100 and time.monotonic() < deadline:
+                entry = cache._read().get("USD")
+                if entry is not None:
+                    assert len(set(entry["value"])) == 1
+                    versions.add(entry["value"][0])
+        finally:
+            stop.set()
+            writer.join()
+
+        assert len(versions) >= 100
+
+    def test_single_refresher(self, tmp_path):
+        """
+        Verify that only one worker refreshes the shared
+        entries, and that another takes over when it stops
+        """
+        path = str(tmp_path / "rates.cache")
+        caches = [SharedRateCache(path=path, ttl=0.2, refresh_ahead=0.1, refresh_interval=0.02) for _ in range(3)]
+        loaders = [CountingLoader(delay=0) for _ in caches]
+
+        async def run():
+            for cache, loader in zip(caches, loaders):
+                await cache.get("USD", loader)
+                cache.start_refresher()
+            await asyncio.sleep(0.5)
+
+            refreshers = [cache for cache in caches if cache.is_refresher]
+            calls = [loader.calls for loader in loaders]
+            await refreshers[0].stop_refresher()
+            await asyncio.sleep(0.5)
+
+            new_refreshers = [cache for cache in caches if cache.is_refresher]
+            for cache in caches:
+                await cache.stop_refresher()
+            return refreshers, new_refreshers, calls
+
+        refreshers, new_refreshers, calls = asyncio.run(run())
+
+        assert len(refreshers) == 1
+        elected = caches.index(refreshers[0])
+        # Apart from the first load, only the elected worker called its loader
+        assert calls[elected] > 1
+        assert sum(calls) - calls[elected] <= 1
+
+        assert len(new_refreshers) == 1
+        assert new_refreshers[0] is not refreshers[0]
+        assert loaders[caches.index(new_refreshers[0])].calls > calls[caches.index(new_refreshers[0])]
+
+    def test_lock_released_while_loading(self, tmp_path):
+        """
+        Ensure that a worker loading an entry doesn't keep other
+        workers from loading other entries, and that a worker
+        missing the same entry waits for the value being loaded
+        """
+        path = str(tmp_path / "rates.cache")
+        loading_cache, other_cache = SharedRateCache(path=path, ttl=60), SharedRateCache(path=path, ttl=60)
+        other_loader = CountingLoader(delay=0)
+
+        async def load_usd():
+            # Would time out if the write lock was held during the load
+            eur = await asyncio.wait_for(other_cache.get("EUR", other_loader), timeout=1)
+            return eur + 100
+
+        async def run():
+            loading = asyncio.create_task(loading_cache.get("USD", load_usd))
+            while "USD" not in other_cache._read():
+                await asyncio.sleep(0.001)
+            # The load of USD has been claimed
+            return [await loading, await other_cache.get("USD", other_loader)]
+
+        assert asyncio.run(run()) == [101, 101]
+        assert other_loader.calls == 1
+
+    def test_epoch_only_changes_with_values(self, tmp_path):
+        """
+        Check that the shared epoch is kept when a value is reloaded
+        unchanged, and moves when it changes or the cache is cleared
+        """
+        clock = FakeClock()
+        path = str(tmp_path / "rates.cache")
+        caches = [SharedRateCache(path=path, ttl=60, clock=clock) for _ in range(2)]
+        values = iter([[1.5], [1.5], [2.5]])
+
+        async def loader():
+            return next(values)
+
+        async def run():
+            epochs = []
+            for cache in caches + caches[:1]:
+                await cache.get("USD", loader)
+                clock.now += 60
+                epochs.append(caches[1].epoch)
+            caches[0].clear()
+            epochs.append(caches[1].epoch)
+            return epochs
+
+        assert asyncio.run(run()) == [0, 0, 1, 2]
+        assert caches[0].scope == caches[1].scope is not None
@@ -0,0 +1,84 @@
+import csv
+import io
+import json
+
+import pytest
+
+from test.data.exchange_rates import DEFAULT_EXCHANGE_RATES
+from test.data.wallets import DEFAULT_WALLET_DATA
+from test.fixtures.create_database_resources import create_extra_wallets
+
+
+@pytest.fixture
+def exporter_class(mocked_aws):
+    from services.export_service import WalletExporter
+    return WalletExporter
+
+
+class TestWalletExporter:
+
+    def test_export_ndjson(self, exporter_class):
+        """
+        Ensure that every wallet is exported
+        once when scanning in parallel
+        """
+        user_ids = create_extra_wallets(120)
+        output = io.StringIO()
+
+        stats = exporter_class(total_segments=4, page_size=10).export(output)
+
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+
+        assert stats.rows == 121
+        assert sorted(row["user_id"] for row in rows) == sorted([*user_ids, DEFAULT_WALLET_DATA["user_id"]])
+
+    def test_export_csv_converted(self, exporter_class, cold_rate_cache):
+        """
+        Check that converted CSV exports use the
+        same rounding as the wallet endpoint
+        """
+        output = io.StringIO()
+
+        exporter_class(output_format="csv", total_segments=2, convert=True).export(output)
+
+        rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+
+        assert len(rows) == 1
+        for currency, balance in DEFAULT_WALLET_DATA["balances"].items():
+            assert float(rows[0][currency]) == round(balance * DEFAULT_EXCHANGE_RATES[currency]["ask"], 2)
+
+    def test_export_resume(self, exporter_class, tmp_path):
+        """
+        Verify that an interrupted export resumes from
+        the checkpoint without skipping any wallet
+        """
+        from clients.aws import wallets_table
+
+        user_ids = create_extra_wallets(200)
+        checkpoint_path = str(tmp_path / "export.checkpoint")
+        output = io.StringIO()
+        scan = wallets_table.scan
+        scans = []
+
+        def failing_scan(**kwargs):
+            scans.append(kwargs)
+            if len(scans) == 6:
+                raise RuntimeError("connection lost")
+            return scan(**kwargs)
+
+        wallets_table.scan = failing_scan
+        try:
+            with pytest.raises(RuntimeError):
+                exporter_class(total_segments=2, page_size=20, checkpoint_path=checkpoint_path).export(output)
+        finally:
+            del wallets_table.scan
+
+        exporter = exporter_class(total_segments=2, page_size=20, checkpoint_path=checkpoint_path)
+        assert exporter.is_resuming
+        exporter.export(output)
+
+        exported_ids = [json.loads(line)["user_id"] for line in output.getvalue().splitlines()]
+
+        assert set(exported_ids) == {*user_ids, DEFAULT_WALLET_DATA["user_id"]}
+        # At most the interrupted page of each segment is exported twice
+        assert len(exported_ids) <= len(user_ids) + 1 + 2 * 20
@@ -0,0 +1,194 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pytest
+from botocore.exceptions import ClientError
+
+from test.data.wallets import DEFAULT_WALLET_DATA
+
+from models.wallet import BalanceChange
+
+USER_ID = DEFAULT_WALLET_DATA["user_id"]
+
+
+@pytest.fixture
+def services(mocked_aws, wallet_ledger):
+    from services.ledger_service import LedgerService
+    from services.wallet_service import WalletService
+    return WalletService, LedgerService
+
+
+@pytest.fixture
+def entries_read(monkeypatch):
+    """
+    Counts the ledger items read by queries
+    """
+    from clients.aws import async_ledger_table
+    query = async_ledger_table.query
+    counts = []
+
+    async def counting_query(**kwargs):
+        response = await query(**kwargs)
+        counts.append(len(response["Items"]))
+        return response
+
+    monkeypatch.setattr(async_ledger_table, "query", counting_query)
+    return counts
+
+
+def now() -> datetime:
+    # Keeps changes made before and after the returned time apart
+    time.sleep(0.002)
+    moment = datetime.now(timezone.utc)
+    time.sleep(0.002)
+    return moment
+
+
+class TestLedger:
+
+    def test_balances_at_point_in_time(self, services):
+        """
+        Ensure that balances can be read as they were after each
+        change, and aren't reported from before the first one
+        """
+        wallet_service, ledger_service = services
+
+        before_changes = now()
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(100)))
+        after_add = now()
+        asyncio.run(wallet_service.apply_balance_changes(USER_ID, [
+            BalanceChange(currency="USD", amount=Decimal(-5)),
+            BalanceChange(currency="EUR", amount=Decimal(1)),
+        ]))
+        after_batch = now()
+
+        history = [asyncio.run(ledger_service.get_balances_at(USER_ID, at)) for at in (before_changes, after_add, after_batch)]
+        balances = DEFAULT_WALLET_DATA["balances"]
+
+        assert history[0] is None
+        assert history[1] == {**balances, "JPY": balances["JPY"] + 100}
+        assert history[2] == {"JPY": balances["JPY"] + 100, "USD": balances["USD"] - 5, "EUR": balances["EUR"] + 1}
+
+    def test_failed_change_not_recorded(self, services):
+        """
+        Check that a rejected subtraction leaves
+        neither the wallet nor the ledger changed
+        """
+        wallet_service, ledger_service = services
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "USD", Decimal(1)))
+
+        with pytest.raises(ClientError) as error:
+            asyncio.run(wallet_service.subtract_from_wallet(USER_ID, "USD", Decimal(1000)))
+
+        assert error.value.response["Error"]["Code"] == "ConditionalCheckFailedException"
+        assert asyncio.run(ledger_service.get_balances_at(USER_ID, now())) == {
+            **DEFAULT_WALLET_DATA["balances"], "USD": DEFAULT_WALLET_DATA["balances"]["USD"] + 1
+        }
+
+    def test_compaction(self, services, entries_read):
+        """
+        Verify that compaction snapshots wallets with enough new entries,
+        and that queries then read a bounded number of entries
+        """
+        wallet_service, ledger_service = services
+
+        for _ in range(12):
+            asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(1)))
+
+        assert asyncio.run(ledger_service.compact()) == 1
+        # No entries since the snapshot, so nothing to do
+        assert asyncio.run(ledger_service.compact()) == 0
+
+        for _ in range(3):
+            asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(1)))
+
+        entries_read.clear()
+        balances = asyncio.run(ledger_service.get_balances_at(USER_ID, now()))
+
+        assert balances["JPY"] == DEFAULT_WALLET_DATA["balances"]["JPY"] + 15
+        # The first entry, the snapshot, then its own entry and the 3 written after it
+        assert entries_read == [1, 1, 4]
+
+    def test_before_first_snapshot(self, services, entries_read):
+        """
+        Ensure that a time before the earliest snapshot is
+        answered by undoing entries from that snapshot
+        """
+        wallet_service, ledger_service = services
+
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "EUR", Decimal(10)))
+        after_first = now()
+        for _ in range(5):
+            asyncio.run(wallet_service.add_to_wallet(USER_ID, "EUR", Decimal(1)))
+        asyncio.run(ledger_service.compact())
+        for _ in range(20):
+            asyncio.run(wallet_service.add_to_wallet(USER_ID, "EUR", Decimal(1)))
+
+        entries_read.clear()
+        balances = asyncio.run(ledger_service.get_balances_at(USER_ID, after_first))
+
+        assert balances["EUR"] == DEFAULT_WALLET_DATA["balances"]["EUR"] + 10
+        # The first entry, no snapshot before, then the snapshot after and the 5 entries up to it
+        assert entries_read == [1, 0, 1, 5]
+
+    def test_entries_committed_out_of_order(self, services, monkeypatch):
+        """
+        Check that an entry positioned before the wallet's latest one, by a
+        slower writer or a clock behind, is retried after it instead of
+        moving the wallet back to an earlier position
+        """
+        wallet_service, ledger_service = services
+
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "USD", Decimal(100)))
+        after_usd = now()
+        latest_position = asyncio.run(ledger_service.latest_position(USER_ID))
+
+        new_position = ledger_service.new_position
+
+        def lagging_position(after=None):
+            position = new_position(after)
+            if after is None:
+                # 10 seconds behind the writer of the USD entry
+                position = f"{int(position[:16]) - 10_000_000:016d}{position[16:]}"
+            return position
+
+        monkeypatch.setattr(ledger_service, "new_position", staticmethod(lagging_position))
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "EUR", Decimal(1)))
+
+        balances = DEFAULT_WALLET_DATA["balances"]
+        assert asyncio.run(ledger_service.latest_position(USER_ID)) > latest_position
+        assert asyncio.run(ledger_service.get_balances_at(USER_ID, after_usd)) == {
+            **balances, "USD": balances["USD"] + 100
+        }
+        assert asyncio.run(ledger_service.get_balances_at(USER_ID, now())) == {
+            **balances, "USD": balances["USD"] + 100, "EUR": balances["EUR"] + 1
+        }
+
+    def test_unledgered_change(self, services, monkeypatch):
+        """
+        Verify that times before a change made while the
+        ledger was disabled aren't answered from the ledger
+        """
+        wallet_service, ledger_service = services
+
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(1)))
+        after_first = now()
+        monkeypatch.setattr("settings.api_settings.wallet_ledger_enabled", False)
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(10)))
+        monkeypatch.setattr("settings.api_settings.wallet_ledger_enabled", True)
+        after_unledgered = now()
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(100)))
+
+        assert asyncio.run(ledger_service.get_balances_at(USER_ID, after_first)) is None
+        assert asyncio.run(ledger_service.get_balances_at(USER_ID, after_unledgered))["JPY"] == \
+            DEFAULT_WALLET_DATA["balances"]["JPY"] + 11
+        assert asyncio.run(ledger_service.get_balances_at(USER_ID, now()))["JPY"] == \
+            DEFAULT_WALLET_DATA["balances"]["JPY"] + 111
+
+    def test_unknown_wallet(self, services):
+        _, ledger_service = services
+
+        assert asyncio.run(ledger_service.get_balances_at("unknown-user", now())) is None
+
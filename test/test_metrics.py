@@ -0,0 +1,64 @@
+import pytest
+
+from settings import api_settings
+
+from metrics import MetricsRegistry
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+
+class TestMetricsRegistry:
+
+    def test_render_counter(self, registry):
+        counter = registry.counter("requests_total", "Requests", ("route",))
+        counter.inc("/wallet")
+        counter.inc("/wallet", amount=2)
+        counter.inc('/odd "route"\n')
+
+        assert registry.render().splitlines() == [
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{route="/wallet"} 3',
+            'requests_total{route="/odd \\"route\\"\\n"} 1',
+        ]
+
+    def test_render_histogram(self, registry):
+        histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        assert registry.render().splitlines()[2:] == [
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            "latency_seconds_sum 3.65",
+            "latency_seconds_count 4",
+        ]
+
+    def test_caches_share_one_family(self, registry):
+        class Cache:
+            hits = 3
+            misses = 1
+
+        registry.add_cache("first", lambda: Cache)
+        registry.add_cache("second", lambda: Cache)
+        lines = registry.render().splitlines()
+
+        assert lines.count("# TYPE cache_hit_ratio gauge") == 1
+        assert 'cache_hit_ratio{cache="first"} 0.75' in lines
+        assert 'cache_hits_total{cache="second"} 3' in lines
+
+    def test_disabled(self, registry, monkeypatch):
+        monkeypatch.setattr(api_settings, "metrics_enabled", False)
+        counter = registry.counter("requests_total", "Requests")
+        histogram = registry.histogram("latency_seconds", "Latency")
+
+        counter.inc()
+        with histogram.time():
+            pass
+
+        assert counter.value() == 0
+        assert histogram.count() == 0
@@ -0,0 +1,395 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+from botocore.exceptions import ClientError
+
+from test.data.exchange_rates import DEFAULT_EXCHANGE_RATES
+from test.data.wallets import DEFAULT_WALLET_DATA
+from test.fixtures.create_database_resources import create_extra_wallets
+
+USER_ID = DEFAULT_WALLET_DATA["user_id"]
+
+
+@pytest.fixture
+def wallet_service(mocked_aws):
+    from services.wallet_service import WalletService
+    return WalletService
+
+
+@pytest.fixture
+def wallets_table(mocked_aws):
+    from clients.aws import wallets_table
+    return wallets_table
+
+
+class TestWalletCache:
+
+    def test_read_through(self, wallet_service, wallet_cache, wallets_table):
+        """
+        Ensure that repeated reads are served from
+        the cache after the first DynamoDB read
+        """
+        asyncio.run(wallet_service.get_original_wallet(USER_ID))
+
+        # Changes made behind the service's back aren't seen while the entry is cached
+        wallets_table.update_item(
+            Key={"user_id": USER_ID},
+            UpdateExpression="SET balances.JPY = :balVal",
+            ExpressionAttributeValues={":balVal": 0},
+        )
+        wallet = asyncio.run(wallet_service.get_original_wallet(USER_ID))
+
+        assert wallet.balances["JPY"] == DEFAULT_WALLET_DATA["balances"]["JPY"]
+        assert wallet_cache.misses == 1
+        assert wallet_cache.hits == 1
+
+    def test_read_your_writes(self, wallet_service, wallet_cache):
+        """
+        Check that a write updates the cached
+        wallet instead of leaving it stale
+        """
+        asyncio.run(wallet_service.get_original_wallet(USER_ID))
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(100)))
+        wallet = asyncio.run(wallet_service.get_original_wallet(USER_ID))
+
+        assert wallet.balances["JPY"] == DEFAULT_WALLET_DATA["balances"]["JPY"] + 100
+        assert wallet_cache.misses == 1
+        assert wallet_cache.hits == 1
+
+    def test_failed_write_invalidates(self, wallet_service, wallet_cache):
+        """
+        Verify that a rejected subtraction drops
+        the cached wallet
+        """
+        asyncio.run(wallet_service.get_original_wallet(USER_ID))
+
+        with pytest.raises(ClientError):
+            asyncio.run(wallet_service.subtract_from_wallet(USER_ID, "USD", Decimal(500)))
+
+        assert wallet_cache.get(USER_ID) is None
+
+    def test_disabled(self, wallet_service, wallet_cache, monkeypatch):
+        """
+        Ensure that nothing is cached when
+        the wallet cache is switched off
+        """
+        from settings import api_settings
+
+        monkeypatch.setattr(api_settings, "wallet_cache_enabled", False)
+
+        asyncio.run(wallet_service.get_original_wallet(USER_ID))
+        asyncio.run(wallet_service.get_original_wallet(USER_ID))
+
+        assert wallet_cache.hits == 0
+        assert len(wallet_cache._cache) == 0
+
+
+class TestConvertedWalletCache:
+
+    def test_repeat_conversion(self, wallet_service, converted_wallet_cache, cold_rate_cache):
+        """
+        Ensure that converting an unchanged wallet with
+        unchanged rates reuses the previous result
+        """
+        async def run():
+            return [await wallet_service.get_local_currency_wallet(USER_ID) for _ in range(3)]
+
+        first, *repeats = asyncio.run(run())
+
+        assert all(repeat == first for repeat in repeats)
+        assert converted_wallet_cache.hits >= 1
+
+    def test_wallet_change(self, wallet_service, converted_wallet_cache, cold_rate_cache):
+        """
+        Check that a balance change produces
+        a freshly converted wallet
+        """
+        async def run():
+            before = await wallet_service.get_local_currency_wallet(USER_ID)
+            await wallet_service.add_to_wallet(USER_ID, "USD", Decimal(1))
+            return before, await wallet_service.get_local_currency_wallet(USER_ID)
+
+        before, after = asyncio.run(run())
+
+        assert after.balances["USD"] == round((DEFAULT_WALLET_DATA["balances"]["USD"] + 1) * DEFAULT_EXCHANGE_RATES["USD"]["ask"], 2)
+        assert after.total > before.total
+
+    def test_rate_change(self, wallet_service, converted_wallet_cache, cold_rate_cache, nbp_stub):
+        """
+        Verify that refreshed exchange rates
+        produce a freshly converted wallet
+        """
+        from clients.exchange_rates.nbp_client import NBPTableExchangeRateClient
+
+        async def run():
+            before = await wallet_service.get_local_currency_wallet(USER_ID)
+            await wallet_service.get_local_currency_wallet(USER_ID)
+
+            nbp_stub.rates = {code: {**rate, "ask": rate["ask"] * 2} for code, rate in DEFAULT_EXCHANGE_RATES.items()}
+            NBPTableExchangeRateClient._rate_cache.clear()
+            return before, await wallet_service.get_local_currency_wallet(USER_ID)
+
+        before, after = asyncio.run(run())
+
+        assert after.balances["EUR"] == round(DEFAULT_WALLET_DATA["balances"]["EUR"] * DEFAULT_EXCHANGE_RATES["EUR"]["ask"] * 2, 2)
+        assert after.total > before.total
+
+
+class TestBulkWalletRead:
+
+    def test_unprocessed_keys_retried(self, wallet_service, monkeypatch):
+        """
+        Ensure that keys DynamoDB leaves unprocessed
+        are requested again until every wallet is read
+        """
+        from clients.aws import async_wallets_table
+        from settings import api_settings
+
+        monkeypatch.setattr(api_settings, "batch_get_retry_backoff", 0)
+        user_ids = create_extra_wallets(150)
+        batch_get_item = async_wallets_table.batch_get_item
+        requested_key_counts = []
+
+        async def throttled_batch_get_item(request):
+            # Only process the first ten keys of each request
+            requested_key_counts.append(len(request["Keys"]))
+            response = await batch_get_item({**request, "Keys": request["Keys"][:10]})
+            if len(request["Keys"]) > 10:
+                response["UnprocessedKeys"] = {
+                    async_wallets_table.name: {**request, "Keys": request["Keys"][10:]}
+                }
+            return response
+
+        monkeypatch.setattr(async_wallets_table, "batch_get_item", throttled_batch_get_item)
+        monkeypatch.setattr(api_settings, "batch_get_max_retries", 10)
+
+        async def run():
+            return [result async for result in wallet_service.get_wallets(user_ids)]
+
+        wallets = dict(asyncio.run(run()))
+
+        assert set(wallets) == set(user_ids)
+        assert all(wallet is not None for wallet in wallets.values())
+        assert max(requested_key_counts) == 100
+        assert len(requested_key_counts) == 15
+
+    def test_unprocessed_keys_give_up(self, wallet_service, monkeypatch):
+        """
+        Verify that reading stops with an error once
+        DynamoDB keeps leaving keys unprocessed
+        """
+        from clients.aws import async_wallets_table
+        from settings import api_settings
+
+        monkeypatch.setattr(api_settings, "batch_get_retry_backoff", 0)
+
+        async def stuck_batch_get_item(request):
+            return {"Responses": {}, "UnprocessedKeys": {async_wallets_table.name: request}}
+
+        monkeypatch.setattr(async_wallets_table, "batch_get_item", stuck_batch_get_item)
+
+        async def run():
+            return [result async for result in wallet_service.get_wallets([USER_ID])]
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(run())
+
+
+class TestWriteCoalescer:
+
+    @pytest.fixture
+    def write_coalescing(self, monkeypatch):
+        from settings import api_settings
+        from services.wallet_service import WalletService
+        from services.write_coalescer import WriteCoalescer
+
+        coalescer = WriteCoalescer(write=WalletService._modify_balance, window=0.05, max_batch=100)
+        monkeypatch.setattr(api_settings, "write_coalescing_enabled", True)
+        monkeypatch.setattr(WalletService, "write_coalescer", coalescer)
+        return coalescer
+
+    def test_concurrent_adds_merged(self, wallet_service, write_coalescing, wallets_table):
+        """
+        Ensure that concurrent additions to the same currency
+        are applied with a single write
+        """
+        async def run():
+            await asyncio.gather(*(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(1)) for _ in range(50)))
+
+        asyncio.run(run())
+
+        item = wallets_table.get_item(Key={"user_id": USER_ID})["Item"]
+
+        assert item["balances"]["JPY"] == DEFAULT_WALLET_DATA["balances"]["JPY"] + 50
+        assert write_coalescing.submitted == 50
+        assert write_coalescing.writes == 1
+
+    def test_failed_subtraction_reported_to_caller(self, wallet_service, write_coalescing, wallets_table):
+        """
+        Check that only the caller whose subtraction can't be
+        covered gets the error when a merged write is rejected
+        """
+        async def run():
+            return await asyncio.gather(
+                wallet_service.subtract_from_wallet(USER_ID, "USD", Decimal(15)),
+                wallet_service.add_to_wallet(USER_ID, "USD", Decimal(2)),
+                wallet_service.subtract_from_wallet(USER_ID, "USD", Decimal(10)),
+                wallet_service.subtract_from_wallet(USER_ID, "USD", Decimal(5)),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(run())
+
+        assert results[0] is None
+        assert results[1] is None
+        assert isinstance(results[2], ClientError)
+        assert results[2].response["Error"]["Code"] == "ConditionalCheckFailedException"
+        assert results[3] is None
+
+        item = wallets_table.get_item(Key={"user_id": USER_ID})["Item"]
+
+        assert item["balances"]["USD"] == DEFAULT_WALLET_DATA["balances"]["USD"] + 2 - 15 - 5
+
+    def test_max_batch(self, wallet_service, write_coalescing, wallets_table):
+        """
+        Verify that a batch is written as soon as
+        it reaches the maximum batch size
+        """
+        write_coalescing.max_batch = 10
+        write_coalescing.window = 10
+
+        async def run():
+            await asyncio.gather(*(wallet_service.add_to_wallet(USER_ID, "EUR", Decimal(1)) for _ in range(30)))
+
+        asyncio.run(run())
+
+        item = wallets_table.get_item(Key={"user_id": USER_ID})["Item"]
+
+        assert item["balances"]["EUR"] == DEFAULT_WALLET_DATA["balances"]["EUR"] + 30
+        assert write_coalescing.writes == 3
+
+
+class TestIdempotencyKeys:
+
+    @pytest.fixture
+    def transactions(self, monkeypatch):
+        """
+        Counts the DynamoDB transactions written by the wallet service
+        """
+        import services.wallet_service
+        transact_write_items = services.wallet_service.transact_write_items
+        calls = []
+
+        async def counting_transact_write_items(transact_items):
+            calls.append(transact_items)
+            return await transact_write_items(transact_items)
+
+        monkeypatch.setattr(services.wallet_service, "transact_write_items", counting_transact_write_items)
+        return calls
+
+    def test_concurrent_duplicates_applied_once(self, wallet_service, idempotency_store, transactions, wallets_table):
+        """
+        Ensure that concurrent requests with the same key
+        are applied once, with a single transaction
+        """
+        async def run():
+            return await asyncio.gather(*(
+                wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(10), idempotency_key="retry-me")
+                for _ in range(20)
+            ))
+
+        results = asyncio.run(run())
+
+        item = wallets_table.get_item(Key={"user_id": USER_ID})["Item"]
+
+        assert item["balances"]["JPY"] == DEFAULT_WALLET_DATA["balances"]["JPY"] + 10
+        assert len(transactions) == 1
+        assert results.count(None) == 1
+        assert all(record.status_code == 200 for record in results if record is not None)
+
+    def test_replay_served_from_memory(self, wallet_service, idempotency_store, transactions, wallets_table):
+        """
+        Check that a retry of a completed request
+        doesn't reach DynamoDB
+        """
+        first = asyncio.run(wallet_service.subtract_from_wallet(USER_ID, "USD", Decimal(5), idempotency_key="retry-me"))
+        second = asyncio.run(wallet_service.subtract_from_wallet(USER_ID, "USD", Decimal(5), idempotency_key="retry-me"))
+
+        item = wallets_table.get_item(Key={"user_id": USER_ID})["Item"]
+
+        assert first is None
+        assert second.status_code == 200
+        assert item["balances"]["USD"] == DEFAULT_WALLET_DATA["balances"]["USD"] - 5
+        assert len(transactions) == 1
+        assert idempotency_store.hits == 1
+
+    def test_replay_detected_by_dynamodb(self, wallet_service, idempotency_store, transactions, wallets_table):
+        """
+        Verify that a retry handled by another process, which hasn't
+        seen the key, is caught by the record stored in DynamoDB
+        """
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "EUR", Decimal(3), idempotency_key="retry-me"))
+        idempotency_store.clear()
+        replayed_record = asyncio.run(wallet_service.add_to_wallet(USER_ID, "EUR", Decimal(3), idempotency_key="retry-me"))
+
+        item = wallets_table.get_item(Key={"user_id": USER_ID})["Item"]
+
+        assert replayed_record.status_code == 200
+        assert item["balances"]["EUR"] == DEFAULT_WALLET_DATA["balances"]["EUR"] + 3
+        assert len(transactions) == 2
+
+    def test_keys_scoped_to_user(self, wallet_service, idempotency_store, wallets_table):
+        """
+        Ensure that different users can use the same key
+        """
+        other_user_id = create_extra_wallets(1)[0]
+
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(1), idempotency_key="retry-me"))
+        replayed_record = asyncio.run(
+            wallet_service.add_to_wallet(other_user_id, "JPY", Decimal(1), idempotency_key="retry-me")
+        )
+
+        item = wallets_table.get_item(Key={"user_id": other_user_id})["Item"]
+
+        assert replayed_record is None
+        assert item["balances"]["JPY"] == 1
+
+    def test_key_reused_for_different_request(self, wallet_service, idempotency_store):
+        """
+        Check that a key sent with different changes is rejected,
+        whether the original is remembered locally or only in DynamoDB
+        """
+        from services.idempotency import IdempotencyKeyReused
+
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(1), idempotency_key="retry-me"))
+
+        with pytest.raises(IdempotencyKeyReused):
+            asyncio.run(wallet_service.add_to_wallet(USER_ID, "JPY", Decimal(2), idempotency_key="retry-me"))
+
+        idempotency_store.clear()
+
+        with pytest.raises(IdempotencyKeyReused):
+            asyncio.run(wallet_service.subtract_from_wallet(USER_ID, "JPY", Decimal(1), idempotency_key="retry-me"))
+
+    def test_failed_subtraction_can_be_retried(self, wallet_service, idempotency_store, wallets_table):
+        """
+        Verify that a rejected subtraction doesn't use up its key,
+        so the same request can succeed once the balance covers it
+        """
+        amount = Decimal(DEFAULT_WALLET_DATA["balances"]["USD"] + 5)
+
+        with pytest.raises(ClientError) as error:
+            asyncio.run(wallet_service.subtract_from_wallet(USER_ID, "USD", amount, idempotency_key="retry-me"))
+
+        assert error.value.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+        asyncio.run(wallet_service.add_to_wallet(USER_ID, "USD", Decimal(5)))
+        replayed_record = asyncio.run(
+            wallet_service.subtract_from_wallet(USER_ID, "USD", amount, idempotency_key="retry-me")
+        )
+
+        item = wallets_table.get_item(Key={"user_id": USER_ID})["Item"]
+
+        assert replayed_record is None
+        assert item["balances"]["USD"] == 0